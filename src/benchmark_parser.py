@@ -0,0 +1,68 @@
+'''
+Script that compares the speed of the parser backends of data_parser.py (BeautifulSoup and lxml iterparse).
+It reads the first patents of the raw XML file, parses them with each backend and reports the documents per second.
+It also checks that both backends produce exactly the same results, and reports the paragraphs with <maths> objects
+of the description, which both backends exclude (the bs4 backend used to keep them: its check never matched).
+'''
+
+import argparse
+import itertools
+import re
+import time
+from config import config
+from data_parser import PARSER_BACKENDS, iter_xml_patents
+
+# Paragraphs of the description of a patent, and paragraphs with <maths> objects among them
+DESCRIPTION = re.compile(r'<description\b.*?</description>', re.S)
+PARAGRAPH = re.compile(r'<p\b[^>]*>.*?</p>', re.S)
+
+def maths_paragraphs(patent):
+    ''' Number of paragraphs of the description of a patent that contain <maths> objects. '''
+    description = DESCRIPTION.search(patent)
+    if description is None:
+        return 0
+    return sum('<maths' in paragraph for paragraph in PARAGRAPH.findall(description.group()))
+
+def benchmark_backend(parse_patent, xml_pantents, repeat):
+    ''' Parses all the patents repeat times and returns the best time (in seconds) along with the results. '''
+    best_time = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parse_patent(patent) for patent in xml_pantents]
+        elapsed = time.perf_counter() - start
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time, results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the parser backends of data_parser.py.')
+    parser.add_argument('--path', default=config['raw_data_patents_path'], help='Raw XML file with the concatenated patents.')
+    parser.add_argument('--patents', type=int, default=500, help='Number of patents to parse (0 means all of them).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions. The best time is reported.')
+    args = parser.parse_args()
+
+    # 1. Load the patents in memory so the reading time does not affect the results
+    xml_pantents = iter_xml_patents(args.path, config['xml_separator'], config['xml_read_buffer_size'])
+    if args.patents > 0:
+        xml_pantents = itertools.islice(xml_pantents, args.patents)
+    xml_pantents = list(xml_pantents)
+    print(f'Parsing {len(xml_pantents)} patents from {args.path}')
+
+    # 2. Parse the patents with each backend
+    backend_results = {}
+    for name, parse_patent in PARSER_BACKENDS.items():
+        elapsed, results = benchmark_backend(parse_patent, xml_pantents, args.repeat)
+        backend_results[name] = results
+        print(f'{name:>5}: {elapsed:.3f} s, {len(xml_pantents) / elapsed:.1f} docs/sec')
+
+    # 3. Check that all the backends produce the same results
+    reference = backend_results['bs4']
+    for name, results in backend_results.items():
+        mismatches = sum(1 for r, ref in zip(results, reference) if r != ref)
+        print(f'{name:>5}: {mismatches} patents differ from bs4')
+    # Output change of the <maths> exclusion: these paragraphs were in the output of the previous versions of both backends
+    excluded = [maths_paragraphs(patent) for patent in xml_pantents]
+    print(f'Paragraphs with <maths> excluded by both backends: {sum(excluded)} in {sum(map(bool, excluded))} patents')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+'''
+Script that benchmarks the whole pipeline offline, without paying for OpenAI nor running the MPT model.
+A synthetic corpus of patents in the format of the weekly XML files (with known measurements) is generated and run
+through the same code as a real run: parsing (parse_and_save() in data_parser.py) and the extraction run of
+first_approach.py (run_extraction()), with the stand-in of the model api (Replay_LLM with the given latency and jitter)
+and every step of the real run: MeasurementExtractor with its cache and rate limiter, deduplication, journal and telemetry.
+It reports the wall time, docs/s, chunks/s and peak RSS of each stage (getrusage, so native buffers of lxml, numpy
+and pyarrow count too, and the parser worker processes are reported apart), taken from the telemetry of the run
+(see run_telemetry.py), and the recall of the known measurements.
+Each run is appended to a history file along with the commit, so the results can be compared across commits:
+python benchmark_pipeline.py --patents 500 --latency 0.2 --jitter 0.05
+python benchmark_pipeline.py --patents 500 --latency 0.2 --jitter 0.05 --compare
+'''
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from config import config
+from data_parser import PARSER_BACKENDS, parse_and_save
+from run_telemetry import max_rss_mb
+
+# Directory of this script. The default paths are resolved from it, so the benchmark can be run from any directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Vocabulary of the synthetic patents. The units are written as in the patents (see measurement_prefilter.py)
+ELEMENTS = ['coating layer', 'substrate', 'polymer film', 'particles', 'electrode', 'fiber', 'membrane', 'adhesive layer', 'housing', 'catalyst']
+PROPERTIES = {
+    'thickness': ['nm', 'μm', 'mm'],
+    'diameter': ['nm', 'μm', 'mm'],
+    'density': ['g/cc', 'g/cm3'],
+    'viscosity': ['cP', 'mPa·s'],
+    'pressure': ['MPa', 'kPa', 'psi'],
+    'concentration': ['wt %', 'mg/mL'],
+    'speed': ['rpm'],
+    'temperature': ['° C', 'K'],
+}
+MEASUREMENT_SENTENCES = [
+    'The {element} has a {property} of {value} {unit}.',
+    'In some embodiments, the {element} having a {property} of about {value} {unit} is used.',
+    'The {property} of the {element} is {value} {unit}.',
+]
+FILLER_SENTENCES = [
+    'As shown in FIG. {number}, the {element} is coupled to the {other}.',
+    'The {element} may be formed by any suitable method known in the art.',
+    'According to claim {number}, the {element} is arranged adjacent to the {other}.',
+    'The {element} and the {other} can be made of the same material or of different materials.',
+    'Various modifications of the {element} will be apparent to those skilled in the art.',
+]
+XML_PATENT = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<!DOCTYPE us-patent-grant SYSTEM "us-patent-grant-v47-2022-02-17.dtd" [ ]>\n'
+    '<us-patent-grant lang="EN" dtd-version="v4.7">\n'
+    '<us-bibliographic-data-grant><publication-reference><document-id><country>US</country>'
+    '<doc-number>{number}</doc-number><kind>B2</kind><date>20221227</date></document-id></publication-reference></us-bibliographic-data-grant>\n'
+    '<abstract id="abstract">\n{abstract}</abstract>\n'
+    '<description id="description">\n'
+    '<?BRFSUM description="Brief Summary" end="lead"?>\n{BRFSUM}<?BRFSUM description="Brief Summary" end="tail"?>\n'
+    '<?DETDESC description="Detailed Description" end="lead"?>\n{DETDESC}<?DETDESC description="Detailed Description" end="tail"?>\n'
+    '</description>\n</us-patent-grant>\n'
+)
+
+def synthetic_paragraph(generator, measurement_ratio, measurements):
+    ''' Paragraph of 3 to 6 sentences. Each sentence states a measurement with probability measurement_ratio (added to measurements). '''
+    sentences = []
+    for _ in range(generator.randint(3, 6)):
+        element, other = generator.sample(ELEMENTS, 2)
+        if generator.random() < measurement_ratio:
+            measured_property = generator.choice(list(PROPERTIES))
+            unit = generator.choice(PROPERTIES[measured_property])
+            value = str(round(generator.uniform(0.1, 500), generator.choice([0, 1, 2])))
+            sentences.append(generator.choice(MEASUREMENT_SENTENCES).format(element=element, property=measured_property, value=value, unit=unit))
+            measurements.append((value, unit))
+        else:
+            sentences.append(generator.choice(FILLER_SENTENCES).format(element=element, other=other, number=generator.randint(1, 20)))
+    return ' '.join(sentences)
+
+def generate_corpus(path, patents_num, paragraphs, measurement_ratio, seed):
+    '''
+    Writes a synthetic weekly XML file with patents_num patents. Each patent has an abstract, a summary (BRFSUM) of
+    paragraphs paragraphs and a detailed description (DETDESC) of twice as many.
+    Returns the known measurements as {(doc_id, section): [(value, unit), ...]}.
+    '''
+    generator = random.Random(seed)
+    ground_truth = {}
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(patents_num):
+            number = str(11500000 + i)
+            # doc_id as extracted by the parser (text of the <document-id>)
+            doc_id = f'US{number}B220221227'
+            sections = {}
+            for section, section_paragraphs in (('abstract', 1), ('BRFSUM', paragraphs), ('DETDESC', 2 * paragraphs)):
+                measurements = ground_truth.setdefault((doc_id, section), [])
+                sections[section] = ''.join(
+                    f'<p id="p-{p:04d}" num="{p:04d}">{synthetic_paragraph(generator, measurement_ratio, measurements)}</p>\n'
+                    for p in range(section_paragraphs)
+                )
+            f.write(XML_PATENT.format(number=number, **sections))
+    return ground_truth
+
+def git_commit():
+    ''' Short hash of the current commit (+dirty if there are uncommitted changes), or unknown outside git. '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+dirty' if dirty else '')
+
+def configure_run(args, workdir):
+    '''
+    Sets the config of the run (shared by every module through config.py): the stand-in of the model api, the options
+    of the benchmark and every input and output of the run in workdir. The previous LLM cache of workdir is removed, so
+    every chunk is sent to the stand-in.
+    '''
+    config.update({
+        'save_indiv_patents': False,
+        'output_processed_format': 'jsonl',
+        'output_processed_pantents_jsonl': os.path.join(workdir, 'synthetic_patents.jsonl'),
+        'sample_patents_num': args.sample,
+        'data_selection_seed': args.seed,
+        'data_selection_required_section': None,
+        'data_selection_sections': args.sections,
+        'use_open_ai': False,
+        'client_replay_llm': True,
+        'replay_completions_path': args.completions,
+        'replay_latency': args.latency,
+        'replay_jitter': args.jitter,
+        'text_chunk_method': args.chunk_method,
+        'chunk_prefilter': args.prefilter,
+        'llm_concurrency': args.concurrency,
+        'llm_chunks_per_call': args.chunks_per_call,
+        'rate_limit_requests_per_min': args.requests_per_min,
+        'rate_limit_tokens_per_min': args.tokens_per_min,
+        'llm_cache_path': os.path.join(workdir, 'llm_cache.sqlite'),
+        'extraction_journal_path': os.path.join(workdir, 'extraction_journal.jsonl'),
+        'output_measurements_parquet_dir': os.path.join(workdir, 'measurements'),
+        'output_extracted_pantents_json': os.path.join(workdir, 'results_extracted_patents.json'),
+        'output_extracted_pantents_valid_json': os.path.join(workdir, 'results_extracted_patents_valid.json'),
+        'output_normalized_measurements_csv': os.path.join(workdir, 'results_normalized_measurements.csv'),
+        'output_telemetry_jsonl': os.path.join(workdir, 'telemetry.jsonl'),
+        'telemetry_profiler': None,
+    })
+    if os.path.exists(config['llm_cache_path']):
+        os.remove(config['llm_cache_path'])
+
+def read_telemetry(path):
+    ''' Stage records and summary of the telemetry of a run (see run_telemetry.py). '''
+    stages, summary = [], None
+    with open(path, 'r', encoding='utf-8') as f:
+        for record in map(json.loads, f):
+            if record['type'] == 'stage':
+                stages.append(record)
+            elif record['type'] == 'summary':
+                summary = record
+    return stages, summary
+
+def recall(results, ground_truth):
+    ''' Known measurements (value and unit) found in the validated measurements of the same patent section. '''
+    found, total = 0, 0
+    for patent in results['patents']:
+        expected = Counter(ground_truth.get((patent['doc_id'], patent['data_section']), []))
+        extracted = Counter(
+            (measurement.get('value', '').replace('about ', ''), measurement.get('unit'))
+            for ep in patent['elements_processed'] for measurement in ep['validated']
+        )
+        found += sum((expected & extracted).values())
+        total += sum(expected.values())
+    return found / total if total else 1.0
+
+def run_benchmark(args, workdir):
+    ''' Runs the pipeline over a synthetic corpus and returns the record of the run. '''
+    # Imported here, after the config of the run is set
+    from first_approach import run_extraction
+    configure_run(args, workdir)
+    xml_path = os.path.join(workdir, 'synthetic_patents.xml')
+
+    # 0. Synthetic corpus (not part of the pipeline)
+    start = time.perf_counter()
+    ground_truth = generate_corpus(xml_path, args.patents, args.paragraphs, args.measurement_ratio, args.seed)
+    print(f'Synthetic corpus of {args.patents} patents ({os.path.getsize(xml_path) / 1e6:.1f} MB) generated in {time.perf_counter() - start:.1f} s')
+
+    # 1. Parse the XML file into the jsonl file of the processed patents (see data_parser.py)
+    # The peak RSS of the workers is read after the pool is closed, when they have finished
+    start = time.perf_counter()
+    parsed_num = parse_and_save(xml_path, args.backend, args.workers)
+    stages = [{
+        'stage': 'parse', 'seconds': time.perf_counter() - start, 'docs': parsed_num, 'chunks': None,
+        'max_rss_mb': max_rss_mb(), 'workers_max_rss_mb': max_rss_mb(children=True) if args.workers > 1 else None,
+    }]
+
+    # 2. Extraction run of first_approach.py: load (sampling), setup, chunks (split, filter, rules, dedup), llm and output
+    run_extraction()
+    run_stages, summary = read_telemetry(config['output_telemetry_jsonl'])
+    with open(config['output_extracted_pantents_json'], 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    chunks = [ep for patent in results['patents'] for ep in patent['elements_processed']]
+    chunks_sent = sum(not ep['skipped'] for ep in chunks)
+    sampled_num = len({patent['doc_id'] for patent in results['patents']})
+    # Docs and chunks processed by each stage of the run, for the throughput
+    stage_counts = {
+        'load': (sampled_num, None), 'chunks': (sampled_num, len(chunks)), 'llm': (None, chunks_sent), 'output': (sampled_num, len(chunks)),
+    }
+    for record in run_stages:
+        docs, chunks_num = stage_counts.get(record['stage'], (None, None))
+        stages.append({
+            'stage': record['stage'], 'seconds': record['seconds'], 'docs': docs, 'chunks': chunks_num,
+            'max_rss_mb': record.get('max_rss_mb'),
+        })
+
+    return {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'label': args.label,
+        'params': benchmark_params(args),
+        'stages': stages,
+        'total_seconds': sum(record['seconds'] for record in stages),
+        'chunks': len(chunks),
+        'chunks_sent': chunks_sent,
+        'llm_calls': summary['llm_calls'],
+        'measurements': sum(len(ep['validated']) for ep in chunks),
+        'recall': recall(results, ground_truth),
+    }
+
+def benchmark_params(args):
+    ''' Parameters that must be equal for two runs to be compared. '''
+    return {
+        'patents': args.patents, 'paragraphs': args.paragraphs, 'measurement_ratio': args.measurement_ratio, 'seed': args.seed,
+        'sample': args.sample, 'sections': args.sections, 'backend': args.backend, 'workers': args.workers,
+        'chunk_method': args.chunk_method, 'prefilter': args.prefilter, 'latency': args.latency, 'jitter': args.jitter,
+        'concurrency': args.concurrency, 'chunks_per_call': args.chunks_per_call, 'completions': args.completions,
+        'requests_per_min': args.requests_per_min, 'tokens_per_min': args.tokens_per_min,
+    }
+
+def print_run(run):
+    ''' Table with the time, throughput and peak RSS (of the process and of the parser workers) of each stage of a run. '''
+    print(f'{"Stage":<10}{"Time (s)":>10}{"Docs/s":>12}{"Chunks/s":>12}{"Peak RSS (MB)":>15}{"Workers RSS (MB)":>18}')
+    for record in run['stages']:
+        docs_rate = f'{record["docs"] / record["seconds"]:.1f}' if record['docs'] and record['seconds'] else '-'
+        chunks_rate = f'{record["chunks"] / record["seconds"]:.1f}' if record['chunks'] and record['seconds'] else '-'
+        memory = f'{record["max_rss_mb"]:.1f}' if record.get('max_rss_mb') is not None else 'n/a'
+        workers_memory = f'{record["workers_max_rss_mb"]:.1f}' if record.get('workers_max_rss_mb') is not None else '-'
+        print(f'{record["stage"]:<10}{record["seconds"]:>10.3f}{docs_rate:>12}{chunks_rate:>12}{memory:>15}{workers_memory:>18}')
+    docs = run['params']['sample'] or run['params']['patents']
+    print(f'{"total":<10}{run["total_seconds"]:>10.3f}{docs / run["total_seconds"]:>12.1f}{run["chunks"] / run["total_seconds"]:>12.1f}')
+    print(f'Chunks: {run["chunks"]}, sent to the LLM: {run["chunks_sent"]} in {run["llm_calls"]} calls, '
+          f'valid measurements: {run["measurements"]}, recall of the known measurements: {run["recall"]:.1%}')
+
+def print_comparison(runs):
+    ''' Table with the time of each stage of several runs (e.g. of different commits) with the same parameters. '''
+    stages = [record['stage'] for record in runs[-1]['stages']]
+    print(f'{"Commit":<16}{"Date":<21}' + ''.join(f'{stage:>10}' for stage in stages) + f'{"total":>10}{"recall":>9}  label')
+    for run in runs:
+        seconds = {record['stage']: record['seconds'] for record in run['stages']}
+        print(f'{run["commit"]:<16}{run["date"]:<21}' + ''.join(f'{seconds.get(stage, float("nan")):>10.3f}' for stage in stages)
+              + f'{run["total_seconds"]:>10.3f}{run["recall"]:>9.1%}  {run["label"] or ""}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the whole pipeline with a synthetic corpus and a stand-in of the model api.')
+    parser.add_argument('--patents', type=int, default=200, help='Number of patents of the synthetic corpus.')
+    parser.add_argument('--paragraphs', type=int, default=8, help='Paragraphs of the summary of each patent (the detailed description has twice as many).')
+    parser.add_argument('--measurement-ratio', type=float, default=0.15, help='Probability of each sentence to state a measurement.')
+    parser.add_argument('--seed', type=int, default=config['data_selection_seed'], help='Seed of the corpus and the sampling.')
+    parser.add_argument('--sample', type=int, default=0, help='Number of patents sampled from the corpus (0 means all of them).')
+    parser.add_argument('--sections', nargs='+', default=config['data_selection_sections'] or [config['data_selection_section']],
+                        choices=['abstract', 'BRFSUM', 'DETDESC'], help='Sections of the patents that are processed.')
+    parser.add_argument('--backend', choices=PARSER_BACKENDS.keys(), default=config['parser_backend'], help='Parser backend of data_parser.py.')
+    parser.add_argument('--workers', type=int, default=config['parser_workers'], help='Processes used to parse the patents.')
+    parser.add_argument('--chunk-method', choices=['characters', 'tokens'], default=config['text_chunk_method'],
+                        help="'characters' (text_chunk_size characters) or 'tokens' (estimated tokens, or client_tokenizer_path if it is set).")
+    parser.add_argument('--prefilter', choices=['measurements', 'digits'], default=config['chunk_prefilter'], help='Filter of the chunks sent to the LLM.')
+    parser.add_argument('--latency', type=float, default=config['replay_latency'], help='Seconds of each call to the stand-in of the model api.')
+    parser.add_argument('--jitter', type=float, default=config['replay_jitter'], help='Maximum random variation (+-seconds) of the latency.')
+    parser.add_argument('--concurrency', type=int, default=config['llm_concurrency'], help='Calls to the model api kept in flight.')
+    parser.add_argument('--chunks-per-call', type=int, default=config['llm_chunks_per_call'], help='Chunks extracted in each call (see chunk_batching.py).')
+    parser.add_argument('--requests-per-min', type=int, default=config['rate_limit_requests_per_min'], help='Requests per minute of the rate limiter.')
+    parser.add_argument('--tokens-per-min', type=int, default=config['rate_limit_tokens_per_min'], help='Tokens per minute of the rate limiter.')
+    parser.add_argument('--completions', default=config['replay_completions_path'], help='jsonl file with recorded completions to replay.')
+    parser.add_argument('--workdir', default=None, help='Directory of the corpus and the outputs. A temporary directory by default.')
+    parser.add_argument('--history', default=os.path.join(SCRIPT_DIR, os.pardir, 'results', 'benchmark_pipeline_history.jsonl'),
+                        help='jsonl file where each run is appended.')
+    parser.add_argument('--label', default=None, help='Label of the run in the history (e.g. a description of the change).')
+    parser.add_argument('--compare', action='store_true', help='Print the runs of the history with the same parameters instead of running the benchmark.')
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = []
+        if os.path.exists(args.history):
+            with open(args.history, 'r', encoding='utf-8') as f:
+                runs = [run for run in map(json.loads, f) if run['params'] == benchmark_params(args)]
+        if not runs:
+            print(f'No runs with these parameters in {args.history}')
+            return
+        print_comparison(runs)
+        return
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        run = run_benchmark(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            run = run_benchmark(args, workdir)
+    print_run(run)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with open(args.history, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run, ensure_ascii=False) + '\n')
+    print(f'Run of commit {run["commit"]} appended to {args.history}')
+
+if __name__ == '__main__':
+    main()
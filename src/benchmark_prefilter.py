@@ -0,0 +1,67 @@
+'''
+Script that benchmarks the measurement prefilter (measurement_prefilter.py) against the results of a previous run
+(by default results/stored_results, GPT-3.5-turbo over the BRFSUM section of 100 patents).
+It reports how many of the chunks that were sent to the LLM (the ones with a digit) would be sent with the prefilter,
+so the number of API calls saved, and how many of the validated measurements would be lost (recall).
+It also reports the size of the chunks trimmed to the sentences with candidates and the recall after trimming.
+'''
+
+import argparse
+import json
+import re
+import time
+from measurement_prefilter import has_measurement_candidate, trim_to_candidate_sentences
+
+NUMBER = re.compile(r'\d+(?:[.,]\d+)*')
+
+def value_in_text(measurement, text):
+    ''' Checks if the numbers of the value of a measurement are in a text (e.g. after trimming it). '''
+    numbers = NUMBER.findall(str(measurement.get('value', '')))
+    return all(number in text for number in numbers)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the measurement prefilter against stored results.')
+    parser.add_argument('--results', default='../results/stored_results/results_extracted_patents.json', help='Results of a previous run (json format).')
+    parser.add_argument('--context-sentences', type=int, default=0, help='Sentences kept before each sentence with candidates when trimming.')
+    parser.add_argument('--show-missed', action='store_true', help='Print the validated measurements lost by the prefilter.')
+    args = parser.parse_args()
+
+    with open(args.results, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    chunks = [ep for patent in results['patents'] for ep in patent['elements_processed']]
+    evaluated = [ep for ep in chunks if not ep['skipped']]
+
+    start = time.perf_counter()
+    kept = [ep for ep in evaluated if has_measurement_candidate(ep['text'])]
+    trimmed = {id(ep): trim_to_candidate_sentences(ep['text'], args.context_sentences) for ep in kept}
+    elapsed = time.perf_counter() - start
+
+    kept_ids = {id(ep) for ep in kept}
+    with_measurements = [ep for ep in evaluated if ep['validated']]
+    measurements = sum(len(ep['validated']) for ep in evaluated)
+    kept_measurements = sum(len(ep['validated']) for ep in kept)
+    trimmed_measurements = sum(
+        sum(value_in_text(measurement, trimmed[id(ep)]) for measurement in ep['validated']) for ep in kept
+    )
+    kept_chars = sum(len(ep['text']) for ep in kept)
+    trimmed_chars = sum(len(text) for text in trimmed.values())
+
+    print(f'Text chunks: {len(chunks)}, sent to the LLM with the digit filter: {len(evaluated)}')
+    print(f'Sent to the LLM with the measurement prefilter: {len(kept)} ({len(evaluated) - len(kept)} API calls saved, '
+          f'{(len(evaluated) - len(kept)) / len(evaluated):.1%})')
+    print(f'Chunks with valid measurements kept: {sum(id(ep) in kept_ids for ep in with_measurements)}/{len(with_measurements)}')
+    print(f'Valid measurements recall: {kept_measurements}/{measurements} ({kept_measurements / measurements:.1%})')
+    print(f'Trimmed to the sentences with candidates: {trimmed_chars}/{kept_chars} characters ({1 - trimmed_chars / kept_chars:.1%} less), '
+          f'valid measurements recall {trimmed_measurements}/{measurements} ({trimmed_measurements / measurements:.1%})')
+    print(f'Prefilter and trimming time: {elapsed * 1000:.1f} ms ({len(evaluated) / elapsed:.0f} chunks/s)')
+
+    if args.show_missed:
+        for ep in evaluated:
+            for measurement in ep['validated']:
+                if id(ep) not in kept_ids:
+                    print('DROPPED', measurement)
+                elif not value_in_text(measurement, trimmed[id(ep)]):
+                    print('TRIMMED', measurement)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Script that benchmarks the prompt prefix cache of the model API (see PrefixCache in mpt_api.py).
+It builds the kor extraction prompts (instructions + few-shot examples + text) of the input examples, registers their
+static prefix in the API and sends each prompt to the streaming endpoint with and without the prefix cache.
+It reports the time to first token (the time spent encoding the prompt) and the total latency of both modes,
+and checks that the generated text is the same.
+To run it on CPU in a few seconds, create a tiny model with tiny_test_model.py, set api_model_path to its folder
+in config.py and launch mpt_api.py before running this script.
+'''
+
+import argparse
+import json
+import statistics
+import time
+import requests
+from kor import from_pydantic
+from kor.extraction import create_extraction_chain
+from config import config
+from prompts import Patent_measurements, patent_examples
+from input_examples import inp_examples
+from llm_custom_wrapper import MPT_LLM
+from load_test_api import percentile
+
+PROMPT_TEXT_MARKER = '<<PATENT_TEXT>>'
+
+def stream_request(url, text, max_new_tokens, use_prefix_cache):
+    ''' Sends a request to the streaming endpoint. Returns the time to first token, the total latency and the response. '''
+    data = {
+        'text': text,
+        'temperature': 0,
+        'top_p': 1,
+        'top_k': 0,
+        'max_new_tokens': max_new_tokens,
+        'use_prefix_cache': use_prefix_cache,
+    }
+    headers = {'Content-type':'application/json', 'Accept':'text/plain'}
+    first_token_time = None
+    response_text = ''
+    start = time.perf_counter()
+    with requests.post(url, data=json.dumps(data), headers=headers, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start
+            response_text += chunk
+    latency = time.perf_counter() - start
+    return first_token_time if first_token_time is not None else latency, latency, response_text
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the prompt prefix cache of the model API.')
+    parser.add_argument('--url', default=config['server_stream_url'], help='URL of the generate_stream endpoint of the API.')
+    parser.add_argument('--register-url', default=config['server_register_prefix_url'], help='URL of the register_prefix endpoint of the API.')
+    parser.add_argument('--rounds', type=int, default=3, help='Number of times that each example is sent in each mode.')
+    parser.add_argument('--max-new-tokens', type=int, default=16, help='Maximum tokens generated by each request.')
+    args = parser.parse_args()
+
+    # Same prompts as first_approach.py
+    model = MPT_LLM(url_model=config['server_url'], url_stream_model=args.url, url_register_prefix=args.register_url)
+    patent_schema, _ = from_pydantic(
+        Patent_measurements,
+        description="Identifies and extracts measurements, including measure elements, attributes, values, and units, from documents.",
+        examples=patent_examples,
+        many=True,
+    )
+    chain = create_extraction_chain(model, patent_schema)
+    prompt_prefix = chain.prompt.format_prompt(text=PROMPT_TEXT_MARKER).to_string().split(PROMPT_TEXT_MARKER)[0]
+    prompts = [chain.prompt.format_prompt(text=text).to_string() for text in inp_examples]
+    print(f'Registered prefix: {model.register_prefix(prompt_prefix)} tokens, {len(prompts)} prompts')
+
+    results = {False: [], True: []}
+    responses = {False: [], True: []}
+    for _ in range(args.rounds):
+        for prompt in prompts:
+            # Both modes are interleaved so they are affected in the same way by the load of the machine
+            for use_prefix_cache in (False, True):
+                first_token_time, latency, response_text = stream_request(args.url, prompt, args.max_new_tokens, use_prefix_cache)
+                results[use_prefix_cache].append((first_token_time, latency))
+                responses[use_prefix_cache].append(response_text)
+
+    for use_prefix_cache, name in ((False, 'Without prefix cache'), (True, 'With prefix cache')):
+        first_token_times = [first_token_time for first_token_time, _ in results[use_prefix_cache]]
+        latencies = [latency for _, latency in results[use_prefix_cache]]
+        print(f'{name}: time to first token p50 {percentile(first_token_times, 50) * 1000:.0f} ms, '
+              f'mean {statistics.mean(first_token_times) * 1000:.0f} ms | '
+              f'latency p50 {percentile(latencies, 50) * 1000:.0f} ms, mean {statistics.mean(latencies) * 1000:.0f} ms')
+    print(f'Same responses: {responses[False] == responses[True]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+Script that benchmarks the inference modes of the model API on CPU (see model_quantization.py).
+It loads the model unquantized (float32) and quantized (int8), generates with greedy decoding the completions of the
+kor extraction prompts of the input examples with both and reports:
+- the load time of the quantized model, the first time (quantization) and from the cache of quantized models,
+- the size of the weights, the time to encode the prompts and the generation speed (tokens/s) of each mode,
+- the agreement of the quantized model with the unquantized one: generated tokens, completions and parsed extractions.
+The prompts go to the model as they are, without the instruction template of the API, which is the same in both modes.
+To run it in a few seconds, create a tiny model with tiny_test_model.py (e.g. --hidden-size 512 --layers 4 --heads 8)
+and pass its folder with --model.
+'''
+
+import argparse
+import io
+import os
+import time
+import torch
+from kor import from_pydantic
+from kor.extraction import create_extraction_chain
+from transformers import AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from config import config
+from prompts import Patent_measurements, patent_examples
+from input_examples import inp_examples
+from llm_custom_wrapper import Replay_LLM
+from model_quantization import load_model, quantized_cache_path
+
+def model_size_mb(model):
+    ''' Size of the saved weights of a model (the packed weights of the quantized layers are in the state dict). '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+class FirstTokenTimer(StoppingCriteria):
+    ''' Stopping criteria that never stops the generation and records when the first token was generated. '''
+
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # It is called after each generated token, so the first call happens right after the encoding of the prompt
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        return False
+
+def generate(model, tokenizer, prompts, max_new_tokens):
+    '''
+    Greedy completions of the prompts, one at a time. Returns the generated token ids of each prompt, the seconds spent
+    encoding the prompts (generating the first token) and the seconds spent generating the rest of the tokens.
+    Both times are measured in the same generate call, with the time of the first token.
+    '''
+    generated = []
+    prompt_seconds, generation_seconds = 0.0, 0.0
+    with torch.no_grad():
+        for prompt in prompts:
+            input_ids = tokenizer(prompt, return_tensors='pt').input_ids
+            timer = FirstTokenTimer()
+            start = time.perf_counter()
+            output_ids = model.generate(
+                input_ids, max_new_tokens=max_new_tokens, do_sample=False, eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id, stopping_criteria=StoppingCriteriaList([timer]),
+            )
+            end = time.perf_counter()
+            # The timer is not called when the generation stops at the first token (max_new_tokens=1)
+            first_token_time = timer.first_token_time or end
+            prompt_seconds += first_token_time - start
+            generation_seconds += end - first_token_time
+            generated.append(output_ids[0, input_ids.shape[1]:].tolist())
+    return generated, prompt_seconds, generation_seconds
+
+def token_agreement(reference, other):
+    ''' Fraction of the generated tokens that are equal in both completions, position by position. '''
+    length = max(len(reference), len(other))
+    if length == 0:
+        return 1.0
+    return sum(a == b for a, b in zip(reference, other)) / length
+
+def parse_extraction(chain, completion):
+    ''' Measurements of a completion parsed with the kor parser, as a set of tuples. '''
+    data = chain.prompt.output_parser.parse(completion)['data']
+    measurements = data.get('patent_measurements', []) if isinstance(data, dict) else []
+    return {tuple(str(measurement.get(field)) for field in ('element', 'property', 'value', 'unit')) for measurement in measurements if isinstance(measurement, dict)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the quantized (int8) CPU inference mode of the model API.')
+    parser.add_argument('--model', default=config['tiny_model_path'], help='Model name or folder. A small local checkpoint, see tiny_test_model.py.')
+    parser.add_argument('--cache-dir', default=config['api_quantized_cache_dir'], help='Folder of the cache of quantized models.')
+    parser.add_argument('--max-new-tokens', type=int, default=32, help='Maximum tokens generated for each prompt.')
+    parser.add_argument('--threads', type=int, default=config['api_torch_threads'], help='Number of CPU threads used by torch.')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # Same prompts as first_approach.py. The LLM of the chain is not called, the chain only builds the prompts and parses the completions
+    patent_schema, _ = from_pydantic(
+        Patent_measurements,
+        description="Identifies and extracts measurements, including measure elements, attributes, values, and units, from documents.",
+        examples=patent_examples,
+        many=True,
+    )
+    chain = create_extraction_chain(Replay_LLM(), patent_schema)
+    prompts = [chain.prompt.format_prompt(text=text).to_string() for text in inp_examples]
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+
+    start = time.perf_counter()
+    reference_model = load_model(args.model, 'float32')
+    print(f'float32 model loaded in {time.perf_counter() - start:.1f} s')
+
+    # The cached quantized model is removed so the first load measures the quantization
+    cache_path = quantized_cache_path(args.cache_dir, args.model, 'int8')
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    start = time.perf_counter()
+    load_model(args.model, 'int8', cache_dir=args.cache_dir)
+    quantization_time = time.perf_counter() - start
+    start = time.perf_counter()
+    quantized_model = load_model(args.model, 'int8', cache_dir=args.cache_dir)
+    cached_load_time = time.perf_counter() - start
+    print(f'int8 model: quantized in {quantization_time:.1f} s, loaded from the cache in {cached_load_time:.1f} s')
+
+    results = {}
+    for mode, model in (('float32', reference_model), ('int8', quantized_model)):
+        # Warm up, so the first call does not count the initialisation of the kernels
+        generate(model, tokenizer, prompts[:1], 2)
+        generated, prompt_seconds, generation_seconds = generate(model, tokenizer, prompts, args.max_new_tokens)
+        # The first token of each prompt is generated with the encoding of the prompt
+        tokens = sum(max(len(token_ids) - 1, 0) for token_ids in generated)
+        results[mode] = generated
+        speed = f'{tokens / generation_seconds:.1f} tokens/s' if tokens and generation_seconds > 0 else 'n/a'
+        print(f'{mode}: weights {model_size_mb(model):.1f} MB, prompt encoding {prompt_seconds / len(prompts):.2f} s per prompt, '
+              f'generation {tokens} tokens in {generation_seconds:.2f} s ({speed})')
+
+    completions = {mode: [tokenizer.decode(token_ids, skip_special_tokens=True) for token_ids in generated] for mode, generated in results.items()}
+    agreements = [token_agreement(reference, other) for reference, other in zip(results['float32'], results['int8'])]
+    same_completions = sum(reference == other for reference, other in zip(completions['float32'], completions['int8']))
+    reference_extractions = [parse_extraction(chain, completion) for completion in completions['float32']]
+    quantized_extractions = [parse_extraction(chain, completion) for completion in completions['int8']]
+    same_extractions = sum(reference == other for reference, other in zip(reference_extractions, quantized_extractions))
+    reference_measurements = sum(len(extraction) for extraction in reference_extractions)
+    shared_measurements = sum(len(reference & other) for reference, other in zip(reference_extractions, quantized_extractions))
+    print(f'Agreement of int8 with float32: tokens {sum(agreements) / len(agreements):.1%}, '
+          f'same completions {same_completions}/{len(prompts)}, same extractions {same_extractions}/{len(prompts)}, '
+          f'measurements found by both {shared_measurements}/{reference_measurements}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Script that compares the rule based extractor (rule_extractor.py) with the LLM results of a previous run
+(by default results/stored_results, GPT-3.5-turbo over the BRFSUM section of 100 patents).
+For the chunks that were sent to the LLM it reports how many the rules would answer without the LLM (confident chunks)
+and, for those chunks, the agreement of the rule measurements with the validated LLM measurements:
+a measurement agrees if it has the same numbers in the value and the same unit. It also reports the agreement
+of the element and the property of the measurements that agree.
+'''
+
+import argparse
+import json
+import re
+import time
+from rule_extractor import extract_measurements_rules
+
+NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+def measurement_key(measurement):
+    ''' Numbers of the value (without thousands separators) and unit of a measurement, used to match measurements. '''
+    value = str(measurement.get('value', '')).replace(',', '')
+    unit = str(measurement.get('unit', '')).strip().lower().replace(' ', '')
+    return tuple(NUMBER.findall(value)), unit
+
+def words_overlap(a, b):
+    ''' Checks if two texts share at least half of their words (e.g. two names of the same element). '''
+    a, b = set(a.lower().split()), set(b.lower().split())
+    return bool(a and b) and len(a & b) / min(len(a), len(b)) >= 0.5
+
+def main():
+    parser = argparse.ArgumentParser(description='Agreement of the rule based extractor with stored LLM results.')
+    parser.add_argument('--results', default='../results/stored_results/results_extracted_patents.json', help='Results of a previous run (json format).')
+    parser.add_argument('--min-confidence', type=float, default=1, help='Minimum confidence of a chunk to be answered by the rules.')
+    parser.add_argument('--show', action='store_true', help='Print the rule and LLM measurements of the confident chunks side by side.')
+    args = parser.parse_args()
+
+    with open(args.results, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    evaluated = [ep for patent in results['patents'] for ep in patent['elements_processed'] if not ep['skipped']]
+
+    start = time.perf_counter()
+    rule_results = [extract_measurements_rules(ep['text']) for ep in evaluated]
+    elapsed = time.perf_counter() - start
+
+    confident = [(ep, measurements) for ep, (measurements, confidence) in zip(evaluated, rule_results) if confidence >= args.min_confidence]
+    rule_total = llm_total = matched = element_agreement = property_agreement = 0
+    for ep, measurements in confident:
+        llm_measurements = list(ep['validated'])
+        rule_total += len(measurements)
+        llm_total += len(llm_measurements)
+        for measurement in measurements:
+            for llm_measurement in llm_measurements:
+                if measurement_key(measurement) == measurement_key(llm_measurement):
+                    matched += 1
+                    element_agreement += words_overlap(measurement['element'], llm_measurement['element'])
+                    property_agreement += words_overlap(measurement['property'], llm_measurement['property'])
+                    llm_measurements.remove(llm_measurement)
+                    break
+        if args.show:
+            print('-' * 20)
+            print(ep['text'][:300])
+            print('RULES:', measurements)
+            print('LLM:  ', ep['validated'])
+
+    print(f'Chunks sent to the LLM: {len(evaluated)}')
+    print(f'Chunks answered by the rules (confidence >= {args.min_confidence}): {len(confident)} ({len(confident) / len(evaluated):.1%} of the LLM calls saved)')
+    print(f'Measurements in the answered chunks: {rule_total} by the rules, {llm_total} valid by the LLM, {matched} in agreement (value and unit)')
+    if rule_total and llm_total:
+        print(f'Agreement: {matched / rule_total:.1%} of the rule measurements, {matched / llm_total:.1%} of the LLM measurements')
+    if matched:
+        print(f'Of the measurements in agreement: same element {element_agreement / matched:.1%}, same property {property_agreement / matched:.1%}')
+    print(f'Rules time: {elapsed * 1000:.1f} ms ({len(evaluated) / elapsed:.0f} chunks/s)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Script that measures the startup and restart time of the model API (mpt_api.py).
+It launches the API several times in a subprocess and, for each start, reports the time until the server answers
+/health (accepting connections while the model loads in the background) and until /ready answers 200 (model loaded
+and warmed up), along with the time of each step reported by the server.
+The first start may include the conversion of the checkpoint to safetensors and the quantization of the model, the
+following ones (restarts) load them from their caches (see model_quantization.py).
+To run it on CPU in a few seconds, set api_model_path to the folder of a tiny model (see tiny_test_model.py) in config.py.
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import requests
+
+def wait_for(url, expected_status, process, timeout):
+    ''' Polls url until it answers with expected_status. Returns the elapsed time and the last JSON answer. '''
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f'The API exited with code {process.returncode} while starting')
+        try:
+            response = requests.get(url, timeout=1)
+            if response.status_code == expected_status or expected_status is None:
+                return response.json()
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f'{url} did not answer {expected_status} after {timeout} s')
+
+def measure_start(server_url, timeout):
+    ''' Starts the API and returns the seconds until it is up and until it is ready, and the timings reported by the server. '''
+    api_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpt_api.py')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, api_path], cwd=os.path.dirname(api_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(f'{server_url}/health', None, process, timeout)
+        up_seconds = time.perf_counter() - start
+        health = wait_for(f'{server_url}/ready', 200, process, timeout)
+        ready_seconds = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    return up_seconds, ready_seconds, health['timings']
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the startup and restart time of the model API.')
+    parser.add_argument('--server-url', default='http://127.0.0.1:5000', help='Base URL where the API started by this script listens.')
+    parser.add_argument('--starts', type=int, default=3, help='Number of times the API is started.')
+    parser.add_argument('--timeout', type=float, default=1800, help='Maximum seconds to wait for each start.')
+    args = parser.parse_args()
+
+    ready_times = []
+    for start_number in range(args.starts):
+        up_seconds, ready_seconds, timings = measure_start(args.server_url, args.timeout)
+        ready_times.append(ready_seconds)
+        print(f'Start {start_number + 1}: up in {up_seconds:.1f} s, ready in {ready_seconds:.1f} s '
+              f'(model load {timings["load_seconds"]:.1f} s, warm-up {timings["warmup_seconds"]:.1f} s)')
+    if len(ready_times) > 1:
+        print(f'First start ready in {ready_times[0]:.1f} s, restarts ready in {statistics.mean(ready_times[1:]):.1f} s on average')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Script that packs several text chunks (possibly from different patents) into a single LLM call.
+Each call pays the whole kor prompt (instructions + few-shot examples), which for short sections like the abstract
+is several times bigger than the text itself. In batched mode the chunks are sent as a numbered list ([1] text, [2] text...)
+and the model tags each measurement with the number of its chunk (Patent_chunk_measurements schema),
+so the output can be demultiplexed back into the chunks.
+'''
+
+import re
+
+# Tag of a chunk in the input of a batched call
+CHUNK_TAG = '[{}] '
+
+def format_chunk_batch(texts):
+    ''' Input text of a batched call: the chunks numbered from 1, one per line. '''
+    return '\n'.join(CHUNK_TAG.format(number) + text for number, text in enumerate(texts, start=1))
+
+def batch_examples(examples, chunks_per_example):
+    '''
+    Groups consecutive few-shot examples (text, measurements) into batched examples, so the model sees the format of a
+    batched call: the texts are numbered and each measurement is tagged with the number of its text.
+    '''
+    batched = []
+    for start in range(0, len(examples), chunks_per_example):
+        group = examples[start:start + chunks_per_example]
+        texts = [text for text, _ in group]
+        measurements = [
+            {**measurement, 'chunk': number}
+            for number, (_, chunk_measurements) in enumerate(group, start=1)
+            for measurement in chunk_measurements
+        ]
+        batched.append((format_chunk_batch(texts), measurements))
+    return batched
+
+def pack_chunk_batches(jobs, count_tokens, token_budget, max_chunks):
+    '''
+    Greedily groups consecutive jobs (doc_id, data_section, chunk_idx, element_processed) into batches of at most max_chunks chunks
+    whose numbered texts fit in token_budget tokens. A chunk that does not fit with others goes alone.
+    Returns the batches and the tokens of the numbered texts of each batch.
+    '''
+    batches, batches_tokens = [], []
+    current, current_tokens = [], 0
+    for job in jobs:
+        text = job[-1]['text']
+        # +1 for the line break between chunks
+        tokens = count_tokens(CHUNK_TAG.format(len(current) + 1) + text) + 1
+        if current and (len(current) >= max_chunks or current_tokens + tokens > token_budget):
+            batches.append(current)
+            batches_tokens.append(current_tokens)
+            current, current_tokens = [], 0
+            tokens = count_tokens(CHUNK_TAG.format(1) + text) + 1
+        current.append(job)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+        batches_tokens.append(current_tokens)
+    return batches, batches_tokens
+
+def demultiplex(measurements, chunks_num):
+    '''
+    Splits the measurements of a batched call by their chunk number. The chunk tag is removed, so each chunk gets
+    its measurements in the same format as a single chunk call. Measurements with a missing or wrong chunk number are discarded.
+    '''
+    chunks_measurements = [[] for _ in range(chunks_num)]
+    discarded = 0
+    for measurement in measurements:
+        match = re.search(r'\d+', str(measurement.get('chunk', '')))
+        number = int(match.group()) if match else 0
+        if 1 <= number <= chunks_num:
+            chunks_measurements[number - 1].append({key: value for key, value in measurement.items() if key != 'chunk'})
+        else:
+            discarded += 1
+    if discarded:
+        print(f'{discarded} measurements of a batched call discarded: wrong chunk number')
+    return chunks_measurements
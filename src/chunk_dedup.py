@@ -0,0 +1,119 @@
+'''
+Script that detects repeated text chunks before they are sent to the LLM.
+Patent families and continuations reuse paragraphs word for word (or with small changes of punctuation, references
+and spacing), so the same chunk appears several times in a run. Each chunk is normalised and turned into a MinHash
+signature of its word shingles, and the signatures are indexed with LSH (locality sensitive hashing) in bands,
+so a chunk is only compared with the chunks that share a band instead of with every processed chunk.
+A chunk is a duplicate of a previous one if their estimated similarity (Jaccard of the shingles) reaches the threshold
+and they contain exactly the same measurement candidates. The extraction of the previous chunk is reused verbatim if both
+have the same normalised text. A near duplicate can differ in the measured element (coating layer / adhesive layer),
+so it only reuses the extraction if it names every element and property of it (see reusable_extraction()).
+'''
+
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+from measurement_prefilter import find_measurement_candidates, mask_references
+
+# Prime bigger than the 32 bit hashes of the shingles. The permutations are (a * hash + b) mod MERSENNE_PRIME
+MERSENNE_PRIME = (1 << 61) - 1
+WORD = re.compile(r'\w+(?:[.,]\w+)*')
+
+def normalize_text(text):
+    ''' Words of a text in lowercase, without the references (FIG. 3, claim 1...) and punctuation. '''
+    return WORD.findall(mask_references(text).lower())
+
+class ChunkDeduplicator:
+    '''
+    Index of the processed chunks. add() returns the key of the chunk it duplicates, or None if it is new (then it is indexed).
+    The signatures have num_perm hashes split in bands of num_perm // bands rows: two chunks are compared
+    if all the rows of one of their bands are equal, which happens with probability 1 - (1 - s^rows)^bands for a similarity s.
+    '''
+    def __init__(self, threshold=0.9, num_perm=128, bands=16, shingle_size=5, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        generator = np.random.default_rng(seed)
+        self.a = generator.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        # Exact duplicates (same normalised text) are found with a dict, without the signature
+        self.exact = {}
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+        self.signatures = {}
+        self.candidates = {}
+        self.duplicates = 0
+
+    def shingles(self, words):
+        ''' 32 bit hashes of the shingles (shingle_size consecutive words) of a normalised text. '''
+        size = min(self.shingle_size, len(words))
+        shingles = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+    def signature(self, words):
+        ''' MinHash signature of a normalised text: the minimum of each permutation over its shingles. '''
+        hashes = self.shingles(words)
+        # The products are computed modulo 2^64 and then reduced. It is not an exact modular product, but it is
+        # deterministic and spreads the hashes evenly, which is all the MinHash needs
+        permuted = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def similarity(self, signature, other):
+        ''' Estimated Jaccard similarity of two chunks: fraction of equal hashes of their signatures. '''
+        return float(np.mean(signature == other))
+
+    def add(self, key, text):
+        '''
+        Returns the key of a previous chunk that is a duplicate of text, or None after indexing text with the given key.
+        Chunks without words are never duplicates.
+        '''
+        words = normalize_text(text)
+        if not words:
+            return None
+        candidates = sorted(find_measurement_candidates(text))
+        exact_key = (' '.join(words), tuple(candidates))
+        if exact_key in self.exact:
+            self.duplicates += 1
+            return self.exact[exact_key]
+
+        signature = self.signature(words)
+        bands = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        compared = set()
+        for band, bucket in zip(bands, self.buckets):
+            for other_key in bucket.get(band, []):
+                if other_key in compared:
+                    continue
+                compared.add(other_key)
+                if self.candidates[other_key] == candidates and self.similarity(signature, self.signatures[other_key]) >= self.threshold:
+                    self.duplicates += 1
+                    return other_key
+
+        self.exact[exact_key] = key
+        self.signatures[key] = signature
+        self.candidates[key] = candidates
+        for band, bucket in zip(bands, self.buckets):
+            bucket[band].append(key)
+        return None
+
+def reusable_extraction(text, extraction, duplicate_text):
+    '''
+    Checks if the extraction of a chunk (text) can be reused for a duplicate of it (duplicate_text): always if both have
+    the same normalised text, otherwise only if every element and property of the measurements appears in the duplicate.
+    '''
+    duplicate_words = normalize_text(duplicate_text)
+    if normalize_text(text) == duplicate_words:
+        return True
+    if not isinstance(extraction, list):
+        return False
+    duplicate_normalized = f" {' '.join(duplicate_words)} "
+    for measurement in extraction:
+        if not isinstance(measurement, dict):
+            return False
+        for field in ('element', 'property'):
+            words = normalize_text(str(measurement.get(field) or ''))
+            if words and f" {' '.join(words)} " not in duplicate_normalized:
+                return False
+    return True
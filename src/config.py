@@ -8,7 +8,13 @@ config = {
     'save_indiv_patents': False,    # Store the concatenated patents individually in the output_processed_path
     'output_processed_path': 'data/processed_data/',    # Destination folder of the processed patents (individual or json)
     'output_processed_pantents_json': 'data/processed_data/extracted_patents_ipg221227.json',   # 'data/processed_data/extracted_patents_ipg230103.json' # 'data/processed_data/extracted_patents_ipg221227.json'
+    'output_processed_format': 'jsonl', # Format of the processed patents. 'jsonl' (one patent per line, written incrementally, with a byte offsets index) or 'json' (single json file)
+    'output_processed_pantents_jsonl': 'data/processed_data/extracted_patents_ipg221227.jsonl', # Destination of the processed patents in jsonl format. Add .gz or .zst to the name to compress it with gzip or zstd
     'xml_separator': '<?xml version="1.0" encoding="UTF-8"?>',  #   String that states the start of an XML file. Useful for splitting the concatenated patents from raw_data_patents_path
+    'xml_read_buffer_size': 1024 * 1024,  # Size (in characters) of the buffers used to read raw_data_patents_path. Only one patent is kept in memory at a time
+    'parser_workers': 1,    # Number of processes used to parse the patents (--workers). 1 means sequential parsing
+    'parser_chunk_size': 16,    # Number of patents sent to each worker at once when parsing in parallel
+    'parser_backend': 'bs4',    # Library used to parse each patent. Possible values are: 'bs4' (BeautifulSoup) or 'lxml' (lxml iterparse, faster)
 
     # model api mpt_api.py
     # --------------------
@@ -20,20 +26,50 @@ config = {
     'api_use_cache': True,  # Default value hyperparameter for using cache. Useful to save resources in local isntallation
     'api_do_sample': True,  # Default value hyperparameter for sampling
     'api_repetition_penalty': 1.1,  # # Default value hyperparameter for repetition penalty. 1 means no penalty, > 1.0 means penalty
+    'api_max_batch_size': 8,    # Maximum number of requests generated together in a single batch
+    'api_batch_wait_ms': 10,    # Maximum time (milliseconds) to wait for more requests before generating a batch
+    'api_prefix_cache': True,   # Cache the state (past_key_values) of the registered static prompt prefixes so they are not encoded in every request
+    'api_max_cached_prefixes': 4,   # Maximum number of cached prompt prefixes
+    'api_inference_mode': 'bfloat16',   # Type of the model weights. Possible values are: 'bfloat16', 'float32' or 'int8' (dynamic quantization of the linear layers, for CPU inference)
+    'api_quantized_cache_dir': 'data/quantized_models', # Folder where the quantized models are saved, so later starts skip the quantization. None to quantize in every start
+    'api_safetensors_dir': 'data/safetensors_models',  # Folder where the checkpoints without safetensors weights are converted once, so later starts memory-map the weights instead of unpickling them. None to load the checkpoint as it is
+    'api_warmup_tokens': 8, # Tokens generated by the warm-up generation run before the API reports it is ready. 0 to skip the warm-up
+    'api_torch_threads': None,  # Number of CPU threads used by torch. None to use the torch default (the physical cores)
+    'tiny_model_path': 'data/tiny_test_model',  # Folder of the tiny random model used to test and benchmark the API on CPU (see tiny_test_model.py)
 
     # model wrapper llm_custom_wrapper.py
     # -----------------------------------
     'server_address': '192.168.1.66',   # Address where the model is deployed
     'server_url': 'http://192.168.1.66:5000/generate', #    URL to query deployed model. http://{SERVER}:5000/generate
+    'server_stream_url': 'http://192.168.1.66:5000/generate_stream', # URL to query deployed model streaming the response. http://{SERVER}:5000/generate_stream
+    'client_streaming': False,  # Receive the response of the model token by token and stop it as soon as the kor output is complete
+    'server_register_prefix_url': 'http://192.168.1.66:5000/register_prefix',   # URL to register the static prefix of the prompts in the deployed model. http://{SERVER}:5000/register_prefix
+    'server_health_url': 'http://192.168.1.66:5000/health', # URL of the liveness probe of the deployed model, with the status of the model load. http://{SERVER}:5000/health
+    'server_ready_url': 'http://192.168.1.66:5000/ready',   # URL of the readiness probe of the deployed model. http://{SERVER}:5000/ready
+    'client_replay_llm': False, # Use a stand-in of the model api that replays recorded completions or builds them with the rules, to test and benchmark the pipeline offline (see Replay_LLM in llm_custom_wrapper.py)
+    'replay_completions_path': None,    # jsonl file with recorded completions ({"prompt": ..., "completion": ...} per line) replayed by the stand-in. The other prompts get a completion built with the rules
+    'replay_latency': 0.5,      # Seconds that each call to the stand-in takes
+    'replay_jitter': 0.1,       # Maximum random variation (+-seconds) of the latency of the stand-in
+    'client_register_prompt_prefix': True,  # Register the kor instructions and examples in the deployed model, so its state is cached
     'client_temperature':0,   # Client side hyperparameter temperature.
     'client_top_p':1,   # Client side hyperparameter top p.
     'client_top_k':0,   # Client side hyperparameter top k.
     'client_max_new_tokens':256,    # Client side hyperparameter for max new tokens.
+    'client_pool_size': 8,  # Number of keep-alive connections to the model API kept by each wrapper instance
+    'client_connect_timeout': 5,    # Seconds to wait when connecting to the model API
+    'client_read_timeout': 300, # Seconds to wait for the response of the model API. A hung request fails instead of stalling the run
+    'client_max_retries': 3,    # Number of retries of a failed request (connection errors, timeouts, 429 and 5xx responses)
+    'client_backoff_factor': 0.5,   # Exponential backoff between retries: backoff_factor * 2^retry seconds
+    'client_wait_for_ready': True,  # Wait until the model API is ready (loaded and warmed up) before the first request, instead of failing while it starts
+    'client_ready_timeout': 1800,   # Maximum seconds to wait for the model API to be ready
+    'client_ready_poll_interval': 2,    # Seconds between the checks of the readiness of the model API
 
     # first_approach
     # ------------------------
     'sample_patents_num': 100,  # If sample = 0 -> no sampling
     'data_selection_seed': 7,   # Useful for reproducibility
+    'data_selection_sampling': 'index', # Sampling method for jsonl files. 'index' (same sample as the json format, reads only the sampled patents) or 'reservoir' (single streaming pass, does not need the index)
+    'data_selection_required_section': None,    # Only sample patents with this section non-empty, e.g. 'BRFSUM'. None means no filter. Filtering always uses reservoir sampling
     'use_open_ai': True,    # Use openai models or MPT
     'gpt_temperature':0,    # Temperature param for GPT3.5-turbo model. IMPORTANT to be 0 so it can not invent things.
     'gpt_max_tokens':2000,  # Max tokens for GPT3.5-turbo model
@@ -41,10 +77,46 @@ config = {
     'gpt_presence_penalty':0,   # Presence penalty for GPT3.5-turbo model
     'execute_single_example': True, # Test the model with one of the examples from example.py. If false, the model will run with the whole sample of patents.
     'data_selection_section': 'BRFSUM', # Part of the data to process. Possible values are: 'abstract', 'BRFSUM', 'DETDESC'
-    'text_chunk_size': 1300,    # Text chunk size (text_chunk + prompt_template + examples ~= MAX TOKENS from model).
+    'data_selection_sections': None,    # List of parts of the data processed in a single pass, e.g. ['abstract', 'BRFSUM', 'DETDESC']. They share the sampled patents, the chain, the cache and the rate limiter. None means only data_selection_section
+    'text_chunk_method': 'tokens',  # How the text chunks are measured. 'tokens': sentences packed into the tokens left by the prompt and the completion in the context window (see token_chunker.py). 'characters': text_chunk_size characters
+    'text_chunk_size': 1300,    # Text chunk size in characters when text_chunk_method is 'characters' (text_chunk + prompt_template + examples ~= MAX TOKENS from model).
+    'gpt_context_tokens': 4096, # Context window (prompt + completion) of GPT3.5-turbo model
+    'mpt_context_tokens': 2048, # Context window (prompt + completion) of the MPT model
+    'text_chunk_token_margin': 64,  # Tokens of the context window kept free for what is added to the kor prompt (chat message format, instruction format of the MPT api)
+    'client_tokenizer_path': None,  # Tokenizer used to count the tokens of the local model (huggingface name or folder). None uses the one of api_model_path, or a rough estimation with the stand-in of the model api (client_replay_llm), which runs offline
     'output_extracted_pantents_json': 'results/results_extracted_patents.json', # Output file with the extracted patents in json format
     'output_extracted_pantents_valid_json': 'results/results_extracted_patents_valid.json', # Output file with the extracted patents that are valid in json format
-    'cooldown_time': 0.5,    # Seconds to wait after a successfult query. Check the model rate limit
+    'output_normalized_measurements_csv': 'results/results_normalized_measurements.csv',    # Output file with all the measurements validated and normalised (canonical units, numeric min/max values) in csv format
+    'output_telemetry_jsonl': 'results/telemetry.jsonl',    # Output file with the metrics of each chunk and patent (timings, tokens, retries, cache hits, cost), of each stage and the summary of the run in jsonl format
+    'telemetry_profiler': None,     # Profiler of each stage of the run. None, 'cprofile' (a .prof file per stage in telemetry_profile_dir) or 'tracemalloc' (peak memory and top allocations of each stage in the telemetry)
+    'telemetry_profile_dir': 'results/profiles',    # Destination folder of the cProfile files of the stages
+    'save_measurements_parquet': True,  # Save the extracted measurements in a flat table in Parquet format as the chunks are processed (see measurement_store.py)
+    'output_measurements_parquet_dir': 'results/measurements',  # Directory of the Parquet measurements table, partitioned by data section (data_section=BRFSUM/run-<run_id>.parquet, the run id is its start time)
+    'parquet_row_group_size': 10000,    # Measurements per row group of the Parquet files
+    'extraction_journal_path': 'results/extraction_journal.jsonl',   # Append-only journal with the processed chunks. Used to resume interrupted runs (--resume)
+    'chunk_prefilter': 'measurements',  # Chunks sent to the LLM. 'measurements': chunks with a number followed by a unit (see measurement_prefilter.py). 'digits': chunks with any number
+    'prefilter_trim_sentences': False,  # Send to the LLM only the sentences of each chunk with measurement candidates. Shorter prompts, slightly lower recall (see benchmark_prefilter.py)
+    'prefilter_context_sentences': 1,   # Sentences kept before each sentence with candidates when trimming
+    'use_rule_extractor': False,    # Extract the measurements of the easy chunks with rules ("<element> having a <property> of <value> <unit>") and only send the rest to the LLM (see rule_extractor.py)
+    'rule_extractor_min_confidence': 1, # Minimum confidence of the rules to not send a chunk to the LLM. 1: every measurement candidate explained with a known property. 0.5: with any property
+    'chunk_dedup': True,            # Reuse the extraction of a chunk for its repetitions (same paragraphs in patents of a family or continuations) instead of sending them to the LLM (see chunk_dedup.py)
+    'dedup_threshold': 0.85,        # Minimum estimated similarity (Jaccard of the word shingles) of two chunks to be duplicates. They must also have the same measurement candidates, and a near duplicate only reuses the extraction if it names its elements and properties
+    'dedup_num_perm': 128,          # Hashes of the MinHash signature of each chunk
+    'dedup_bands': 16,              # LSH bands of the signatures. Chunks are compared if a band is equal (16 bands of 8 rows: likely from a similarity of ~0.7)
+    'dedup_shingle_size': 5,        # Consecutive words of each shingle
+    'llm_chunks_per_call': 1,   # Maximum text chunks (possibly from different patents) extracted in a single LLM call, so they share the prompt. 1 means one call per chunk (see chunk_batching.py)
+    'llm_batch_examples_chunks': 2, # Number of few-shot examples grouped in each numbered example of the batched prompt
+    'llm_concurrency': 4,   # Number of queries to the LLM kept in flight at the same time
+    'rate_limit_requests_per_min': 3500,    # Maximum requests per minute allowed by the model API. Check the model rate limit
+    'rate_limit_tokens_per_min': 90000, # Maximum tokens (prompt + completion) per minute allowed by the model API. Check the model rate limit
+    'use_llm_cache': True,  # Store the LLM completions in a persistent cache so the same prompts are not queried again
+    'llm_cache_path': 'data/llm_cache.sqlite',  # SQLite database with the cached LLM completions
+    'llm_cache_max_size_mb': 512,   # Maximum size of the LLM cache. The least recently used completions are evicted
+    'llm_prices_per_1k_tokens': {   # Prices (dollars per 1k prompt and completion tokens) used to estimate the cost of the runs with OpenAI models. The local models have no cost
+        'gpt-3.5-turbo': {'prompt': 0.0015, 'completion': 0.002},
+        'gpt-3.5-turbo-16k': {'prompt': 0.003, 'completion': 0.004},
+        'gpt-4': {'prompt': 0.03, 'completion': 0.06},
+    },
 
     # generate train data
     # ------------------------
@@ -3,45 +3,62 @@ Script that reads a XML file with patents in it and parse them. Extracts the abs
 '''
 
 from bs4 import BeautifulSoup, Comment, element
+from lxml import etree
+import argparse
+import io
+import itertools
 import json
+import multiprocessing
 import re
 from config import config
+from patent_store import PatentWriter
 # GLOBALS
 #raw_data_path = 'data/raw_data/ipg230103.xml'
 raw_data_path = config['raw_data_patents_path']
 output_path = config['output_processed_path']
 xml_separator = config['xml_separator']
+buffer_size = config['xml_read_buffer_size']
 
-# 1. OPEN FILE
-with open(raw_data_path, 'r') as file:
-        xml_text = file.read()
+def iter_xml_patents(path, separator, buffer_size):
+    '''
+    Generator that reads the concatenated XML file in fixed-size buffers and yields one patent at a time.
+    Each yielded patent starts with the separator, as if it had been stored in its own file.
+    Only the patent that is being assembled is kept in memory, so the peak memory depends on the
+    largest patent and not on the size of the weekly file. Text before the first separator is ignored.
+    '''
+    document = ''
+    # Position from which to look for the next separator. Skips the separator that opens the current document
+    search_from = 1
+    with open(path, 'r', encoding='utf-8') as file:
+        while True:
+            buffer = file.read(buffer_size)
+            if not buffer:
+                break
+            document += buffer
+            # A single buffer may contain several patents
+            while True:
+                position = document.find(separator, search_from)
+                if position == -1:
+                    # The separator may be cut between two buffers, look again from the end of this one
+                    search_from = max(1, len(document) - len(separator) + 1)
+                    break
+                if document.startswith(separator):
+                    yield document[:position]
+                document = document[position:]
+                search_from = 1
+    # Last patent of the file
+    if document.startswith(separator):
+        yield document
 
-# 2. SPLIT SINGLE XML INTO MULTIPLE PATENTS
-xml_pantents = xml_text.split(xml_separator)
-xml_pantents = [xml_separator + xp for xp in xml_pantents]
-print(len(xml_pantents))
-xml_pantents = xml_pantents[1:]
-
-# 3. Prepare resulting object
-patents = {
-    'patents': []
-}
-
-# 4. Save the patents individually if the user wants to. Multiple xml files in the output processed foled
-if config['save_indiv_patents']:
-    for i, patent in enumerate(xml_pantents):
-        # save patent
-        file_name = f'patent_{i}.xml'
-        file_path = config['output_processed_path'] + file_name
-        with open(file_path, 'w') as dest_file:
-            dest_file.write(patent)
-
-# 5. For each patent
-for patent in xml_pantents:
-    # 5.1 Parse patent
+def parse_patent_bs4(patent):
+    '''
+    Parses a single XML patent and extracts its doc_id, abstract, summary (BRFSUM) and detailed description (DETDESC).
+    This function is executed by the worker processes when parsing in parallel, so it only depends on its input.
+    '''
+    # 1. Parse patent
     bs = BeautifulSoup(patent, features="xml") 
     #publication_title = bs.find('invention-title').text
-    # 5.2 Extract specific information (abstract, doc_id, description)
+    # 2. Extract specific information (abstract, doc_id, description)
     abstract = bs.find('abstract')
     if abstract:
         abstract = abstract.text
@@ -56,7 +73,7 @@ for patent in xml_pantents:
         doc_id = doc_id.text
     description = bs.find('description')
 
-    # 5.3 Prepare single patent resulting object
+    # 3. Prepare single patent resulting object
     pantent_data = {
         'doc_id': doc_id,
         #'publication_title': publication_title,
@@ -69,7 +86,7 @@ for patent in xml_pantents:
         #'brief-description-of-drawings': []
     }
     # descriptions_types = ['BRFSUM','DETDESC','RELAPP','GOVINT']
-    # 5.4 If there is a description extract each <p> component.
+    # 4. If there is a description extract each <p> component.
     # Exclude <headings> and <math> objects
     if description:
         flag = False
@@ -83,8 +100,7 @@ for patent in xml_pantents:
             if flag:
                 if desc_type in pantent_data:
                     if isinstance(d, element.Tag):
-                        children = list(d.children)
-                        if d.name == 'p' and '<maths' not in children:
+                        if d.name == 'p' and d.find('maths') is None:
                             text_element = d.text
                             # replace extra \n with spaces
                             text_element = text_element.replace('\n',' ')
@@ -94,17 +110,190 @@ for patent in xml_pantents:
                             text_element = text_element.strip()
                             pantent_data[desc_type].append(text_element)
 
-    # 6. Remove <p> paragraphs containing just '' or '\n'
+    # 5. Remove <p> paragraphs containing just '' or '\n'
+    pantent_data['BRFSUM'] = [pd for pd in pantent_data['BRFSUM'] if pd not in ['','\n']]
+    pantent_data['DETDESC'] = [pd for pd in pantent_data['DETDESC'] if pd not in ['','\n']]
+
+    return pantent_data
+
+def parse_patent_lxml(patent):
+    '''
+    Alternative to parse_patent_bs4() built on lxml iterparse. It extracts the same information, with the same
+    processing instructions state machine and text normalisation, in a single streaming pass over the patent.
+    The elements are cleared as soon as they have been processed, so the whole tree is never built.
+    '''
+    pantent_data = {
+        'doc_id': None,
+        'abstract': [],
+        'BRFSUM': [],
+        'DETDESC': [],
+    }
+    # Tags of the elements that are currently open
+    open_tags = []
+    # Depth of the first <description> (0 if it has not been found yet, -1 once it has been processed)
+    description_depth = 0
+    flag = False
+    desc_type = None
+    abstract_found = False
+
+    events = etree.iterparse(io.BytesIO(patent.encode('utf-8')), events=('start', 'end', 'pi'), recover=True, huge_tree=True)
+    for event, node in events:
+        if event == 'start':
+            open_tags.append(node.tag)
+            if node.tag == 'description' and description_depth == 0:
+                description_depth = len(open_tags)
+            continue
+
+        if event == 'pi':
+            # 1. Processing instructions that are direct children of the description mark the start and end of each section
+            if description_depth > 0 and len(open_tags) == description_depth:
+                desc_type = node.target
+                instruction = f'{node.target} {node.text or ""}'
+                if 'end="lead"' in instruction:
+                    flag = True
+                elif 'end="tail"' in instruction:
+                    flag = False
+            continue
+
+        # event == 'end'
+        depth = len(open_tags)
+        open_tags.pop()
+
+        # 2. Extract specific information (abstract, doc_id, description)
+        if node.tag == 'abstract' and not abstract_found:
+            abstract_found = True
+            abstract = ''.join(node.itertext())
+            abstract = abstract.replace('\n',' ')
+            abstract = re.sub(r'\s+', ' ',abstract)
+            pantent_data['abstract'] = [abstract]
+        elif node.tag == 'document-id' and pantent_data['doc_id'] is None:
+            pantent_data['doc_id'] = ''.join(node.itertext())
+        elif node.tag == 'description' and depth == description_depth:
+            description_depth = -1
+
+        # 3. Extract each <p> component of the sections of the description
+        if description_depth > 0 and depth == description_depth + 1:
+            # Exclude the paragraphs with <maths> objects, like parse_patent_bs4()
+            if flag and desc_type in pantent_data and node.tag == 'p' and node.find('.//maths') is None:
+                text_element = ''.join(node.itertext())
+                # replace extra \n with spaces
+                text_element = text_element.replace('\n',' ')
+                # transform multiple spaces into a single one
+                text_element = re.sub(r'\s+', ' ',text_element)
+                # remove trailing extra spaces
+                text_element = text_element.strip()
+                pantent_data[desc_type].append(text_element)
+            # The children of the description are not needed anymore
+            _clear_element(node)
+        elif depth <= 2:
+            # Sections of the patent (bibliographic data, abstract, claims...) that have already been processed
+            _clear_element(node)
+
+    # 4. Remove <p> paragraphs containing just '' or '\n'
     pantent_data['BRFSUM'] = [pd for pd in pantent_data['BRFSUM'] if pd not in ['','\n']]
     pantent_data['DETDESC'] = [pd for pd in pantent_data['DETDESC'] if pd not in ['','\n']]
+    return pantent_data
+
+def _clear_element(node):
+    ''' Frees the memory of an already processed element and of its previous siblings. '''
+    node.clear()
+    parent = node.getparent()
+    if parent is not None:
+        while node.getprevious() is not None:
+            del parent[0]
+
+# Available parser backends. Both of them produce the same results
+PARSER_BACKENDS = {
+    'bs4': parse_patent_bs4,
+    'lxml': parse_patent_lxml,
+}
+
+def parse_patents(xml_pantents, parse_patent, workers, chunk_size):
+    '''
+    Generator that parses the patents and yields the results in the same order as the input patents.
+    With more than one worker the patents are parsed by a pool of processes. The patents are sent to the pool
+    in windows of workers*chunk_size patents so that the lazily read file is not loaded into memory by the pool.
+    '''
+    if workers <= 1:
+        for patent in xml_pantents:
+            yield parse_patent(patent)
+        return
+
+    window_size = workers * chunk_size
+    with multiprocessing.Pool(processes=workers) as pool:
+        while True:
+            window = list(itertools.islice(xml_pantents, window_size))
+            if not window:
+                break
+            # pool.map keeps the order of the input patents
+            yield from pool.map(parse_patent, window, chunksize=chunk_size)
+
+def save_indiv_patents(xml_pantents, output_path):
+    '''
+    Generator that stores each patent in its own XML file in the output processed folder and yields it unchanged.
+    '''
+    for i, patent in enumerate(xml_pantents):
+        file_name = f'patent_{i}.xml'
+        file_path = output_path + file_name
+        with open(file_path, 'w') as dest_file:
+            dest_file.write(patent)
+        yield patent
+
+def parse_patent_file(path, backend='bs4', workers=1, chunk_size=16, save_indiv_path=None):
+    '''
+    Generator that reads a weekly XML file of patents and yields the parsed patents with some information
+    (abstract, summary or detailed description), in the order of the file. See parse_patents() for the workers.
+    If save_indiv_path is given each patent is also stored in its own XML file in that folder.
+    '''
+    # 1. OPEN FILE AND SPLIT SINGLE XML INTO MULTIPLE PATENTS
+    # The patents are read lazily, one at a time, so the whole file is never loaded into memory
+    xml_pantents = iter_xml_patents(path, xml_separator, buffer_size)
+
+    # 2. Save the patents individually if the user wants to. Multiple xml files in the output processed foled
+    if save_indiv_path is not None:
+        xml_pantents = save_indiv_patents(xml_pantents, save_indiv_path)
+
+    # 3. Parse each patent (see parse_patent_bs4() and parse_patent_lxml()), sequentially or with a pool of workers
+    for pantent_data in parse_patents(xml_pantents, PARSER_BACKENDS[backend], workers, chunk_size):
+        # 4. Keep the patent if at least some info
+        if pantent_data['BRFSUM'] or pantent_data['DETDESC'] or pantent_data['abstract']:
+            yield pantent_data
+
+def parse_and_save(path=raw_data_path, backend='bs4', workers=1):
+    ''' Parses the patents of a weekly XML file (see parse_patent_file()) and saves them in the processed patents file. '''
+    # 1. Parse the patents (see parse_patent_file())
+    save_indiv_path = output_path if config['save_indiv_patents'] else None
+    parsed_patents = parse_patent_file(path, backend, workers, config['parser_chunk_size'], save_indiv_path)
+
+    # 2. Save extracted information. In jsonl format each patent is appended to the file as soon as it is parsed
+    if config['output_processed_format'] == 'jsonl':
+        output_file = config['output_processed_pantents_jsonl']
+        # The writer is closed even if the parsing fails, so the jsonl file and its index stay in sync
+        with PatentWriter(output_file) as writer:
+            for pantent_data in parsed_patents:
+                writer.write(pantent_data)
+        patents_num = writer.count
+    else:
+        output_file = config['output_processed_pantents_json']
+        patents = {
+            'patents': list(parsed_patents)
+        }
+        patents_num = len(patents['patents'])
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(patents, f, ensure_ascii=False, indent=4)
 
-    # 7. Add extracted patent if at least some info
-    if pantent_data['BRFSUM'] or pantent_data['DETDESC'] or pantent_data['abstract']:
-        patents['patents'].append(pantent_data)
+    print(f'File saved {output_file}')
+    return patents_num
 
-# 8. Save extracted information
-print(len(patents['patents']))
-with open(config['output_processed_pantents_json'], 'w', encoding='utf-8') as f:
-    json.dump(patents, f, ensure_ascii=False, indent=4)
+def main():
+    parser = argparse.ArgumentParser(description='Parse the patents of a weekly XML file and save them in a json file.')
+    parser.add_argument('--input', default=raw_data_path, help='Weekly XML file with the patents.')
+    parser.add_argument('--workers', type=int, default=config['parser_workers'],
+                        help='Number of processes used to parse the patents. 1 parses them sequentially.')
+    parser.add_argument('--backend', choices=PARSER_BACKENDS.keys(), default=config['parser_backend'],
+                        help='Library used to parse the XML of each patent.')
+    args = parser.parse_args()
+    parse_and_save(args.input, args.backend, args.workers)
 
-print(f'File saved {config["output_processed_pantents_json"]}')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
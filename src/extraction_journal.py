@@ -0,0 +1,89 @@
+'''
+Script that defines the journal of an extraction run, used to checkpoint the results and resume interrupted runs.
+Each processed text chunk is appended to a JSONL file (one chunk per line) and flushed to disk right away,
+so a crash, a rate limit exception or a Ctrl-C does not throw away the queries that have already been paid for.
+When resuming, the chunks stored in the journal are not sent again to the LLM.
+The first line of the journal holds the id of the run, so a resumed run keeps the id of the run it continues.
+'''
+
+import hashlib
+import json
+import os
+import threading
+
+def text_hash(text):
+    ''' Hash of the text of a chunk. Used to detect chunks that have changed (e.g. a different text_chunk_size). '''
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class ExtractionJournal:
+    '''
+    Append-only journal of the processed chunks, identified by doc_id, data section and chunk position.
+    If resume is False the journal is emptied and starts with run_id. Otherwise the chunks that it already contains
+    are loaded, along with the id of their run (run_id is kept for journals without it). Thread safe.
+    '''
+    def __init__(self, path, resume, run_id=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.run_id = run_id
+        self.entries = {}
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            self._load()
+            self.file = open(path, 'a', encoding='utf-8')
+            # The last line may be incomplete if the previous run was killed while writing it
+            if os.path.getsize(path) > 0:
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.file.write('\n')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+            self._append({'run_id': run_id})
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Incomplete line of an interrupted run
+                    continue
+                if 'doc_id' not in entry:
+                    self.run_id = entry.get('run_id') or self.run_id
+                    continue
+                self.entries[(entry['doc_id'], entry['data_section'], entry['chunk_idx'])] = entry
+
+    def get(self, doc_id, data_section, chunk_idx, text):
+        ''' Returns the stored entry of a chunk, or None if the chunk has not been processed yet. '''
+        entry = self.entries.get((doc_id, data_section, chunk_idx))
+        if entry is None or entry['text_hash'] != text_hash(text):
+            return None
+        return entry
+
+    def write(self, doc_id, data_section, chunk_idx, text, extraction, validated):
+        ''' Appends a processed chunk to the journal and forces it to disk. '''
+        entry = {
+            'doc_id': doc_id,
+            'data_section': data_section,
+            'chunk_idx': chunk_idx,
+            'text_hash': text_hash(text),
+            'extraction': extraction,
+            'validated': validated,
+        }
+        with self.lock:
+            self._append(entry)
+            self.entries[(doc_id, data_section, chunk_idx)] = entry
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self.file.close()
@@ -3,229 +3,385 @@ Script containing the implementation of the tool to extract measurements from pa
 First the data is loaded, sampling is performed to reduce the number of patents to be processed, then the model is loaded.
 Next we define the prompt template along with several examples (few-shot learning) from prompts.py.
 
-For each patent, a text chunk is generated (text_chunk + prompt_template + examples ~= MAX TOKENS from model). 
-Then, only the text chunks that contains a number will be feed into the model. Otherwise it is disregarded since it is assumed that there is no measure.
+For each patent, text chunks are generated so that text_chunk + prompt_template + examples + completion fit in the context window of the model.
+Then, only the text chunks that contain a measurement candidate (a number followed by a unit) will be feed into the model. Otherwise it is disregarded since it is assumed that there is no measure.
 Finally the output of the model is parsed and validated. 
 The validation consists in that the value must contain at least one number and the unit must be different from unitless, NA or similar.
+
+The steps of the pipeline (sampler, chunker, extractor and validator) are defined in measurement_pipeline.py, so they can
+be reused without running this script. The run can also be launched with the extract command of pipeline_cli.py.
 '''
 
 # Common imports
-import random
+import argparse
+import contextlib
 import json
-import re
-
-# LLM related imports
-from langchain.chat_models import ChatOpenAI
-from langchain.llms import OpenAI
-from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from kor import from_pydantic
-from kor.extraction import create_extraction_chain
+import time
 
 # My imports (from my files)
-from llm_custom_wrapper import MPT_LLM
 from config import config
-import time
-from prompts import Patent_measurements, patent_examples
-from input_examples import inp_examples
-
-# 1. Load data
-with open(config['output_processed_pantents_json'], 'r', encoding='utf-8') as f:
-    patents = json.load(f)
-
-# 2. Sample pantents.
-# 2.1 Stablish a seed --> Important for code reproducibility
-random.seed(a=config['data_selection_seed'])
-if config['sample_patents_num'] > 0:
-    # Sampling patents
-    patents['patents'] = random.sample(patents['patents'],config['sample_patents_num'])
-
-# 3. Load the model
-if config['use_open_ai']:
-    #     model_name="gpt-3.5-turbo", # Cheaper but less reliable
-    try:
-        from secret import open_ai_key
-    except:
-        raise Exception(
-            "src/secret.py not found. Make sure that you have created the following file: src/secret.py with your api_key in a variable called open_ai_key."
-            "You can also rename the file src/secret_template.py into src/secret.py "
-        )
-        exit()
-    model = ChatOpenAI(model_name="gpt-3.5-turbo",
-                        temperature= config['gpt_temperature'], #0,
-                        max_tokens= config['gpt_max_tokens'], #2000,
-                        frequency_penalty= config['gpt_frequency_penalty'], #0,
-                        presence_penalty= config['gpt_presence_penalty'], #0,
-                        openai_api_key=open_ai_key)
-else:
-    model = MPT_LLM(url_model=config['server_url'])
-
-# 4. Define the patent schema. Patent_measurements and patent_examples can be found in the prompts.py file.
-# The patent schema will be the object that contains the template prompt with the examples and the parser
-# to handle the LLM results
-patent_schema, extraction_validator = from_pydantic(
-    Patent_measurements,
-    description="Identifies and extracts measurements, including measure elements, attributes, values, and units, from documents.",
-    examples=patent_examples,
-    many=True,
-)
-# 4.1 Create the chain. Merely an object to call when we want to query the LLM following the defined schema
-chain = create_extraction_chain(model, patent_schema)
-
-def chunk_filer(text):
-    ''' 
-    This function aims to optimize API calls to the LLM by filtering out chunks that do not contain numbers. 
-    We are implementing a basic and straightforward filtering approach where chunks without numbers are excluded. 
-    Our assumption is that every measurement always includes a number.
-    For a more profesional environment this filtering should be more complete.
+from measurement_pipeline import MeasurementExtractor, llm_input_text, load_patents, prefilter_chunk
+from llm_dispatch import dispatch, estimate_tokens
+from extraction_journal import ExtractionJournal
+from rule_extractor import extract_measurements_rules
+from measurement_normalizer import extractions_to_frame, normalize_frame, validate_llm_output
+from measurement_store import MeasurementParquetWriter, new_run_id
+from chunk_dedup import ChunkDeduplicator, reusable_extraction
+from run_telemetry import RunTelemetry, print_summary
+from chunk_batching import pack_chunk_batches
+
+def run_single_example(extractor=None):
     '''
-    flag = bool(re.search(r"\d+", text))
-    return flag
-
-def validate_llm_output(llm_output):
-    ''' 
-    Function that validates the LLM outputs.
-    Basically we are checking that the results as we would check any user input.
-    Value must contain a number and unit must not be unitless, NA or similar
+    Extracts the measurements of the first input example and prints them along with the raw output of the chain.
+    This is mainly for debugging and testing purposes.
     '''
-    validated_results = []
-    
-    for lo in llm_output:
-        if ('value' in lo) and ('unit' in lo):
-            valid_flag = True
-            # value
-            # check if value contains a number
-            if not re.search(r"\d+", lo['value']):
-                valid_flag = False
-                
-            # unit
-            if lo['unit'] in ['N/A', 'unitless', '', 'NA', 'not specified', '-']:
-                valid_flag = False
-
-            if valid_flag:
-                validated_results.append(lo)
-    return validated_results
-
-# This is mainly for debugging and testing purposes
-if 'execute_single_example':
+    from input_examples import inp_examples
+    extractor = extractor or MeasurementExtractor()
     # Select one example
     debug_text = inp_examples[0]
 
     # Run extraction chain
-    extracted = chain.predict_and_parse(text=debug_text)
+    extracted = extractor.chain.predict_and_parse(text=debug_text)
     print(extracted)
     print('-'*20)
     print(extracted['data'])
 
     # Print the prompt used
-    #prompt = chain.prompt.format_prompt(text=text).to_string()
+    #prompt = extractor.chain.prompt.format_prompt(text=text).to_string()
     #print(prompt)
-    exit()
-
-# 5. Select the part of the patent to process.  Abstract, summary or detailed description
-data_section = config['data_selection_section']
-print(f"Processing the {data_section} section of the {len(patents['patents'])} patents to process")
-
-# 6. Prepare resulting object and text splitter. The last is used to split the text into chunks
-extraction_results = {
-    'patents':[]
-}
-text_splitter = RecursiveCharacterTextSplitter(chunk_size = config['text_chunk_size'])
-
-# 7. Process patents
-# 7.1 For each patent
-for patent in patents['patents']:
-    # 7.2 Form the resulting object of 1 patent
-    res = {
-        'doc_id': patent['doc_id'],
-        'data_section': data_section,
-        'elements_processed': []
+    return extracted
+
+def run_extraction(resume=False):
+    '''
+    Extracts the measurements of a sample of patents and saves the results, the measurements table and the telemetry of the run.
+    With resume, the chunks stored in the extraction journal by an interrupted run are not sent again to the LLM.
+    '''
+    # 0. Telemetry of the run: metrics of each chunk and patent, time of each stage and LLM latency (see run_telemetry.py)
+    telemetry = RunTelemetry(
+        config['output_telemetry_jsonl'], None, profiler=config['telemetry_profiler'], profile_dir=config['telemetry_profile_dir']
+    )
+    telemetry.begin_stage('load')
+
+    # 1-2. Load data and sample pantents. With the jsonl format only the sampled patents are kept in memory (see patent_store.py)
+    patents = {'patents': load_patents()}
+
+    # 3-4. Load the model and define the patent schema and the chains (template prompt with the examples and parser).
+    # Patent_measurements and patent_examples can be found in the prompts.py file. The cache of LLM completions and the
+    # rate limiter are also created here and the static part of the prompts is registered in the MPT api (see measurement_pipeline.py)
+    telemetry.begin_stage('setup')
+    extractor = MeasurementExtractor(telemetry=telemetry)
+    telemetry.model_name = extractor.model_params['model_name']
+    telemetry.prices = config['llm_prices_per_1k_tokens'].get(extractor.model_params['model_name']) if config['use_open_ai'] else None
+
+    # 5. Select the parts of the patent to process.  Abstract, summary and/or detailed description.
+    # Several sections are processed in a single pass, sharing the patents, the chain, the cache and the rate limiter
+    data_sections = config['data_selection_sections'] or [config['data_selection_section']]
+    print(f"Processing the {', '.join(data_sections)} section(s) of the {len(patents['patents'])} patents to process")
+
+    # 6. Prepare resulting object and text splitter. The last is used to split the text into chunks (see MeasurementExtractor.text_splitter())
+    extraction_results = {
+        'patents':[]
     }
+    text_splitter = extractor.text_splitter()
+    if config['text_chunk_method'] == 'tokens':
+        # Tokens of the context window left for the text by the rendered prompt (instructions and examples) and the completion
+        print(f'Text chunks of up to {text_splitter.token_budget} tokens (context {extractor.context_tokens}, '
+              f'prompt {extractor.prompt_tokens()}, completion {extractor.completion_max_tokens})')
+    # 6.1 The rate limiter of the model API and the cache of LLM completions are shared by all the calls of the extractor
+    # 6.2 Journal of the processed chunks. When resuming, the chunks already processed are taken from it
+    # The journal also holds the id of the run, kept by a resumed run (see measurement_store.py)
+    journal = ExtractionJournal(config['extraction_journal_path'], resume=resume, run_id=new_run_id())
+    resumed_chunks = 0
+    # Chunks extracted by the rules without calling the LLM
+    rule_chunks = 0
+    # The journal and the measurement files are closed even if the run fails. The measurement files of a failed run
+    # are discarded, so they never leave incomplete files in the table (see MeasurementParquetWriter)
+    with contextlib.ExitStack() as open_files:
+        open_files.callback(journal.close)
+        # 6.3 Table of measurements in Parquet format, written in row groups as the chunks are processed. A file per section
+        measurement_writers = {}
+        if config['save_measurements_parquet']:
+            measurement_writers = {
+                data_section: open_files.enter_context(MeasurementParquetWriter(
+                    config['output_measurements_parquet_dir'], data_section, config['parquet_row_group_size'], journal.run_id
+                ))
+                for data_section in data_sections
+            }
+        # 6.4 Index of the chunks that have passed the filter, to detect the repeated ones (see chunk_dedup.py)
+        deduplicator = None
+        if config['chunk_dedup']:
+            deduplicator = ChunkDeduplicator(
+                config['dedup_threshold'], config['dedup_num_perm'], config['dedup_bands'], config['dedup_shingle_size']
+            )
+        # Resulting objects of the indexed chunks by (doc_id, data_section, chunk_idx)
+        indexed_chunks = {}
+        # Chunks that repeat an indexed chunk and the tokens of text that were not sent to the LLM for them
+        duplicate_chunks = []
+        duplicate_tokens = 0
 
-    # 7.3 Form text chunks of the selected section of the patent
-    text_document = ' '.join(patent[data_section])
-    split_docs = text_splitter.create_documents([text_document])
-
-    # 7.4 For each doc
-    for sd in split_docs:
-        # 7.5 Create empy list to store results and obtain the text from the chunk
-        result = []
-        validated_data = []
-        text = sd.page_content
-        skipped = True
-        # 7.6 Filter the results. If there is a num then call the LLM
-        if chunk_filer(text):
-            skipped = False
-            # 7.7 Call the LLM with the chain (template prompt with examples and parser)
-            extracted = chain.predict_and_parse(text=text)
-            result = extracted['data']
-            if 'patent_measurements' in result:
-                # 7.8 If the model has outputted something meaningful store the raw results and the validated ones (see validate_llm_output())
-                result = result['patent_measurements']
-                validated_data = validate_llm_output(result)
-            else:
-                # Sometimes the model response contains some unparseable elements
-                # for example 5 measure attributes when we are expecting 4.
-                # Mostly the unparseable elements are empty dicts because there was nothing to extract.
-                # We could test and explore when and why this happens more carefully.
-                print(result)
-
-            # 7.9 Wait a cooldown time. Useful with API models who has apirates
-            time.sleep(config['cooldown_time'])
-        # 7.10 Save the extracted information about the single chunk into the resulting object
-        res['elements_processed'].append({
-            'text':text,
-            'skipped': skipped,
-            'extraction':result,
-            'validated': validated_data
-        })
-    # 7.11 Save the extracted information about the single patent into the resulting object       
-    extraction_results['patents'].append(res)
-
-# 8. Save the resulting object with the raw extractions and the validated ones
-with open(config['output_extracted_pantents_json'], 'w', encoding='utf-8') as f:
-    json.dump(extraction_results, f, ensure_ascii=False, indent=4)
-
-# 9. Save in a different file the resulting object with just the validated extractions.
-# If there are no valid extractions then the chunk will be saved along with no measurements
-cleaned_extraction_results = {'patents':[]}
-for patent in extraction_results['patents']:
-    cleaned_elements_processed = []
-    for ep in patent['elements_processed']:
-        # Check if the chunk has been skipped. If not save the information
-        if not ep['skipped']:
-            cleaned_section = {
-                'text': ep['text'],
-                'validated': ep['validated']
+        def save_chunk_measurements(doc_id, data_section, chunk_idx, element_processed):
+            ''' Adds the measurements of a processed chunk to the Parquet measurements table of its section (see measurement_store.py). '''
+            if measurement_writers:
+                measurement_writers[data_section].write_chunk(doc_id, chunk_idx, element_processed['extraction'], element_processed['validated'])
+
+        def record_chunk_metrics(doc_id, data_section, chunk_idx, element_processed, metrics):
+            ''' Adds the measurements of a processed chunk to the metrics collected while it was prepared and records them. '''
+            metrics = {**chunk_metrics.pop((doc_id, data_section, chunk_idx)), **metrics}
+            metrics['measurements'] = len(element_processed['extraction']) if isinstance(element_processed['extraction'], list) else 0
+            metrics['valid_measurements'] = len(element_processed['validated'])
+            telemetry.record_chunk(doc_id, data_section, chunk_idx, metrics)
+
+        def process_chunk(job):
+            '''
+            Extracts the measurements of a chunk (see MeasurementExtractor.extract()), saves them in its resulting object
+            and appends them to the extraction journal so they are not lost if the run is interrupted.
+            '''
+            doc_id, data_section, chunk_idx, element_processed = job
+            metrics = {'batch_size': 1}
+            result, validated_data = extractor.extract(element_processed['text'], metrics)
+            element_processed['extraction'] = result
+            element_processed['validated'] = validated_data
+            journal.write(doc_id, data_section, chunk_idx, element_processed['text'], result, validated_data)
+            save_chunk_measurements(doc_id, data_section, chunk_idx, element_processed)
+            record_chunk_metrics(doc_id, data_section, chunk_idx, element_processed, metrics)
+
+        def process_chunk_batch(batch):
+            '''
+            Extracts the measurements of several chunks in a single LLM call (see MeasurementExtractor.extract_batch())
+            and saves them in the resulting object of each chunk and in the journal.
+            A batch with a single chunk is processed with the normal chain (see process_chunk()).
+            '''
+            if len(batch) == 1:
+                return process_chunk(batch[0])
+            call_metrics = {}
+            results = extractor.extract_batch([element_processed['text'] for *_, element_processed in batch], call_metrics)
+            # The metrics of the call are split evenly among the chunks of the batch, and its retries are counted once (in the first chunk)
+            metrics = {
+                name: value / len(batch) if isinstance(value, float) or name.endswith('tokens') else value
+                for name, value in call_metrics.items()
             }
-            cleaned_elements_processed.append(cleaned_section)
-            
-    cleaned_patent = {
-        'doc_id':patent['doc_id'],
-        'data_section':patent['data_section'],
-        'elements_processed': cleaned_elements_processed
-    }
+            metrics['batch_size'] = len(batch)
+            for position, ((doc_id, data_section, chunk_idx, element_processed), (chunk_result, validated_data)) in enumerate(zip(batch, results)):
+                chunk_call_metrics = metrics if position == 0 else {**metrics, 'retries': 0}
+                element_processed['extraction'] = chunk_result
+                element_processed['validated'] = validated_data
+                journal.write(doc_id, data_section, chunk_idx, element_processed['text'], chunk_result, validated_data)
+                save_chunk_measurements(doc_id, data_section, chunk_idx, element_processed)
+                record_chunk_metrics(doc_id, data_section, chunk_idx, element_processed, chunk_call_metrics)
+
+        # 7. Process patents
+        telemetry.begin_stage('chunks')
+        # Chunks that have passed the filter and have to be sent to the LLM
+        pending_chunks = []
+        # Metrics of the chunks sent to the LLM, recorded once they are processed (see record_chunk_metrics())
+        chunk_metrics = {}
+        # 7.1 For each patent and each selected section (a resulting object per patent and section)
+        for patent in patents['patents']:
+            for data_section in data_sections:
+                # 7.2 Form the resulting object of 1 patent section
+                res = {
+                    'doc_id': patent['doc_id'],
+                    'data_section': data_section,
+                    'elements_processed': []
+                }
+
+                # 7.3 Form text chunks of the selected section of the patent
+                start = time.perf_counter()
+                text_document = ' '.join(patent[data_section])
+                split_texts = text_splitter.split_text(text_document)
+                # The split time of the section is shared by its chunks
+                split_seconds = (time.perf_counter() - start) / max(1, len(split_texts))
+
+                # 7.4 For each chunk
+                for chunk_idx, text in enumerate(split_texts):
+                    # 7.5 Create the resulting object of the chunk with empty results
+                    element_processed = {
+                        'text':text,
+                        'skipped': True,
+                        'extraction':[],
+                        'validated': []
+                    }
+                    chunk_key = (patent['doc_id'], data_section, chunk_idx)
+                    chunk_metrics[chunk_key] = {'path': 'skipped', 'chars': len(text), 'split_seconds': split_seconds}
+                    # 7.6 Filter the results. If there is a measurement candidate (or a num) then the chunk will be sent to the LLM
+                    start = time.perf_counter()
+                    passes_filter = prefilter_chunk(text)
+                    chunk_metrics[chunk_key]['filter_seconds'] = time.perf_counter() - start
+                    if passes_filter:
+                        element_processed['skipped'] = False
+                        # Unless the rules can extract its measurements with enough confidence (see rule_extractor.py)
+                        start = time.perf_counter()
+                        rule_measurements, rule_confidence = extract_measurements_rules(text) if config['use_rule_extractor'] else ([], 0)
+                        chunk_metrics[chunk_key]['rules_seconds'] = time.perf_counter() - start
+                        # or it has already been processed in a previous run
+                        entry = journal.get(patent['doc_id'], data_section, chunk_idx, text)
+                        # or it repeats a chunk of this run (of this patent or another one, of any section), whose extraction is reused
+                        duplicate_of = deduplicator.add(chunk_key, text) if deduplicator is not None else None
+                        if deduplicator is not None and duplicate_of is None:
+                            indexed_chunks[chunk_key] = element_processed
+                        if config['use_rule_extractor'] and rule_confidence >= config['rule_extractor_min_confidence']:
+                            element_processed['extraction'] = rule_measurements
+                            element_processed['validated'] = validate_llm_output(rule_measurements)
+                            save_chunk_measurements(*chunk_key, element_processed)
+                            record_chunk_metrics(*chunk_key, element_processed, {'path': 'rules'})
+                            rule_chunks += 1
+                        elif entry is not None:
+                            element_processed['extraction'] = entry['extraction']
+                            element_processed['validated'] = entry['validated']
+                            save_chunk_measurements(*chunk_key, element_processed)
+                            record_chunk_metrics(*chunk_key, element_processed, {'path': 'journal'})
+                            resumed_chunks += 1
+                        elif duplicate_of is not None:
+                            chunk_metrics[chunk_key]['path'] = 'duplicate'
+                            duplicate_chunks.append((*chunk_key, element_processed, duplicate_of))
+                            duplicate_tokens += estimate_tokens(llm_input_text(text))
+                        else:
+                            chunk_metrics[chunk_key]['path'] = 'llm'
+                            pending_chunks.append((*chunk_key, element_processed))
+                    else:
+                        record_chunk_metrics(*chunk_key, element_processed, {})
+                    # 7.7 Save the single chunk into the resulting object
+                    res['elements_processed'].append(element_processed)
+                # 7.8 Save the single patent section into the resulting object
+                extraction_results['patents'].append(res)
+
+        if resume:
+            print(f'Resuming run: {resumed_chunks} chunks taken from the journal, {len(pending_chunks)} chunks left')
+
+        # 7.9 Call the LLM for every chunk that has passed the filter (see process_chunk()).
+        telemetry.begin_stage('llm')
+        # Up to llm_concurrency queries are kept in flight and the pace is controlled by the rate limiter.
+        # The results are saved in the resulting object of each chunk and in the journal as soon as they are received.
+        if extractor.batch_chain is not None:
+            # Several chunks are packed in each call, up to the tokens left by the batched prompt (see chunk_batching.py)
+            count_tokens = extractor.count_tokens
+            prompt_tokens = extractor.prompt_tokens()
+            batch_prompt_tokens = extractor.prompt_tokens(extractor.batch_chain)
+            chunk_batches, batches_tokens = pack_chunk_batches(
+                pending_chunks, count_tokens, extractor.token_budget(extractor.batch_chain), config['llm_chunks_per_call']
+            )
+            dispatch(process_chunk_batch, chunk_batches, config['llm_concurrency'])
+            # Prompt tokens sent with one call per chunk and with the batched calls (a batch of one chunk uses the normal prompt)
+            single_calls_prompt_tokens = len(pending_chunks) * prompt_tokens + sum(
+                count_tokens(element_processed['text']) for *_, element_processed in pending_chunks
+            )
+            batched_calls_prompt_tokens = sum(
+                (batch_prompt_tokens if len(batch) > 1 else prompt_tokens) + tokens
+                for batch, tokens in zip(chunk_batches, batches_tokens)
+            )
+        else:
+            dispatch(process_chunk, pending_chunks, config['llm_concurrency'])
+
+        # 7.10 The repeated chunks take the extraction of the chunk they repeat, once it has been processed.
+        # A near duplicate only takes it if it names every element and property of the extraction (see reusable_extraction()),
+        # otherwise it is sent to the LLM
+        rechecked_chunks = []
+        for doc_id, data_section, chunk_idx, element_processed, duplicate_of in duplicate_chunks:
+            original = indexed_chunks[duplicate_of]
+            if not reusable_extraction(original['text'], original['extraction'], element_processed['text']):
+                chunk_metrics[(doc_id, data_section, chunk_idx)]['path'] = 'llm'
+                rechecked_chunks.append((doc_id, data_section, chunk_idx, element_processed))
+                duplicate_tokens -= estimate_tokens(llm_input_text(element_processed['text']))
+                continue
+            element_processed['extraction'] = list(original['extraction']) if isinstance(original['extraction'], list) else original['extraction']
+            element_processed['validated'] = list(original['validated'])
+            journal.write(doc_id, data_section, chunk_idx, element_processed['text'], element_processed['extraction'], element_processed['validated'])
+            save_chunk_measurements(doc_id, data_section, chunk_idx, element_processed)
+            record_chunk_metrics(doc_id, data_section, chunk_idx, element_processed, {})
+        dispatch(process_chunk, rechecked_chunks, config['llm_concurrency'])
+    for measurement_writer in measurement_writers.values():
+        print(f'Measurements table saved in {measurement_writer.path} ({measurement_writer.rows} rows)')
+
+    # 8. Save the resulting object with the raw extractions and the validated ones
+    telemetry.begin_stage('output')
+    with open(config['output_extracted_pantents_json'], 'w', encoding='utf-8') as f:
+        json.dump(extraction_results, f, ensure_ascii=False, indent=4)
+
+    # 8.1 Save all the measurements in a table (csv) with the valid flag, the canonical unit and the numeric min/max of the
+    # values, computed for the whole result set at once (see measurement_normalizer.py)
+    normalized_measurements = normalize_frame(extractions_to_frame(extraction_results))
+    normalized_measurements.to_csv(config['output_normalized_measurements_csv'], index=False)
+
+    # 9. Save in a different file the resulting object with just the validated extractions.
+    # If there are no valid extractions then the chunk will be saved along with no measurements
+    cleaned_extraction_results = {'patents':[]}
+    for patent in extraction_results['patents']:
+        cleaned_elements_processed = []
+        for ep in patent['elements_processed']:
+            # Check if the chunk has been skipped. If not save the information
+            if not ep['skipped']:
+                cleaned_section = {
+                    'text': ep['text'],
+                    'validated': ep['validated']
+                }
+                cleaned_elements_processed.append(cleaned_section)
+
+        cleaned_patent = {
+            'doc_id':patent['doc_id'],
+            'data_section':patent['data_section'],
+            'elements_processed': cleaned_elements_processed
+        }
+        cleaned_extraction_results['patents'].append(cleaned_patent)
+
+    with open(config['output_extracted_pantents_valid_json'], 'w', encoding='utf-8') as f:
+        json.dump(cleaned_extraction_results, f, ensure_ascii=False, indent=4)
+
+    # 10. Extract information about the experiment. 
+    # Num of patents processed, text chunks, filtered text chunks, raw extractions and valid measurements.
+    # The counters are computed per section and added up
+    section_counters = {data_section: {'chunks': 0, 'evaluated': 0, 'raw': 0, 'valid': 0} for data_section in data_sections}
+    for patent in extraction_results['patents']:
+        counters = section_counters[patent['data_section']]
+        counters['chunks'] += len(patent['elements_processed'])
+        for ep in patent['elements_processed']:
+            counters['raw'] += len(ep['extraction'])
+            counters['valid'] += len(ep['validated'])
+            if not ep['skipped']:
+                counters['evaluated'] +=1
+    patents_num = len(patents['patents'])
+    text_chunks_total = sum(counters['chunks'] for counters in section_counters.values())
+    chunks_evaluated = sum(counters['evaluated'] for counters in section_counters.values())
+    num_raw_extractions = sum(counters['raw'] for counters in section_counters.values())
+    num_valid_extractions = sum(counters['valid'] for counters in section_counters.values())
+
+    print(f'Number of patents analysed: {patents_num}')
+    print(f'Number of text chunks produced: {text_chunks_total}')
+    print(f'Number of text chunks after filtering (evaluated): {chunks_evaluated}')
+    if len(data_sections) > 1:
+        for data_section, counters in section_counters.items():
+            print(f'    {data_section}: {counters["chunks"]} text chunks, {counters["evaluated"]} evaluated, '
+                  f'{counters["raw"]} measurements extracted, {counters["valid"]} valid')
+    if config['use_rule_extractor']:
+        print(f'Number of text chunks extracted by the rules (without LLM): {rule_chunks}')
+    if deduplicator is not None:
+        print(f'Number of text chunks deduplicated (extraction reused): {len(duplicate_chunks) - len(rechecked_chunks)} '
+              f'(~{duplicate_tokens} tokens not sent, {len(rechecked_chunks)} near duplicates sent to the LLM)')
+    if extractor.batch_chain is not None:
+        print(f'Number of LLM calls: {len(chunk_batches)} ({len(pending_chunks)} chunks, up to {config["llm_chunks_per_call"]} chunks per call)')
+        print(f'Prompt tokens: {batched_calls_prompt_tokens} with batched calls, {single_calls_prompt_tokens} with one call per chunk '
+              f'({single_calls_prompt_tokens - batched_calls_prompt_tokens} saved)')
+    if config['text_chunk_method'] == 'tokens':
+        print(f'Average fill ratio of the text chunks: {text_splitter.fill_ratio():.2f} (budget of {text_splitter.token_budget} tokens)')
+    print(f'Number of measurements extracted: {num_raw_extractions}')
+    print(f'Number of valid measurements extracted: {num_valid_extractions}')
+    if extractor.llm_cache:
+        print(f'Number of LLM cache hits: {extractor.llm_cache.hits}')
+        print(f'Number of LLM cache misses: {extractor.llm_cache.misses}')
+
+    # 10.1 Metrics of the run: time of each stage, LLM latency percentiles, tokens and cost (see run_telemetry.py)
+    print_summary(telemetry.close())
+    print(f"Telemetry of the run saved in {config['output_telemetry_jsonl']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract the measurements of a sample of patents with a LLM.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted run. The chunks stored in the extraction journal are not sent again to the LLM.')
+    args = parser.parse_args()
+
+    if config['execute_single_example']:
+        run_single_example()
+        return
+    run_extraction(resume=args.resume)
 
-with open(config['output_extracted_pantents_valid_json'], 'w', encoding='utf-8') as f:
-    json.dump(extraction_results, f, ensure_ascii=False, indent=4)
-
-# 10. Extract information about the experiment. 
-# Num of patents processed, text chunks, filtered text chunks, raw extractions and valid measurements.
-patents_num = len(extraction_results['patents'])
-text_chunks_total = 0
-chunks_evaluated = 0
-num_raw_extractions = 0
-num_valid_extractions = 0
-for patent in extraction_results['patents']:
-    text_chunks_total += len(patent['elements_processed'])
-    for ep in patent['elements_processed']:
-        num_raw_extractions += len(ep['extraction'])
-        num_valid_extractions += len(ep['validated'])
-        if not ep['skipped']:
-            chunks_evaluated +=1
-
-print(f'Number of patents analysed: {patents_num}')
-print(f'Number of text chunks produced: {text_chunks_total}')
-print(f'Number of text chunks after filtering (evaluated): {chunks_evaluated}')
-print(f'Number of measurements extracted: {num_raw_extractions}')
-print(f'Number of valid measurements extracted: {num_valid_extractions}')
+if __name__ == '__main__':
+    main()
@@ -4,26 +4,6 @@ Script to generate synthetic train data for finetuning the model.
 
 from config import config 
 import json
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import (
-    AIMessage,
-    HumanMessage,
-    SystemMessage
-)
-
-try:
-    from secret import open_ai_key
-except:
-    raise Exception(
-        "src/secret.py not found. Make sure that you have created the following file: src/secret.py with your api_key in a variable called open_ai_key."
-        "You can also rename the file src/secret_template.py into src/secret.py "
-    )
-model = ChatOpenAI(model_name="gpt-3.5-turbo",
-                        temperature= 0.7, # we want the model to be creative
-                        max_tokens= config['gpt_max_tokens'], #2000,
-                        #frequency_penalty= config['gpt_frequency_penalty'], #0,
-                        #presence_penalty= config['gpt_presence_penalty'], #0,
-                        openai_api_key=open_ai_key)
 
 generation_prompt = """
 Generate {n_times} paragraphs related to patents descriptions that contains at least a measurement. Along with the paragraphs you will need to output the measurement in a json format.format
@@ -38,21 +18,28 @@ Input: The resulting BaCO3 had a crystallite size of between about 20 and 40 nm
 Output: {{'element': 'BACO3', 'property': 'crystallite size', 'value': 'between 20 and 40', 'unit': 'nm'}}
 
 Input:
-""".format(n_times=config["number_generations_prompt"])
+"""
 
-messages = [
-    HumanMessage(content=generation_prompt)
-]
-
-# Define the resulting object
-generated_pantents = {'generated_pantents': []}
+def load_generation_model():
+    ''' OpenAI chat model used to generate the examples. '''
+    from langchain.chat_models import ChatOpenAI
+    try:
+        from secret import open_ai_key
+    except ImportError:
+        raise Exception(
+            "src/secret.py not found. Make sure that you have created the following file: src/secret.py with your api_key in a variable called open_ai_key."
+            "You can also rename the file src/secret_template.py into src/secret.py "
+        )
+    return ChatOpenAI(model_name="gpt-3.5-turbo",
+                        temperature= 0.7, # we want the model to be creative
+                        max_tokens= config['gpt_max_tokens'], #2000,
+                        #frequency_penalty= config['gpt_frequency_penalty'], #0,
+                        #presence_penalty= config['gpt_presence_penalty'], #0,
+                        openai_api_key=open_ai_key)
 
-# Repeat repeat_generation_process times
-for i in range(config['repeat_generation_process']):
-    print(i)
-    # Query the model and get results
-    prompt_result = model(messages)
-    prompt_result = prompt_result.content
+def parse_generated_examples(prompt_result):
+    ''' Splits the answer of the model into examples with the input paragraph (prompt) and the measurement (completion). '''
+    examples = []
     # Split each \n\n
     generated_examples = prompt_result.split('\n\n')
     # For each split (generated instance)
@@ -68,9 +55,33 @@ for i in range(config['repeat_generation_process']):
         output_llm = inp_out[1]
         result['prompt'] = input_patent
         result['completion'] = output_llm
-        # Append example
-        generated_pantents['generated_pantents'].append(result)
+        examples.append(result)
+    return examples
+
+def generate_examples(model=None, n_times=config["number_generations_prompt"], repetitions=config['repeat_generation_process']):
+    ''' Queries the model repetitions times for n_times examples each time and returns all the generated examples. '''
+    from langchain.schema import HumanMessage
+    model = model or load_generation_model()
+    messages = [
+        HumanMessage(content=generation_prompt.format(n_times=n_times))
+    ]
+
+    # Define the resulting object
+    generated_pantents = {'generated_pantents': []}
+
+    # Repeat repeat_generation_process times
+    for i in range(repetitions):
+        print(i)
+        # Query the model and get results
+        prompt_result = model(messages)
+        generated_pantents['generated_pantents'].extend(parse_generated_examples(prompt_result.content))
+    return generated_pantents
+
+def main():
+    generated_pantents = generate_examples()
+    # Save results
+    with open(config['output_generated_pantents_json'], 'w', encoding='utf-8') as f:
+        json.dump(generated_pantents, f, ensure_ascii=False, indent=4)
 
-# Save results
-with open(config['output_generated_pantents_json'], 'w', encoding='utf-8') as f:
-    json.dump(generated_pantents, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Script that defines a persistent cache of the LLM completions stored in a SQLite database.
+Each completion is stored under a hash of the fully rendered prompt together with the model parameters
+(model name, temperature, max tokens...), so re-running an experiment with the same data, chunk size and prompt
+does not query the model again. The raw completions are stored, so the parser can be changed without invalidating the cache.
+When the cache grows over its maximum size, the least recently used completions are evicted.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class LLMCache:
+    ''' SQLite cache of raw LLM completions keyed by the hash of the prompt and the model parameters. Thread safe. '''
+    def __init__(self, path, model_params, max_size_mb):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.model_params = json.dumps(model_params, sort_keys=True)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS completions ('
+            'key TEXT PRIMARY KEY, completion TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+
+    def key(self, prompt):
+        ''' Hash of the rendered prompt and the model parameters. '''
+        return hashlib.sha256(f'{self.model_params}\n{prompt}'.encode('utf-8')).hexdigest()
+
+    def get(self, prompt):
+        ''' Returns the cached completion of the prompt, or None if it is not in the cache. '''
+        key = self.key(prompt)
+        with self.lock:
+            row = self.connection.execute('SELECT completion FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE completions SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, prompt, completion):
+        ''' Stores the completion of the prompt and evicts the least recently used ones if the cache is too big. '''
+        key = self.key(prompt)
+        size = len(key) + len(completion.encode('utf-8'))
+        with self.lock:
+            previous = self.connection.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            if previous is not None:
+                self.size -= previous[0]
+            self.connection.execute(
+                'INSERT OR REPLACE INTO completions (key, completion, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, completion, size, time.time()),
+            )
+            self.size += size
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        ''' Removes the least recently used completions until the cache fits in its maximum size. '''
+        while self.size > self.max_size:
+            rows = self.connection.execute(
+                'SELECT key, size FROM completions ORDER BY last_access LIMIT 100'
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.connection.execute('DELETE FROM completions WHERE key = ?', (key,))
+                self.size -= size
+
+    def close(self):
+        self.connection.close()
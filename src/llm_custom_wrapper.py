@@ -4,20 +4,92 @@ There is also a client part so we can test and speak with the model.
 I have used this tutorial: https://python.langchain.com/en/latest/modules/models/llms/examples/custom_llm.html
 '''
 
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain.llms.base import LLM
+from pydantic import PrivateAttr
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
 import requests
 import json
 from typing import Any, Mapping, Optional, List
 import colorama
+import hashlib
+import random
+import re
+import threading
+import time
 from config import config
+from rule_extractor import extract_measurements_rules
 
 # Load API url
 SERVER = config['server_address']
 URL = config['server_url']
+STREAM_URL = config['server_stream_url']
+REGISTER_PREFIX_URL = config['server_register_prefix_url']
+READY_URL = config['server_ready_url']
+
+# Markers that appear after a complete kor output (CSV table): a blank line, the model starting a new example
+# or the end key of the instruction format
+KOR_OUTPUT_END_MARKERS = ['\n\n', '\r\n\r\n', '\nInput:', '### End']
+
+def kor_output_end(text):
+    ''' Position where the kor output of a completion ends, or None if the output may still continue. '''
+    start = len(text) - len(text.lstrip())
+    positions = [text.find(marker, start) for marker in KOR_OUTPUT_END_MARKERS]
+    positions = [position for position in positions if position != -1]
+    return min(positions) if positions else None
+
+# Key of the instruction format of the api that precedes the response (RESPONSE_KEY in mpt_api.py, which is not imported
+# here because it loads torch). The /generate endpoint returns the prompt with the template followed by the response
+RESPONSE_KEY = '### Response:'
+
+def strip_prompt(generated_text):
+    ''' Response of a /generate output, which also contains the prompt (the streamed outputs only contain the response). '''
+    if RESPONSE_KEY not in generated_text:
+        return generated_text
+    response = generated_text.split(RESPONSE_KEY, 1)[1]
+    # The template ends with a new line after the response key
+    return response[1:] if response.startswith('\n') else response
+
+# HTTP status codes of the responses that are retried (rate limit and server errors)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+HEADERS = {'Content-type':'application/json', 'Accept':'application/json'}
+# Retries of the last call made by each thread (see MPT_LLM.call_retries())
+_call_state = threading.local()
+
+def response_retries(response):
+    ''' Number of times that the request of a response was retried by the session. '''
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
 
 class MPT_LLM(LLM):
-    ''' Definition of our custom wrapper for the MPT. We need to define at least the call function. '''
+    '''
+    Definition of our custom wrapper for the MPT. We need to define at least the call function.
+    Each instance keeps a pool of keep-alive HTTP connections to the api (one for the sync calls and one for the async ones),
+    with connect/read timeouts and retries with exponential backoff. Before its first request it waits until the api is ready.
+    '''
     url_model: str
+    url_stream_model: str = STREAM_URL
+    url_register_prefix: str = REGISTER_PREFIX_URL
+    streaming: bool = config['client_streaming']
+    stop_on_complete_output: bool = True
+    pool_size: int = config['client_pool_size']
+    connect_timeout: float = config['client_connect_timeout']
+    read_timeout: float = config['client_read_timeout']
+    max_retries: int = config['client_max_retries']
+    backoff_factor: float = config['client_backoff_factor']
+    url_ready: str = READY_URL
+    wait_for_ready: bool = config['client_wait_for_ready']
+    ready_timeout: float = config['client_ready_timeout']
+    ready_poll_interval: float = config['client_ready_poll_interval']
+
+    _session: Optional[requests.Session] = PrivateAttr(default=None)
+    _ready: bool = PrivateAttr(default=False)
+    _ready_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _async_session: Optional[aiohttp.ClientSession] = PrivateAttr(default=None)
+    _async_loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
 
     @property
     def _llm_type(self) -> str:
@@ -28,6 +100,71 @@ class MPT_LLM(LLM):
         ''' Get the identifying parameters.'''
         return {"url_model": self.url_model}
 
+    @property
+    def session(self) -> requests.Session:
+        ''' Session with a pool of keep-alive connections and retries, created the first time it is needed. '''
+        if self._session is None:
+            retries = Retry(
+                total=self.max_retries,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=RETRY_STATUS_CODES,
+                allowed_methods=frozenset(['POST']),
+            )
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def wait_until_ready(self, timeout=None):
+        '''
+        Waits until the api is ready: the model is loaded and warmed up (see /ready in mpt_api.py). While the api is
+        starting (connection refused) or loading (503), it is checked again every ready_poll_interval seconds.
+        Returns the seconds waited. Raises TimeoutError after timeout seconds (ready_timeout by default) and
+        RuntimeError if the api failed to load the model. An api without readiness probe (404) is considered ready.
+        '''
+        timeout = self.ready_timeout if timeout is None else timeout
+        start = time.monotonic()
+        while True:
+            try:
+                response = self.session.get(self.url_ready, timeout=self.timeout)
+                if response.status_code in (200, 404):
+                    self._ready = True
+                    return time.monotonic() - start
+                if response.status_code == 503 and response.json().get('status') == 'failed':
+                    raise RuntimeError(f'The model api failed to load the model: {response.json().get("error")}')
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            if time.monotonic() - start >= timeout:
+                raise TimeoutError(f'The model api ({self.url_ready}) was not ready after {timeout} s')
+            time.sleep(self.ready_poll_interval)
+
+    def _ensure_ready(self):
+        ''' Waits for the api before the first request of this instance (if wait_for_ready is set). The concurrent calls wait together. '''
+        if self.wait_for_ready and not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    waited = self.wait_until_ready()
+                    if waited >= self.ready_poll_interval:
+                        print(f'Model api ready after waiting {waited:.0f} s')
+
+    def _request_data(self, prompt, temperature, top_p, top_k, max_new_tokens, stop):
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+
+        return {
+            'text': prompt,
+            'temperature': temperature,
+            'top_p': top_p,
+            'top_k': top_k,
+            'max_new_tokens': max_new_tokens,
+        }
+
     def _call(
         self,
         prompt:str,
@@ -35,26 +172,194 @@ class MPT_LLM(LLM):
         top_p:int=config['client_top_p'],
         top_k:int=config['client_top_k'],
         max_new_tokens:int=config['client_max_new_tokens'],
-        stop: Optional[List[str]] = None
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
     ):
         ''' 
         Function that defines what to do when the model is called for inference.
         In this case the function will call the api with the input prompt.
+        If streaming is enabled the response is received token by token (see _stream_call()).
+        Either way only the response is returned, without the prompt (see _response()).
         '''
-        if stop is not None:
-            raise ValueError("stop kwargs are not permitted.")
-            
-        data = {
-        'text': prompt,
-        'temperature': temperature, 
-        'top_p': top_p, 
-        'top_k': top_k, 
-        'max_new_tokens': max_new_tokens,
-        }
-        
-        headers = {'Content-type':'application/json', 'Accept':'application/json'}
-        response = requests.post(URL, data=json.dumps(data), headers=headers)
-        return response.json()['generated_text']
+        data = self._request_data(prompt, temperature, top_p, top_k, max_new_tokens, stop)
+        self._ensure_ready()
+        if self.streaming:
+            return self._stream_call(data, run_manager)
+
+        response = self.session.post(self.url_model, data=json.dumps(data), headers=HEADERS, timeout=self.timeout)
+        _call_state.retries = response_retries(response)
+        response.raise_for_status()
+        return self._response(strip_prompt(response.json()['generated_text']))
+
+    def _stream_call(self, data, run_manager=None):
+        '''
+        Calls the streaming endpoint of the api and receives the response (without the prompt) token by token.
+        Each new token is sent to the langchain callbacks. If stop_on_complete_output is set, the connection is closed
+        as soon as the kor output is complete, so the server stops generating tokens that would be discarded.
+        '''
+        headers = {'Content-type':'application/json', 'Accept':'text/plain'}
+        text = ''
+        with self.session.post(self.url_stream_model, data=json.dumps(data), headers=headers, timeout=self.timeout, stream=True) as response:
+            _call_state.retries = response_retries(response)
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                if not chunk:
+                    continue
+                text += chunk
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk)
+                if self.stop_on_complete_output:
+                    end = kor_output_end(text)
+                    if end is not None:
+                        text = text[:end]
+                        break
+        return text
+
+    def _response(self, text):
+        '''
+        Completion returned by the calls: the response without the prompt, cut where the kor output ends if
+        stop_on_complete_output is set, so the streamed and the non streamed calls return the same completions.
+        '''
+        if self.stop_on_complete_output:
+            end = kor_output_end(text)
+            if end is not None:
+                return text[:end]
+        return text
+
+    def call_retries(self):
+        ''' Number of retries of the last call made by the current thread. '''
+        return getattr(_call_state, 'retries', 0)
+
+    def register_prefix(self, prefix):
+        '''
+        Registers in the api the static beginning of the prompts (e.g. the kor instructions and examples), so the
+        model caches its state and does not encode it again in every request. Returns the number of tokens of the prefix.
+        '''
+        self._ensure_ready()
+        response = self.session.post(
+            self.url_register_prefix, data=json.dumps({'text': prefix}), headers=HEADERS, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()['prefix_tokens']
+
+    def _get_async_session(self) -> aiohttp.ClientSession:
+        ''' Async session with a pool of keep-alive connections. It is bound to the running event loop. '''
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._async_loop = loop
+        return self._async_session
+
+    async def _acall(
+        self,
+        prompt:str,
+        temperature:float=config['client_temperature'],
+        top_p:int=config['client_top_p'],
+        top_k:int=config['client_top_k'],
+        max_new_tokens:int=config['client_max_new_tokens'],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    ):
+        '''
+        Async version of _call(). The concurrent calls share the same pool of connections.
+        The failed requests (connection errors, timeouts and RETRY_STATUS_CODES) are retried with exponential backoff.
+        '''
+        data = self._request_data(prompt, temperature, top_p, top_k, max_new_tokens, stop)
+        if self.wait_for_ready and not self._ready:
+            await asyncio.get_running_loop().run_in_executor(None, self._ensure_ready)
+        session = self._get_async_session()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.post(self.url_model, data=json.dumps(data), headers=HEADERS) as response:
+                    if response.status in RETRY_STATUS_CODES and attempt < self.max_retries:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+                    response.raise_for_status()
+                    result = await response.json()
+                    _call_state.retries = attempt
+                    return self._response(strip_prompt(result['generated_text']))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def aclose(self):
+        ''' Closes the async pool of connections. '''
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+
+# Header of the kor outputs of a prompt (first example output) and numbered chunks of a batched prompt (see chunk_batching.py)
+KOR_OUTPUT_HEADER = re.compile(r'Output: ([^\n]+)')
+CHUNK_TAG_PATTERN = re.compile(r'^\[(\d+)\] ', re.M)
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+def synthetic_completion(prompt):
+    '''
+    Completion of a kor prompt built without a model: a CSV table with the measurements of the input text that the rules
+    can extract (see rule_extractor.py). The measurements of a batched prompt are tagged with the number of their chunk.
+    '''
+    header = KOR_OUTPUT_HEADER.search(prompt).group(1).strip()
+    columns = header.split('|')
+    text = prompt.rsplit('Input:', 1)[-1].rsplit('Output:', 1)[0].strip()
+    parts = CHUNK_TAG_PATTERN.split(text)
+    # A prompt without numbered chunks is a single chunk
+    chunks = list(zip(parts[1::2], parts[2::2])) if 'chunk' in columns and len(parts) > 1 else [('1', text)]
+    rows = [header]
+    for chunk, chunk_text in chunks:
+        measurements, _ = extract_measurements_rules(chunk_text)
+        for measurement in measurements:
+            measurement['chunk'] = chunk
+            rows.append('|'.join(measurement.get(column, '') for column in columns))
+    return ' ' + '\n'.join(rows) + '\n'
+
+class Replay_LLM(LLM):
+    '''
+    Stand-in for MPT_LLM that does not need a model, to test and benchmark the pipeline offline.
+    The completions are replayed from a jsonl file of recorded completions ({"prompt": ..., "completion": ...} per line)
+    if the prompt is there, and otherwise built from the prompt (see synthetic_completion()).
+    Each call waits latency seconds plus a uniform jitter of up to +-jitter seconds, like a model api would.
+    '''
+    completions_path: Optional[str] = None
+    latency: float = 0.0
+    jitter: float = 0.0
+    seed: int = 7
+
+    _completions: dict = PrivateAttr(default_factory=dict)
+    _random: random.Random = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._random = random.Random(self.seed)
+        if self.completions_path:
+            with open(self.completions_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self._completions[prompt_hash(record['prompt'])] = record['completion']
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {"completions_path": self.completions_path, "latency": self.latency, "jitter": self.jitter}
+
+    def _call(
+        self,
+        prompt:str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ):
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        completion = self._completions.get(prompt_hash(prompt))
+        return completion if completion is not None else synthetic_completion(prompt)
 
 def instruction_client(model):
     ''' 
@@ -0,0 +1,69 @@
+'''
+Script that dispatches the LLM queries concurrently while respecting the rate limits of the model API.
+Instead of waiting a fixed cooldown time after each query, several queries are kept in flight by a pool of threads
+and the pace is controlled by token buckets configured in requests per minute and tokens per minute.
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class TokenBucket:
+    '''
+    Thread safe token bucket. It is refilled continuously at rate_per_minute tokens per minute up to its capacity
+    (by default one minute worth of tokens). acquire() blocks until the requested tokens are available.
+    '''
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, amount=1):
+        ''' Takes amount tokens from the bucket, waiting until they are available. '''
+        # A request bigger than the bucket would wait forever, so it just waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+class RateLimiter:
+    ''' Rate limiter of an LLM API with a limit of requests per minute and a limit of tokens per minute. '''
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens):
+        ''' Waits until a request of the given number of tokens (prompt + completion) can be sent. '''
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+
+def estimate_tokens(text):
+    ''' Rough estimation of the number of tokens of a text (~4 characters per token in English). '''
+    return len(text) // 4 + 1
+
+def dispatch(function, jobs, workers):
+    '''
+    Calls function(job) for every job keeping up to workers calls in flight.
+    The rate limiter is acquired inside each call, right before the query (see MeasurementExtractor.query() in measurement_pipeline.py).
+    The results are returned in the same order as the jobs, whatever the order in which the calls finish.
+    '''
+    if workers <= 1:
+        return [function(job) for job in jobs]
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        return list(executor.map(function, jobs))
+    finally:
+        # If a call fails (or on Ctrl-C) the queued jobs are cancelled instead of being sent to the model
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,61 @@
+'''
+Script that load tests the model API (mpt_api.py) sending concurrent requests, like several extraction runs would do.
+It reports the generated tokens per second and the p50/p99 latency of the requests.
+To run it on CPU in a few seconds, create a tiny model with tiny_test_model.py, set api_model_path to its folder
+in config.py and launch mpt_api.py before running this script.
+'''
+
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from config import config
+from input_examples import inp_examples
+
+def percentile(values, percent):
+    ''' Percentile of a list of values (nearest rank). '''
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+def send_request(url, text, max_new_tokens):
+    ''' Sends a single request to the API and returns its latency (seconds) and the number of generated tokens. '''
+    data = {
+        'text': text,
+        'temperature': 0,
+        'top_p': 1,
+        'top_k': 0,
+        'max_new_tokens': max_new_tokens,
+    }
+    headers = {'Content-type':'application/json', 'Accept':'application/json'}
+    start = time.perf_counter()
+    response = requests.post(url, data=json.dumps(data), headers=headers)
+    latency = time.perf_counter() - start
+    response.raise_for_status()
+    return latency, response.json().get('generated_tokens', 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the model API.')
+    parser.add_argument('--url', default=config['server_url'], help='URL of the generate endpoint of the API.')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=64, help='Total number of requests.')
+    parser.add_argument('--max-new-tokens', type=int, default=32, help='Maximum tokens generated by each request.')
+    args = parser.parse_args()
+
+    texts = [inp_examples[i % len(inp_examples)] for i in range(args.requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        results = list(executor.map(lambda text: send_request(args.url, text, args.max_new_tokens), texts))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    generated_tokens = sum(tokens for _, tokens in results)
+    print(f'Requests: {args.requests} ({args.clients} concurrent clients) in {elapsed:.2f} s')
+    print(f'Throughput: {generated_tokens / elapsed:.1f} tokens/s, {args.requests / elapsed:.2f} requests/s')
+    print(f'Latency: p50 {percentile(latencies, 50) * 1000:.0f} ms, p99 {percentile(latencies, 99) * 1000:.0f} ms, '
+          f'mean {statistics.mean(latencies) * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
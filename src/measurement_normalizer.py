@@ -0,0 +1,226 @@
+'''
+Script that validates and normalises the extracted measurements of a whole result set at once with pandas.
+All the raw extractions are loaded into a table (one row per measurement) and the checks of the validation
+(value with a number, valid unit) are applied to whole columns with compiled regular expressions.
+The units are canonicalised (micrometers/microns/um -> μm) and the values (ranges like "between 20 and 40",
+"from 0.855 to 0.900", bounds like "less than 100" and tolerances like "6.3±0.3") are converted into numeric min/max columns.
+It does not need the LLM, so it can be re-run offline over the results of previous runs:
+python measurement_normalizer.py --input ../results/stored_results/results_extracted_patents.json
+'''
+
+import argparse
+import json
+import re
+import time
+import pandas as pd
+from config import config
+
+# Units that make a measurement invalid (see validate_llm_output())
+INVALID_UNITS = ['N/A', 'unitless', '', 'NA', 'not specified', '-']
+MEASUREMENT_COLUMNS = ['element', 'property', 'value', 'unit']
+
+# Canonical unit -> written forms (compared in lowercase, without surrounding spaces and final dots)
+UNIT_ALIASES = {
+    'nm': ['nm', 'nanometer', 'nanometers', 'nanometre', 'nanometres'],
+    'μm': ['μm', 'µm', 'um', 'micrometer', 'micrometers', 'micrometre', 'micrometres', 'micron', 'microns'],
+    'mm': ['mm', 'millimeter', 'millimeters', 'millimetre', 'millimetres'],
+    'cm': ['cm', 'centimeter', 'centimeters', 'centimetre', 'centimetres'],
+    'm': ['m', 'meter', 'meters', 'metre', 'metres'],
+    'Å': ['å', 'Å', 'angstrom', 'angstroms'],
+    'in': ['in', 'inch', 'inches'],
+    'ft': ['ft', 'foot', 'feet'],
+    'cm²': ['cm2', 'cm²', 'square centimeter', 'square centimeters'],
+    'in²': ['in2', 'in²', 'square inch', 'square inches'],
+    'g/cm³': ['g/cc', 'g/cm3', 'g/cm³', 'g/cm^3', 'grams per cubic centimeter'],
+    'g': ['g', 'gram', 'grams'],
+    'mg': ['mg', 'milligram', 'milligrams'],
+    'μg': ['μg', 'µg', 'ug', 'microgram', 'micrograms'],
+    'kg': ['kg', 'kilogram', 'kilograms'],
+    'mg/kg': ['mg/kg', 'mg per kg', 'milligrams per kilogram'],
+    'mg/mL': ['mg/ml', 'mg per ml', 'milligrams per milliliter'],
+    'μg/mL': ['μg/ml', 'µg/ml', 'ug/ml', 'micrograms per milliliter'],
+    'g/L': ['g/l', 'grams per liter'],
+    'mL': ['ml', 'milliliter', 'milliliters', 'millilitre', 'millilitres'],
+    'L': ['l', 'liter', 'liters', 'litre', 'litres'],
+    'M': ['molar', 'mol/l'],
+    'mM': ['millimolar', 'mmol/l'],
+    'μM': ['micromolar', 'μmol/l'],
+    'nM': ['nanomolar', 'nmol/l'],
+    '°C': ['°c', '° c', 'degrees c', 'degrees celsius', 'degree celsius', 'celsius', 'deg c'],
+    '°F': ['°f', '° f', 'degrees f', 'degrees fahrenheit', 'fahrenheit'],
+    '°': ['°', 'degree', 'degrees'],
+    'K': ['k', 'kelvin'],
+    '%': ['%', 'percent', 'percentage', '% (percentage)', 'per cent'],
+    'wt%': ['wt%', 'wt %', 'wt.%', 'wt. %', 'wt-%', '% by weight', 'weight percent', 'percent by weight', '% w/w'],
+    'vol%': ['vol%', 'vol %', 'vol.%', 'vol.-%', '% by volume', 'volume percent', '% v/v'],
+    'Pa': ['pa', 'pascal', 'pascals', 'pascals (pa)'],
+    'kPa': ['kpa', 'kilopascal', 'kilopascals'],
+    'MPa': ['mpa', 'megapascal', 'megapascals'],
+    'GPa': ['gpa', 'gigapascal', 'gigapascals'],
+    'psi': ['psi', 'pounds per square inch'],
+    'mmHg': ['mmhg', 'mm hg', 'millimeters of mercury'],
+    'cP': ['cp', 'centipoise', 'mpa·s', 'mpa s', 'mpas', 'mpa.s'],
+    's': ['s', 'sec', 'second', 'seconds'],
+    'min': ['min', 'mins', 'minute', 'minutes'],
+    'h': ['h', 'hr', 'hrs', 'hour', 'hours'],
+    'day': ['day', 'days', 'd'],
+    'week': ['week', 'weeks', 'wk', 'wks'],
+    'month': ['month', 'months'],
+    'year': ['year', 'years', 'yr', 'yrs'],
+    'V': ['v', 'volt', 'volts'],
+    'mV': ['mv', 'millivolt', 'millivolts'],
+    'A': ['a', 'amp', 'amps', 'ampere', 'amperes'],
+    'mA': ['ma', 'milliamp', 'milliamps', 'milliampere', 'milliamperes', 'milliamps (ma)'],
+    'μA': ['μa', 'µa', 'ua', 'microamp', 'microamps', 'microampere', 'microamperes'],
+    'W': ['w', 'watt', 'watts'],
+    'Hz': ['hz', 'hertz'],
+    'kHz': ['khz', 'kilohertz'],
+    'MHz': ['mhz', 'megahertz'],
+    'bpm': ['bpm', 'beats per minute', 'beats per minute (bpm)'],
+    'rpm': ['rpm', 'revolutions per minute'],
+    'ppm': ['ppm', 'parts per million'],
+}
+# Units whose symbol is case sensitive. The lowercase lookup would mix them (M/m, MPa/mPa...), so they are matched exactly first
+CASE_SENSITIVE_UNITS = {
+    'M': 'M', 'mM': 'mM', 'μM': 'μM', 'µM': 'μM', 'uM': 'μM', 'nM': 'nM', 'm': 'm', 'MPa': 'MPa', 'mPa': 'mPa',
+    'mA': 'mA', 'MA': 'MA', 'K': 'K', 'k': 'k', 'mHz': 'mHz', 'MHz': 'MHz', 'mm': 'mm', 'Mm': 'Mm', 'mV': 'mV', 'MV': 'MV',
+    'mPa·s': 'cP', 'mPas': 'cP', 'mPa s': 'cP', 'mPa.s': 'cP',
+}
+UNIT_LOOKUP = {alias: canonical for canonical, aliases in UNIT_ALIASES.items() for alias in aliases}
+
+# Numbers of a value: thousands separators are removed first. A minus sign is only a sign if it is not between digits (20-40).
+# The scientific notation (1 x 10-5, 5×10^3, 2×10⁻⁴, 1.5e-3) gives the mantissa and the exponent of a single number.
+# The exponent after "x 10" needs a ^, a sign or superscript digits, so dimensions like "5 x 100" are two numbers
+SUPERSCRIPT_DIGITS = str.maketrans('⁰¹²³⁴⁵⁶⁷⁸⁹⁻⁺', '0123456789-+')
+NUMBER_PATTERN = (
+    r'(?P<mantissa>(?:(?<![\w.])-)?\d+(?:\.\d+)?)'
+    r'(?:\s*[x×*]\s*10\s*(?:(?:\^|\*\*)\s*\(?(?P<power>[-−+]?\d+)\)?|(?P<signed_power>[-−]\d+)|(?P<superscript_power>[⁻⁺]?[⁰¹²³⁴⁵⁶⁷⁸⁹]+))'
+    r'|[eE](?P<e_power>[-−+]?\d+))?(?![\d⁰¹²³⁴⁵⁶⁷⁸⁹])'
+)
+# What is left of a value after removing its numbers that means it had a number in a form that is not parsed (10^x, 10 to the 5th...)
+UNPARSED_NUMBER_PATTERN = r'\^|\*\*|[⁰¹²³⁴⁵⁶⁷⁸⁹]|\b10\s+to\s+the\b'
+THOUSANDS_SEPARATOR_PATTERN = r'(?<=\d),(?=\d{3}(?!\d))'
+TOLERANCE_PATTERN = r'(?P<center>\d+(?:\.\d+)?)\s*(?:±|\+/-|\+-)\s*(?P<tolerance>\d+(?:\.\d+)?)'
+# Values that are only an upper or a lower bound
+UPPER_BOUND_PATTERN = r'^\s*(?:less than|lower than|smaller than|below|under|up to|at most|no more than|not more than|not exceeding|maximum of|max\.?|<|≤|=<)'
+LOWER_BOUND_PATTERN = r'^\s*(?:more than|greater than|higher than|larger than|above|over|at least|no less than|not less than|minimum of|min\.?|>|≥|>=)'
+
+def validate_llm_output(llm_output):
+    ''' 
+    Function that validates the LLM outputs.
+    Basically we are checking that the results as we would check any user input.
+    Value must contain a number and unit must not be unitless, NA or similar
+    '''
+    validated_results = []
+    
+    for lo in llm_output:
+        if ('value' in lo) and ('unit' in lo):
+            valid_flag = True
+            # value
+            # check if value contains a number
+            if not re.search(r"\d+", lo['value']):
+                valid_flag = False
+                
+            # unit
+            if lo['unit'] in INVALID_UNITS:
+                valid_flag = False
+
+            if valid_flag:
+                validated_results.append(lo)
+    return validated_results
+
+def extractions_to_frame(extraction_results, field='extraction'):
+    '''
+    Table with a row per measurement of a result set (resulting object of first_approach.py).
+    field is 'extraction' for the raw LLM measurements or 'validated' for the validated ones.
+    The unparseable extractions (dicts instead of lists) are skipped.
+    '''
+    rows = []
+    for patent in extraction_results['patents']:
+        for chunk_idx, ep in enumerate(patent['elements_processed']):
+            measurements = ep.get(field, [])
+            if not isinstance(measurements, list):
+                continue
+            for measurement in measurements:
+                if isinstance(measurement, dict):
+                    rows.append((patent['doc_id'], patent['data_section'], chunk_idx, *(measurement.get(column) for column in MEASUREMENT_COLUMNS)))
+    frame = pd.DataFrame(rows, columns=['doc_id', 'data_section', 'chunk_idx'] + MEASUREMENT_COLUMNS)
+    return frame.astype({column: 'string' for column in MEASUREMENT_COLUMNS})
+
+def validate_frame(frame):
+    ''' Boolean mask of the valid measurements: the value contains a number and the unit is not unitless, NA or similar. '''
+    has_number = frame['value'].str.contains(r'\d', regex=True).fillna(False)
+    valid_unit = frame['unit'].notna() & ~frame['unit'].isin(INVALID_UNITS)
+    return (has_number & valid_unit).astype(bool)
+
+def canonical_units(units):
+    ''' Canonical form of a column of units. The units that are not in the lexicon are kept (without surrounding spaces). '''
+    stripped = units.str.strip()
+    exact = stripped.map(CASE_SENSITIVE_UNITS)
+    lowercase = stripped.str.lower().str.rstrip('.').str.strip().map(UNIT_LOOKUP)
+    return exact.fillna(lowercase).fillna(stripped).astype('string')
+
+def value_ranges(values):
+    '''
+    Numeric min/max columns of a column of values. A range or a list of numbers gives its smallest and biggest numbers,
+    a single number gives the same min and max, a tolerance (6.3±0.3) gives center-tolerance and center+tolerance,
+    and an upper (lower) bound like "less than 100" ("at least 90") leaves the min (max) empty.
+    The numbers in scientific notation (1 x 10-5, 5×10^3, 1.5e-3) are converted into a single float, and the values
+    with numbers in a form that is not parsed (10^x...) get an empty min and max.
+    '''
+    clean = values.str.replace(THOUSANDS_SEPARATOR_PATTERN, '', regex=True)
+    parts = clean.str.extractall(NUMBER_PATTERN)
+    powers = parts['power'].fillna(parts['signed_power']).fillna(parts['superscript_power'].str.translate(SUPERSCRIPT_DIGITS))
+    powers = powers.fillna(parts['e_power']).fillna('0').str.replace('−', '-', regex=False)
+    numbers = parts['mantissa'].astype(float) * 10.0 ** powers.astype(int)
+    ranges = pd.DataFrame({
+        'value_min': numbers.groupby(level=0).min(),
+        'value_max': numbers.groupby(level=0).max(),
+    }).reindex(values.index)
+
+    tolerances = clean.str.extract(TOLERANCE_PATTERN).astype(float)
+    with_tolerance = tolerances['center'].notna()
+    ranges.loc[with_tolerance, 'value_min'] = tolerances['center'] - tolerances['tolerance']
+    ranges.loc[with_tolerance, 'value_max'] = tolerances['center'] + tolerances['tolerance']
+
+    upper_bound = clean.str.contains(UPPER_BOUND_PATTERN, case=False, regex=True).fillna(False).astype(bool)
+    lower_bound = clean.str.contains(LOWER_BOUND_PATTERN, case=False, regex=True).fillna(False).astype(bool)
+    ranges.loc[upper_bound, 'value_min'] = float('nan')
+    ranges.loc[lower_bound, 'value_max'] = float('nan')
+
+    # The values with a number that could not be parsed get no min/max instead of wrong ones
+    unparsed = clean.str.replace(NUMBER_PATTERN, ' ', regex=True).str.contains(UNPARSED_NUMBER_PATTERN, regex=True).fillna(False).astype(bool)
+    ranges.loc[unparsed, ['value_min', 'value_max']] = float('nan')
+    return ranges
+
+def normalize_frame(frame):
+    ''' Adds the valid flag, the canonical unit and the numeric min/max of the values to a measurements table. '''
+    frame = frame.copy()
+    frame['valid'] = validate_frame(frame)
+    frame['unit_canonical'] = canonical_units(frame['unit'])
+    frame[['value_min', 'value_max']] = value_ranges(frame['value'])
+    return frame
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate and normalise the measurements of a result set offline.')
+    parser.add_argument('--input', default=config['output_extracted_pantents_json'], help='Result set of first_approach.py (json format).')
+    parser.add_argument('--output', default=config['output_normalized_measurements_csv'], help='CSV file with the normalised measurements.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.input, 'r', encoding='utf-8') as f:
+        extraction_results = json.load(f)
+    loaded = time.perf_counter()
+    frame = normalize_frame(extractions_to_frame(extraction_results))
+    normalized = time.perf_counter()
+    frame.to_csv(args.output, index=False)
+
+    valid = frame[frame['valid']]
+    with_number = (valid['value_min'].notna() | valid['value_max'].notna()).sum()
+    print(f'Measurements: {len(frame)}, valid: {len(valid)}, valid with numeric min/max: {with_number}')
+    print(f'Distinct units of the valid measurements: {valid["unit"].str.strip().nunique()} written, {valid["unit_canonical"].nunique()} canonical')
+    print(f'Load: {(loaded - start) * 1000:.1f} ms, validation and normalisation: {(normalized - loaded) * 1000:.1f} ms')
+    print(f'Normalised measurements saved in {args.output}')
+
+if __name__ == '__main__':
+    main()
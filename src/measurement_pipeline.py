@@ -0,0 +1,288 @@
+'''
+Script that exposes the steps of the measurement extraction pipeline as functions and classes, so they can be reused
+by other scripts or by a long running worker without running first_approach.py:
+- parser: parse_patent_file() in data_parser.py yields the parsed patents of a weekly XML file.
+- sampler: load_patents() loads a sample of the processed patents (see patent_store.py).
+- chunker: MeasurementExtractor.text_splitter() splits the sections into chunks that fit in the prompt.
+- extractor: MeasurementExtractor builds the model, the kor chains, the cache of completions and the rate limiter once,
+  and extract() / extract_batch() reuse them for every chunk.
+- validator: validate_llm_output() in measurement_normalizer.py.
+The heavy libraries (langchain, kor, the OpenAI client, pandas and the tokenizers) are only imported when they are
+needed, so importing this module is fast.
+'''
+
+import json
+import random
+import time
+from config import config
+from llm_dispatch import RateLimiter, estimate_tokens
+from measurement_prefilter import chunk_filer, has_measurement_candidate, trim_to_candidate_sentences
+
+# Text that marks where the text of the chunk goes in a prompt, to find its static prefix (instructions and examples)
+PROMPT_TEXT_MARKER = '<<PATENT_TEXT>>'
+
+def load_patents(sample_num=None, seed=None, required_section=None):
+    '''
+    Loads a random sample of sample_num processed patents (all of them if it is 0), by default the ones of config.py.
+    With the jsonl format only the sampled patents are read (see patent_store.py).
+    '''
+    sample_num = config['sample_patents_num'] if sample_num is None else sample_num
+    seed = config['data_selection_seed'] if seed is None else seed
+    required_section = config['data_selection_required_section'] if required_section is None else required_section
+    if config['output_processed_format'] == 'jsonl':
+        from patent_store import sample_patents
+        return sample_patents(
+            config['output_processed_pantents_jsonl'],
+            sample_num,
+            seed,
+            method=config['data_selection_sampling'],
+            required_section=required_section,
+        )
+
+    with open(config['output_processed_pantents_json'], 'r', encoding='utf-8') as f:
+        patents = json.load(f)['patents']
+    if required_section:
+        patents = [p for p in patents if p[required_section]]
+    # Stablish a seed --> Important for code reproducibility
+    random.seed(a=seed)
+    if sample_num > 0:
+        patents = random.sample(patents, sample_num)
+    return patents
+
+def load_llm():
+    ''' Model used to extract the measurements (OpenAI, the stand-in of the model api or the MPT api) and its parameters. '''
+    if config['use_open_ai']:
+        from langchain.chat_models import ChatOpenAI
+        try:
+            from secret import open_ai_key
+        except ImportError:
+            raise Exception(
+                "src/secret.py not found. Make sure that you have created the following file: src/secret.py with your api_key in a variable called open_ai_key."
+                "You can also rename the file src/secret_template.py into src/secret.py "
+            )
+        model_params = {
+            'model_name': "gpt-3.5-turbo", # Cheaper but less reliable
+            'temperature': config['gpt_temperature'], #0,
+            'max_tokens': config['gpt_max_tokens'], #2000,
+            'frequency_penalty': config['gpt_frequency_penalty'], #0,
+            'presence_penalty': config['gpt_presence_penalty'], #0,
+        }
+        return ChatOpenAI(**model_params, openai_api_key=open_ai_key), model_params
+
+    if config['client_replay_llm']:
+        # Offline stand-in of the model api, with the latency of a real one (see Replay_LLM in llm_custom_wrapper.py)
+        from llm_custom_wrapper import Replay_LLM
+        model = Replay_LLM(
+            completions_path=config['replay_completions_path'], latency=config['replay_latency'], jitter=config['replay_jitter']
+        )
+        model_params = {
+            'model_name': config['api_model_path'],
+            'replay_completions_path': config['replay_completions_path'],
+        }
+        return model, model_params
+
+    from llm_custom_wrapper import MPT_LLM
+    model = MPT_LLM(url_model=config['server_url'])
+    model_params = {
+        'model_name': config['api_model_path'],
+        'url_model': config['server_url'],
+        'temperature': config['client_temperature'],
+        'top_p': config['client_top_p'],
+        'top_k': config['client_top_k'],
+        'max_new_tokens': config['client_max_new_tokens'],
+    }
+    return model, model_params
+
+def build_chains(model, chunks_per_call):
+    '''
+    kor chains of the extraction: the template prompt with the examples (see prompts.py) and the parser of the LLM results.
+    With chunks_per_call > 1 there is also a chain that extracts several numbered chunks in a single call (see chunk_batching.py).
+    '''
+    from kor import from_pydantic
+    from kor.extraction import create_extraction_chain
+    from prompts import Patent_measurements, Patent_chunk_measurements, patent_examples
+    from chunk_batching import batch_examples
+
+    patent_schema, _ = from_pydantic(
+        Patent_measurements,
+        description="Identifies and extracts measurements, including measure elements, attributes, values, and units, from documents.",
+        examples=patent_examples,
+        many=True,
+    )
+    chain = create_extraction_chain(model, patent_schema)
+    batch_chain = None
+    if chunks_per_call > 1:
+        # Each measurement is tagged with the number of its chunk and the examples are numbered in the same way
+        batch_schema, _ = from_pydantic(
+            Patent_chunk_measurements,
+            description="Identifies and extracts measurements, including measure elements, attributes, values, and units, from documents made of numbered text chunks.",
+            examples=batch_examples(patent_examples, config['llm_batch_examples_chunks']),
+            many=True,
+        )
+        batch_chain = create_extraction_chain(model, batch_schema)
+    return chain, batch_chain
+
+def prefilter_chunk(text):
+    '''
+    Decides if a chunk is sent to the LLM. With the 'measurements' prefilter only the chunks with a number followed
+    by a unit are sent (see measurement_prefilter.py). With the 'digits' prefilter any chunk with a number is sent (see chunk_filer()).
+    '''
+    if config['chunk_prefilter'] == 'measurements':
+        return has_measurement_candidate(text)
+    return chunk_filer(text)
+
+def llm_input_text(text):
+    ''' Text of a chunk that is sent to the LLM. Optionally only the sentences with measurement candidates are kept. '''
+    if config['prefilter_trim_sentences']:
+        return trim_to_candidate_sentences(text, config['prefilter_context_sentences'])
+    return text
+
+class MeasurementExtractor:
+    '''
+    Extracts the measurements of text chunks with a LLM. The model (load_llm() by default), the kor chains, the cache of
+    completions and the rate limiter are built once, so a worker can keep an extractor and call extract() for every
+    chunk it receives. extract() and extract_batch() can be called from several threads at once.
+    If a RunTelemetry is given (see run_telemetry.py), the tokens and the cost of each call are recorded in it.
+    '''
+    def __init__(self, model=None, model_params=None, telemetry=None):
+        if model is None:
+            model, model_params = load_llm()
+        self.model = model
+        self.model_params = model_params
+        self.telemetry = telemetry
+        self.chain, self.batch_chain = build_chains(model, config['llm_chunks_per_call'])
+
+        # The completions are stored by prompt and model parameters (see llm_cache.py)
+        self.llm_cache = None
+        if config['use_llm_cache']:
+            from llm_cache import LLMCache
+            self.llm_cache = LLMCache(config['llm_cache_path'], model_params, config['llm_cache_max_size_mb'])
+        # Rate limiter of the model API. It replaces the fixed cooldown time after each query
+        self.rate_limiter = RateLimiter(config['rate_limit_requests_per_min'], config['rate_limit_tokens_per_min'])
+
+        self.completion_max_tokens = config['gpt_max_tokens'] if config['use_open_ai'] else config['client_max_new_tokens']
+        self.context_tokens = config['gpt_context_tokens'] if config['use_open_ai'] else config['mpt_context_tokens']
+        # The stand-in of the model api runs offline, where the tokenizer of the model may not be available
+        replay_model = getattr(model, '_llm_type', None) == 'replay' and not config['client_tokenizer_path']
+        if (config['text_chunk_method'] == 'tokens' or self.batch_chain is not None) and not replay_model:
+            from token_chunker import load_token_counter
+            self.count_tokens = load_token_counter(config['use_open_ai'], config['client_tokenizer_path'] or model_params['model_name'])
+        else:
+            # Rough estimation, used to account the tokens of the calls (see run_telemetry.py) and to measure the chunks with the stand-in
+            self.count_tokens = estimate_tokens
+
+        if config['client_register_prompt_prefix'] and hasattr(model, 'register_prefix'):
+            self.register_prompt_prefixes()
+
+    def register_prompt_prefixes(self):
+        '''
+        Registers the static part of the prompts (kor instructions and examples) in the MPT api, so the state of the model
+        after reading it is cached and only the text of each chunk is encoded (see PrefixCache in mpt_api.py).
+        '''
+        import requests
+        for extraction_chain in (self.chain, self.batch_chain):
+            if extraction_chain is None:
+                continue
+            prompt_prefix = extraction_chain.prompt.format_prompt(text=PROMPT_TEXT_MARKER).to_string().split(PROMPT_TEXT_MARKER)[0]
+            try:
+                print(f'Prompt prefix registered in the model api: {self.model.register_prefix(prompt_prefix)} tokens')
+            except requests.RequestException as e:
+                print(f'The prompt prefix could not be registered in the model api, every prompt will be fully encoded: {e}')
+                break
+
+    def prompt_tokens(self, extraction_chain=None):
+        ''' Tokens of the rendered prompt of a chain (instructions and examples) without text. The normal chain by default. '''
+        extraction_chain = extraction_chain or self.chain
+        return self.count_tokens(extraction_chain.prompt.format_prompt(text='').to_string())
+
+    def token_budget(self, extraction_chain=None):
+        ''' Tokens of the context window left for the text by the rendered prompt of a chain and the completion. '''
+        return self.context_tokens - self.prompt_tokens(extraction_chain) - self.completion_max_tokens - config['text_chunk_token_margin']
+
+    def text_splitter(self):
+        '''
+        Splitter of the texts into chunks. With the 'tokens' method the chunks are measured with the tokenizer of the
+        model and filled up to the token budget (see token_chunker.py), otherwise they have text_chunk_size characters.
+        '''
+        if config['text_chunk_method'] == 'tokens':
+            from token_chunker import TokenChunker
+            return TokenChunker(self.count_tokens, self.token_budget())
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        return RecursiveCharacterTextSplitter(chunk_size = config['text_chunk_size'])
+
+    def query(self, extraction_chain, text, metrics):
+        '''
+        Calls the LLM with a chain (template prompt with examples and parser) and returns the parsed data.
+        If the prompt is in the cache the stored completion is used, without querying the LLM nor waiting for the rate limiter.
+        The metrics of the call (cache hit, rate limit wait, LLM and parse time, retries, tokens and cost) are saved in metrics.
+        '''
+        prompt = extraction_chain.prompt.format_prompt(text=text).to_string()
+        completion = self.llm_cache.get(prompt) if self.llm_cache else None
+        metrics['cache_hit'] = completion is not None
+        start = time.perf_counter()
+        if completion is None:
+            self.rate_limiter.acquire(estimate_tokens(prompt) + self.completion_max_tokens)
+            metrics['rate_limit_wait_seconds'] = time.perf_counter() - start
+            start = time.perf_counter()
+            completion = extraction_chain.predict(text=text)
+            metrics['retries'] = self.model.call_retries() if hasattr(self.model, 'call_retries') else 0
+            if self.llm_cache:
+                self.llm_cache.put(prompt, completion)
+        parse_start = time.perf_counter()
+        metrics['llm_seconds'] = parse_start - start
+        data = extraction_chain.prompt.output_parser.parse(completion)['data']
+        metrics['parse_seconds'] = time.perf_counter() - parse_start
+        if self.telemetry is not None:
+            self.telemetry.record_call(metrics, self.count_tokens(prompt), self.count_tokens(completion))
+        return data
+
+    def extract(self, text, metrics=None):
+        '''
+        Extracts the measurements of a single text chunk (see query()).
+        Returns the raw results and the validated ones (see validate_llm_output()).
+        '''
+        from measurement_normalizer import validate_llm_output
+        metrics = {} if metrics is None else metrics
+        validated_data = []
+        result = self.query(self.chain, llm_input_text(text), metrics)
+        if 'patent_measurements' in result:
+            # If the model has outputted something meaningful store the raw results and the validated ones
+            result = result['patent_measurements']
+            start = time.perf_counter()
+            validated_data = validate_llm_output(result)
+            metrics['validate_seconds'] = time.perf_counter() - start
+        else:
+            # Sometimes the model response contains some unparseable elements
+            # for example 5 measure attributes when we are expecting 4.
+            # Mostly the unparseable elements are empty dicts because there was nothing to extract.
+            # We could test and explore when and why this happens more carefully.
+            print(result)
+        return result, validated_data
+
+    def extract_batch(self, texts, metrics=None):
+        '''
+        Extracts the measurements of several chunks in a single LLM call with the batch chain (see chunk_batching.py).
+        The measurements are split by their chunk number. Returns the raw results and the validated ones of each chunk.
+        A single chunk is extracted with the normal chain (see extract()).
+        '''
+        from measurement_normalizer import validate_llm_output
+        from chunk_batching import demultiplex, format_chunk_batch
+        metrics = {} if metrics is None else metrics
+        if len(texts) == 1:
+            return [self.extract(texts[0], metrics)]
+        if self.batch_chain is None:
+            raise ValueError('The extractor has no batch chain. Set llm_chunks_per_call > 1 to extract several chunks per call')
+        result = self.query(self.batch_chain, format_chunk_batch([llm_input_text(text) for text in texts]), metrics)
+        if 'patent_chunk_measurements' in result:
+            chunks_results = demultiplex(result['patent_chunk_measurements'], len(texts))
+        else:
+            # Unparseable response (see extract())
+            print(result)
+            chunks_results = [result] * len(texts)
+        start = time.perf_counter()
+        results = [
+            (chunk_result, validate_llm_output(chunk_result) if isinstance(chunk_result, list) else [])
+            for chunk_result in chunks_results
+        ]
+        metrics['validate_seconds'] = time.perf_counter() - start
+        return results
@@ -0,0 +1,98 @@
+'''
+Script that defines a local prefilter of the text chunks before they are sent to the LLM.
+Instead of sending every chunk that contains a digit (figure references, claim numbers, patent numbers and dates
+contain digits too), a chunk is only sent if it contains a measurement candidate: a number followed by a unit
+of the unit lexicon (nm, μm, g/cc, ° C., MPa, wt %...). The lexicon and the references are compiled into regular expressions once.
+The chunks can also be trimmed down to the sentences that contain candidates, so the prompts are shorter.
+'''
+
+import re
+from token_chunker import split_sentences
+
+# Units written with symbols. They are case sensitive (e.g. M is molar and m is meter) and can be attached to the number (10nm)
+SI_PREFIXES = ['', 'k', 'M', 'G', 'm', 'μ', 'µ', 'u', 'n', 'p', 'c', 'd']
+SI_UNITS = ['m', 'g', 'L', 'l', 's', 'Pa', 'V', 'A', 'W', 'J', 'Hz', 'M', 'mol', 'Ω', 'F', 'H', 'S', 'T', 'Wh', 'Ah', 'eV', 'N', 'C']
+SYMBOL_UNITS = [prefix + unit for prefix in SI_PREFIXES for unit in SI_UNITS] + [
+    '%', 'wt %', 'wt%', 'wt.%', 'wt. %', 'wt-%', 'vol %', 'vol%', 'vol.%', 'vol.-%', 'mol %', 'mol%', 'at %', 'at%',
+    # Angstrom is written with two different characters
+    '° C', '°C', '° F', '°F', '° K', 'K', '°', '\u00c5', '\u212b', 'VAC', 'VDC', 'Vrms', 'Vpp', 'ppm', 'ppb', 'ppt', 'psi', 'psig', 'psia', 'mmHg', 'atm', 'bar', 'mbar', 'Torr',
+    'cP', 'mPas', 'mPa·s', 'mPa s', 'Pa·s', 'dB', 'dBm', 'rpm', 'bpm', 'IU', 'EU', 'U', 'Da', 'kDa', 'cc', 'sccm', 'slm',
+    'mAh', 'kWh', 'MWh', 'VA', 'kVA', 'lm', 'cd', 'lx', 'Gy', 'Sv', 'Bq', 'mOsm', 'dpi', 'ppi',
+    'in', 'ft', 'yd', 'mi', 'lb', 'lbs', 'oz', 'gal', 'mph', 'BTU', 'B.T.U.', 'cal', 'kcal', 'h', 'hr', 'hrs', 'min', 'sec',
+    'cm2', 'cm3', 'mm2', 'mm3', 'm2', 'm3', 'cm²', 'cm³', 'mm²', 'mm³', 'm²', 'm³', 'μm2', 'nm2',
+]
+# Symbols that are also words or letters of reference numerals (the housing 12 in the frame, the wall 14 A and the wall 14 B).
+# They are only units when they are attached to the number (12in, 5h) or followed by punctuation or the end of the text (5 h.)
+AMBIGUOUS_SYMBOL_UNITS = ['in', 'h', 'A', 'C', 'K', 'U']
+# Units written with words. They are case insensitive and must be separated from the number
+WORD_UNITS = [
+    'percent', 'percentage', 'degrees?', 'kelvin', 'celsius', 'fahrenheit',
+    '(?:kilo|centi|milli|micro|nano|pico)?(?:meters?|metres?|grams?|liters?|litres?|seconds?|amps?|amperes?|volts?|watts?|joules?|pascals?|moles?|molar|ohms?|hertz)',
+    'inch(?:es)?', 'feet', 'foot', 'yards?', 'miles?', 'pounds?', 'ounces?', 'gallons?', 'tons?', 'tonnes?',
+    'minutes?', 'hours?', 'days?', 'weeks?', 'months?', 'years?', 'cycles?', 'times', 'fold', 'mesh',
+    'calories', 'kilocalories', 'atmospheres?', 'torr', 'bars?', 'centipoise', 'poise', 'decibels?', 'rpm', 'revolutions',
+    'microns?', 'mils?', 'angstroms?', 'units?', 'parts per (?:million|billion)', 'beats per minute', 'gauge', 'carats?',
+]
+
+# Words allowed between the number and a word unit (21 consecutive days, 100 square inches)
+UNIT_MODIFIERS = ['square', 'sq.', 'cubic', 'cu.', 'linear', 'consecutive', 'additional', 'total']
+# Currencies written before the number ($2,400)
+CURRENCIES = '$€£¥'
+
+# Numbers (integers, decimals, thousands separators, scientific notation) optionally as a range (10-20, 10 to 20, between 10 and 20)
+NUMBER = r'\d+(?:[.,]\d+)*(?:\s*[x×]\s*10\s*[-−]?\d+|[eE][-−]?\d+)?'
+NUMBER_RANGE = NUMBER + r'(?:\s*(?:-|–|to|and|or)\s*' + NUMBER + r')?'
+SYMBOL_UNITS_PATTERN = '|'.join(re.escape(unit) for unit in sorted(set(SYMBOL_UNITS), key=len, reverse=True))
+UNAMBIGUOUS_SYMBOL_UNITS_PATTERN = '|'.join(
+    re.escape(unit) for unit in sorted(set(SYMBOL_UNITS) - set(AMBIGUOUS_SYMBOL_UNITS), key=len, reverse=True)
+)
+AMBIGUOUS_SYMBOL_UNITS_PATTERN = '|'.join(AMBIGUOUS_SYMBOL_UNITS)
+WORD_UNITS_PATTERN = '|'.join(WORD_UNITS)
+MEASUREMENT_CANDIDATE = re.compile(
+    r'(?<![\w.])' + NUMBER_RANGE
+    + r'(?:(?:\s?(?:' + UNAMBIGUOUS_SYMBOL_UNITS_PATTERN + r')|(?:' + AMBIGUOUS_SYMBOL_UNITS_PATTERN + r')'
+    + r'|\s(?:' + AMBIGUOUS_SYMBOL_UNITS_PATTERN + r')(?=[.,;:)\]/]|\s*$))'
+    + r'(?:\s?/\s?(?:' + SYMBOL_UNITS_PATTERN + r'))*(?![A-Za-z0-9])'
+    + r'|\s(?i:(?:(?:' + '|'.join(re.escape(modifier) for modifier in UNIT_MODIFIERS) + r')\s)?(?:' + WORD_UNITS_PATTERN + r')'
+    + r'(?:\sper\s(?:' + WORD_UNITS_PATTERN + r'))?)\b)'
+    + r'|[' + re.escape(CURRENCIES) + r']\s?' + NUMBER
+)
+# Numbers that are references and not measurements: figures, claims, examples, tables, patent and sequence numbers
+REFERENCE = re.compile(
+    r'\b(?:FIGS?\.|Figs?\.|Figures?|FIGURES?|claims?|Claims?|Examples?|EXAMPLES?|Tables?|TABLES?|Nos?\.|Ser\.|Pat\.|'
+    r'SEQ ID NOs?:?|Formula|Steps?|steps?|Embodiments?)\s*\(?\d+[A-Za-z]?\)?(?:\s*(?:,|and|to|-|through)\s*\d+[A-Za-z]?)*'
+)
+
+def mask_references(text):
+    ''' Replaces the references (FIG. 3, claim 1...) with spaces. The positions of the rest of the text do not change. '''
+    return REFERENCE.sub(lambda match: ' ' * len(match.group()), text)
+
+def chunk_filer(text):
+    ''' 
+    This function aims to optimize API calls to the LLM by filtering out chunks that do not contain numbers. 
+    We are implementing a basic and straightforward filtering approach where chunks without numbers are excluded. 
+    Our assumption is that every measurement always includes a number.
+    For a more profesional environment this filtering should be more complete.
+    '''
+    flag = bool(re.search(r"\d+", text))
+    return flag
+
+def find_measurement_candidates(text):
+    ''' Returns the measurement candidates (number + unit) of a text, ignoring the references (FIG. 3, claim 1...). '''
+    return MEASUREMENT_CANDIDATE.findall(mask_references(text))
+
+def has_measurement_candidate(text):
+    ''' Checks if a text contains at least one measurement candidate. '''
+    return MEASUREMENT_CANDIDATE.search(mask_references(text)) is not None
+
+def trim_to_candidate_sentences(text, context_sentences=0):
+    '''
+    Keeps only the sentences that contain measurement candidates, plus context_sentences sentences before each one
+    (the element being measured is sometimes named in the previous sentence). The order of the sentences is kept.
+    '''
+    sentences = split_sentences(text)
+    keep = set()
+    for position, sentence in enumerate(sentences):
+        if has_measurement_candidate(sentence):
+            keep.update(range(max(0, position - context_sentences), position + 1))
+    return ' '.join(sentence for position, sentence in enumerate(sentences) if position in keep)
@@ -0,0 +1,144 @@
+'''
+Script that stores the extracted measurements in a flat columnar table in Parquet format.
+Each row is a measurement extracted from a text chunk (run_id, doc_id, chunk_idx, element, property, value, unit) along with
+its validated flag. The rows are written in row groups as the chunks are processed, so the whole run is never held in memory,
+and the files are partitioned by data section (hive style: <directory>/data_section=BRFSUM/run-<run_id>.parquet).
+A file is written under a temporary hidden name and only renamed when the run finishes cleanly, so an interrupted run
+never leaves an incomplete file in the table. A resumed run has the same run id and replaces the file of the previous attempt.
+Downstream analytics can scan the table (e.g. with pyarrow.dataset, pandas or duckdb) without loading the json results.
+'''
+
+import os
+import re
+import threading
+import time
+
+MEASUREMENT_FIELDS = ['run_id', 'doc_id', 'chunk_idx', 'element', 'property', 'value', 'unit', 'validated']
+RUN_FILE = re.compile(r'run-(?P<run_id>.+)\.parquet$')
+
+def new_run_id():
+    ''' Id of a new run: its start time, so the ids sort in the order of the runs. '''
+    return time.strftime('%Y%m%d-%H%M%S')
+
+def measurements_schema():
+    ''' Schema of the measurements table. The data section is the partition of the files. '''
+    import pyarrow as pa
+    return pa.schema([
+        ('run_id', pa.string()),
+        ('doc_id', pa.string()),
+        ('chunk_idx', pa.int32()),
+        ('element', pa.string()),
+        ('property', pa.string()),
+        ('value', pa.string()),
+        ('unit', pa.string()),
+        ('validated', pa.bool_()),
+    ])
+
+class MeasurementParquetWriter:
+    '''
+    Writes the measurements of the processed chunks of a run to a Parquet file in row groups of row_group_size rows.
+    The file of each run is <directory>/data_section=<data_section>/run-<run_id>.parquet. Thread safe.
+    Use it as a context manager: the file is only renamed to its final name by close(), when the block ends without
+    errors. Otherwise the temporary file is removed (see abort()).
+    '''
+    def __init__(self, directory, data_section, row_group_size, run_id):
+        import pyarrow.parquet as pq
+        partition_directory = os.path.join(directory, f'data_section={data_section}')
+        os.makedirs(partition_directory, exist_ok=True)
+        self.run_id = run_id
+        self.path = os.path.join(partition_directory, f'run-{run_id}.parquet')
+        # Files starting with a dot are ignored by pyarrow.dataset, so readers never see the file of a run in progress
+        self.temporary_path = os.path.join(partition_directory, f'.run-{run_id}.parquet.tmp')
+        self.schema = measurements_schema()
+        self.row_group_size = row_group_size
+        self.columns = {field: [] for field in MEASUREMENT_FIELDS}
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.writer = pq.ParquetWriter(self.temporary_path, self.schema)
+
+    def write_chunk(self, doc_id, chunk_idx, extraction, validated):
+        '''
+        Adds a row per measurement of a chunk. Unparseable extractions (not a list of measurements) do not add rows.
+        A measurement is validated if it is in the validated measurements of the chunk.
+        '''
+        if not isinstance(extraction, list):
+            return
+        with self.lock:
+            for measurement in extraction:
+                if not isinstance(measurement, dict):
+                    continue
+                self.columns['run_id'].append(self.run_id)
+                self.columns['doc_id'].append(doc_id)
+                self.columns['chunk_idx'].append(chunk_idx)
+                for field in ('element', 'property', 'value', 'unit'):
+                    value = measurement.get(field)
+                    self.columns[field].append(None if value is None else str(value))
+                self.columns['validated'].append(measurement in validated)
+            if len(self.columns['doc_id']) >= self.row_group_size:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        rows = len(self.columns['doc_id'])
+        if rows == 0:
+            return
+        self.writer.write_table(pa.Table.from_pydict(self.columns, schema=self.schema), row_group_size=self.row_group_size)
+        self.rows += rows
+        self.columns = {field: [] for field in MEASUREMENT_FIELDS}
+
+    def close(self):
+        ''' Writes the last row group and moves the file to its final name, replacing the one of a previous attempt of the run. '''
+        with self.lock:
+            self._write_row_group()
+            self.writer.close()
+            os.replace(self.temporary_path, self.path)
+
+    def abort(self):
+        ''' Closes and removes the temporary file of an interrupted run. The table is left as it was before the run. '''
+        with self.lock:
+            self.writer.close()
+            os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def run_files(directory):
+    ''' Paths of the Parquet files of the table by data section and run id. '''
+    files = {}
+    for partition in sorted(os.listdir(directory)):
+        if not partition.startswith('data_section='):
+            continue
+        for name in os.listdir(os.path.join(directory, partition)):
+            match = RUN_FILE.fullmatch(name)
+            if match:
+                files[(partition.split('=', 1)[1], match.group('run_id'))] = os.path.join(directory, partition, name)
+    return files
+
+def read_measurements(directory, columns=None, filter=None, run_id=None, all_runs=False):
+    '''
+    Reads the measurements table as a pandas DataFrame, with the data_section column taken from the partitions.
+    By default only the latest run of each data section is read, so the measurements of a sample processed several
+    times are not counted twice. run_id reads the given run and all_runs every run (they can be told apart by the run_id column).
+    Only the given columns are read, and filter (a pyarrow.dataset expression, e.g. pyarrow.dataset.field('validated'))
+    is applied while scanning, so only the row groups that can match are read.
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    files = run_files(directory)
+    if run_id is not None:
+        files = {key: path for key, path in files.items() if key[1] == run_id}
+    elif not all_runs:
+        latest_runs = {}
+        for data_section, file_run_id in files:
+            latest_runs[data_section] = max(latest_runs.get(data_section, file_run_id), file_run_id)
+        files = {key: path for key, path in files.items() if latest_runs[key[0]] == key[1]}
+    # The schema is given so a table without files has its columns, and the files of older runs without run_id can be read
+    schema = measurements_schema().append(pa.field('data_section', pa.string()))
+    dataset = ds.dataset(sorted(files.values()), schema=schema, format='parquet', partitioning='hive', partition_base_dir=directory)
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
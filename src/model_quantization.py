@@ -0,0 +1,222 @@
+'''
+Script that loads the model served by mpt_api.py in one of the inference modes.
+- 'bfloat16' and 'float32': the model weights in that type, on the GPU if there is one.
+- 'int8': dynamic quantization of the linear layers for CPU inference. The weights are stored in int8 and the
+  activations are quantized on the fly, so the matrix multiplications use the int8 kernels of the CPU (fbgemm/onednn)
+  and the model takes about a quarter of the float32 memory.
+The quantized weights are saved in a cache folder the first time, so the next starts load them from there directly
+instead of loading the full precision weights and quantizing them again. They are saved as plain tensors (the int8 values
+and the quantization parameters of each weight), which are loaded with torch.load(weights_only=True) without unpickling
+any code. The cache is keyed by the commit of the checkpoint, so an update of the model is quantized again.
+The checkpoints without safetensors weights (e.g. the pickled pytorch_model.bin of MPT) can be converted once to
+safetensors, which are memory-mapped when loaded instead of unpickled, so the later starts read the weights much faster.
+'''
+
+import os
+import re
+import shutil
+import time
+import torch
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from transformers import AutoConfig, AutoModelForCausalLM
+from transformers.modeling_utils import no_init_weights
+from transformers.pytorch_utils import Conv1D
+
+INFERENCE_MODES = {
+    'bfloat16': torch.bfloat16,
+    'float32': torch.float32,
+    # Dynamic quantization starts from the float32 weights
+    'int8': torch.float32,
+}
+QUANTIZED_MODES = ['int8']
+
+def conv1d_to_linear(model):
+    '''
+    Replaces the Conv1D layers (linear layers with transposed weights of GPT-2 like models) with nn.Linear layers,
+    so they are quantized like the linear layers of the rest of the models.
+    '''
+    for parent in model.modules():
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(parent, name, linear)
+    return model
+
+def quantize_int8(model):
+    ''' Dynamic int8 quantization of the linear layers of a float32 model (CPU only). '''
+    return torch.ao.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+def quantized_layers(model):
+    ''' Quantized linear layers of a model by name. '''
+    return {name: module for name, module in model.named_modules() if isinstance(module, DynamicQuantizedLinear)}
+
+def unquantized_tensors(model, layers):
+    ''' Tensors of the state dict of a quantized model that are not part of its quantized layers (embeddings, norms...). '''
+    return {
+        name: value for name, value in model.state_dict().items()
+        if isinstance(value, torch.Tensor) and name.rsplit('.', 1)[0] not in layers and '._packed_params' not in name
+    }
+
+def quantized_state_dict(model):
+    '''
+    State dict of a quantized model made only of plain tensors, so it can be loaded with torch.load(weights_only=True).
+    The weight of each quantized linear layer is stored as its int8 values and its scales and zero points.
+    '''
+    layers = quantized_layers(model)
+    state = unquantized_tensors(model, layers)
+    for name, module in layers.items():
+        weight, bias = module._weight_bias()
+        state[f'{name}.weight_int8'] = weight.int_repr()
+        if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+            state[f'{name}.weight_scales'] = weight.q_per_channel_scales()
+            state[f'{name}.weight_zero_points'] = weight.q_per_channel_zero_points()
+            state[f'{name}.weight_axis'] = torch.tensor(weight.q_per_channel_axis())
+        else:
+            state[f'{name}.weight_scale'] = torch.tensor(weight.q_scale(), dtype=torch.float64)
+            state[f'{name}.weight_zero_point'] = torch.tensor(weight.q_zero_point())
+        if bias is not None:
+            state[f'{name}.bias'] = bias
+    return state
+
+def load_quantized_state_dict(model, state):
+    ''' Loads a state dict saved with quantized_state_dict() in a quantized model with the same architecture. '''
+    state = dict(state)
+    for name, module in quantized_layers(model).items():
+        int8_weight = state.pop(f'{name}.weight_int8')
+        if f'{name}.weight_scales' in state:
+            weight = torch._make_per_channel_quantized_tensor(
+                int8_weight, state.pop(f'{name}.weight_scales'), state.pop(f'{name}.weight_zero_points'), int(state.pop(f'{name}.weight_axis'))
+            )
+        else:
+            weight = torch._make_per_tensor_quantized_tensor(
+                int8_weight, float(state.pop(f'{name}.weight_scale')), int(state.pop(f'{name}.weight_zero_point'))
+            )
+        module.set_weight_bias(weight, state.pop(f'{name}.bias', None))
+    # The rest of the tensors share their storage with the parameters and buffers of the model, so they are copied in place
+    tensors = unquantized_tensors(model, quantized_layers(model))
+    if set(tensors) != set(state):
+        raise RuntimeError(
+            f'The cached quantized weights do not match the model. Missing: {sorted(set(tensors) - set(state))}, '
+            f'unexpected: {sorted(set(state) - set(tensors))}'
+        )
+    with torch.no_grad():
+        for name, value in state.items():
+            tensors[name].copy_(value)
+    return model
+
+def checkpoint_key(model_name, trust_remote_code=True, use_auth_token=None):
+    '''
+    Name of a checkpoint in the cache folders: the model name and its version. For local checkpoints the version is
+    the time they were last modified, for the models of the hub the commit of the downloaded revision.
+    '''
+    key = re.sub(r'[^\w.-]+', '_', model_name.strip('/\\'))
+    if os.path.isdir(model_name):
+        key += '-' + str(int(max(entry.stat().st_mtime for entry in os.scandir(model_name))))
+    else:
+        commit_hash = getattr(
+            AutoConfig.from_pretrained(model_name, trust_remote_code=trust_remote_code, use_auth_token=use_auth_token), '_commit_hash', None
+        )
+        if commit_hash:
+            key += '-' + commit_hash[:12]
+    return key
+
+def quantized_cache_path(cache_dir, model_name, inference_mode, trust_remote_code=True, use_auth_token=None):
+    '''
+    File of the cached quantized weights. The name includes the checkpoint, the mode and the torch version (the
+    quantization of the weights can change between versions).
+    '''
+    key = checkpoint_key(model_name, trust_remote_code, use_auth_token)
+    return os.path.join(cache_dir, f'{key}-{inference_mode}-torch{torch.__version__}-weights.pt')
+
+def has_safetensors(path):
+    ''' True if path is a local checkpoint with its weights in safetensors format. '''
+    return os.path.exists(os.path.join(path, 'model.safetensors')) or os.path.exists(os.path.join(path, 'model.safetensors.index.json'))
+
+def safetensors_checkpoint(model_name, safetensors_dir, torch_dtype, trust_remote_code=True, use_auth_token=None):
+    '''
+    Returns a local checkpoint of the model with its weights in safetensors format. If the model does not have one,
+    it is converted the first time and saved in safetensors_dir (the weights in torch_dtype, along with the config and
+    the code of the model). The tokenizer is not copied, it is still loaded from model_name.
+    '''
+    if has_safetensors(model_name):
+        return model_name
+    dtype_name = str(torch_dtype).replace('torch.', '')
+    path = os.path.join(safetensors_dir, f'{checkpoint_key(model_name, trust_remote_code, use_auth_token)}-{dtype_name}')
+    if has_safetensors(path):
+        return path
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch_dtype,
+        trust_remote_code=trust_remote_code,
+        use_auth_token=use_auth_token,
+    )
+    # Written to a temporary folder first, so an interrupted conversion does not leave a broken checkpoint
+    temporary_path = path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    model.save_pretrained(temporary_path, safe_serialization=True)
+    os.replace(temporary_path, path)
+    print(f'Model converted to safetensors in {path} in {time.perf_counter() - start:.1f} s')
+    return path
+
+def from_pretrained(model_name, torch_dtype, safetensors_dir=None, trust_remote_code=True, use_auth_token=None):
+    ''' Loads the weights of the model, from its safetensors checkpoint if safetensors_dir is given (see safetensors_checkpoint()). '''
+    if safetensors_dir is None:
+        return AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch_dtype,
+            trust_remote_code=trust_remote_code,
+            use_auth_token=use_auth_token,
+        )
+    path = safetensors_checkpoint(model_name, safetensors_dir, torch_dtype, trust_remote_code, use_auth_token)
+    return AutoModelForCausalLM.from_pretrained(
+        path,
+        torch_dtype=torch_dtype,
+        trust_remote_code=trust_remote_code,
+        use_auth_token=use_auth_token,
+        use_safetensors=True,
+    )
+
+def load_model(model_name, inference_mode='bfloat16', cache_dir=None, safetensors_dir=None, trust_remote_code=True, use_auth_token=None):
+    '''
+    Loads the model in the given inference mode (see INFERENCE_MODES) and returns it in eval mode on its device.
+    The quantized modes run on CPU. If cache_dir is given, the quantized model is loaded from it or saved in it.
+    If safetensors_dir is given, the full precision weights are loaded from safetensors (see safetensors_checkpoint()).
+    '''
+    if inference_mode not in INFERENCE_MODES:
+        raise ValueError(f'Unknown inference mode {inference_mode}. Possible values are: {list(INFERENCE_MODES)}')
+    torch_dtype = INFERENCE_MODES[inference_mode]
+    if inference_mode not in QUANTIZED_MODES:
+        model = from_pretrained(model_name, torch_dtype, safetensors_dir, trust_remote_code, use_auth_token)
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model.eval()
+        return model.to(device=device, dtype=torch_dtype)
+
+    cache_path = quantized_cache_path(cache_dir, model_name, inference_mode, trust_remote_code, use_auth_token) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        start = time.perf_counter()
+        # The model is built from its config without initialising its weights and quantized, and then the cached
+        # weights are loaded in it
+        model_config = AutoConfig.from_pretrained(model_name, trust_remote_code=trust_remote_code, use_auth_token=use_auth_token)
+        with no_init_weights():
+            model = AutoModelForCausalLM.from_config(model_config, trust_remote_code=trust_remote_code, torch_dtype=torch_dtype)
+        model = quantize_int8(model.eval())
+        load_quantized_state_dict(model, torch.load(cache_path, map_location='cpu', weights_only=True))
+        print(f'Quantized model ({inference_mode}) loaded from {cache_path} in {time.perf_counter() - start:.1f} s')
+        return model.eval()
+
+    start = time.perf_counter()
+    model = from_pretrained(model_name, torch_dtype, safetensors_dir, trust_remote_code, use_auth_token)
+    model = quantize_int8(model.eval())
+    print(f'Model quantized ({inference_mode}) in {time.perf_counter() - start:.1f} s')
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written to a temporary file first, so an interrupted save does not leave a broken cache
+        temporary_path = cache_path + '.tmp'
+        torch.save(quantized_state_dict(model), temporary_path)
+        os.replace(temporary_path, cache_path)
+        print(f'Quantized weights saved in {cache_path}')
+    return model
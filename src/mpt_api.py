@@ -2,15 +2,23 @@
 Script that defines an local API for serving the MPT model.
 This way we avoid loading the model each time we run the program, 
 since the model load time is aroun 10 minutes.
+The model is loaded in the background, so the server answers /health from the start and /ready once the model is ready.
 '''
 
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, List, Tuple
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+import queue
+import time
 import warnings
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoTokenizer, TextIteratorStreamer
 from transformers import StoppingCriteria, StoppingCriteriaList
 from config import config
+from model_quantization import load_model
 
 # 1. Define the prompt structure. With this template the model results are much better since its similar to the data in the training process
 INSTRUCTION_KEY = "### Instruction:"
@@ -30,21 +38,85 @@ PROMPT_FOR_GENERATION_FORMAT = """{intro}
     response_key=RESPONSE_KEY,
 )
 
+class PrefixCache:
+    '''
+    Cache of the attention keys and values (past_key_values) of static prompt prefixes, like the kor instructions and
+    the few-shot examples that start every extraction prompt. When a prompt starts with a registered prefix, the
+    generation continues from the cached state and only the rest of the prompt has to be encoded.
+    The prefixes are compared token by token, so a prompt that shares only part of a prefix (e.g. because the last
+    tokens of the prefix are merged with the text that follows it) reuses the state of the shared tokens.
+    '''
+    def __init__(self, model, max_prefixes) -> None:
+        self.model = model
+        self.max_prefixes = max_prefixes
+        # prefix text -> (token ids, past_key_values, sequence dimension of each tensor of a layer)
+        self.prefixes = OrderedDict()
+        self.lock = Lock()
+
+    def register(self, prefix_text, prefix_ids):
+        ''' Computes and stores the state of a prefix. The least recently registered prefixes are evicted. '''
+        with torch.no_grad():
+            past_key_values = self.model(prefix_ids, use_cache=True).past_key_values
+            # The layout of the cache depends on the model. The sequence dimension is the one that changes with the length
+            single_token = self.model(prefix_ids[:, :1], use_cache=True).past_key_values
+        sequence_dims = [
+            [dim for dim, (a, b) in enumerate(zip(full.shape, one.shape)) if a != b][0] if full.shape != one.shape else None
+            for full, one in zip(past_key_values[0], single_token[0])
+        ]
+        with self.lock:
+            self.prefixes[prefix_text] = (prefix_ids[0], past_key_values, sequence_dims)
+            self.prefixes.move_to_end(prefix_text)
+            while len(self.prefixes) > self.max_prefixes:
+                self.prefixes.popitem(last=False)
+
+    def lookup(self, input_ids):
+        '''
+        Returns the cached state of the registered prefix that shares more tokens with input_ids (truncated to the
+        shared tokens) and the number of shared tokens. At least the last token of the prompt is left to be encoded.
+        '''
+        with self.lock:
+            entries = list(self.prefixes.values())
+        prompt_ids = input_ids[0, :-1]
+        best_entry, best_length = None, 0
+        for prefix_ids, past_key_values, sequence_dims in entries:
+            length = min(len(prefix_ids), len(prompt_ids))
+            mismatches = (prefix_ids[:length] != prompt_ids[:length]).nonzero()
+            if len(mismatches) > 0:
+                length = mismatches[0].item()
+            if length > best_length:
+                best_entry, best_length = (prefix_ids, past_key_values, sequence_dims), length
+        if best_entry is None:
+            return None, 0
+        prefix_ids, past_key_values, sequence_dims = best_entry
+        if best_length < len(prefix_ids):
+            past_key_values = tuple(
+                tuple(
+                    tensor.narrow(dim, 0, best_length) if dim is not None else tensor
+                    for tensor, dim in zip(layer, sequence_dims)
+                )
+                for layer in past_key_values
+            )
+        return past_key_values, best_length
+
 class InstructionTextGenerationPipeline:
     ''' Definition of the pipeline for the MPT model. '''
     def __init__(
         self,
         model_name,
-        torch_dtype=torch.bfloat16,
+        inference_mode='bfloat16',
+        quantized_cache_dir=None,
+        safetensors_dir=None,
         trust_remote_code=True,
         use_auth_token=None,
     ) -> None:
-        self.model = AutoModelForCausalLM.from_pretrained(
+        # The model is loaded in eval mode on its device: the GPU if there is one, the CPU for the quantized modes (see model_quantization.py)
+        self.model = load_model(
             model_name,
-            torch_dtype=torch_dtype,
+            inference_mode=inference_mode,
+            cache_dir=quantized_cache_dir,
+            safetensors_dir=safetensors_dir,
             trust_remote_code=trust_remote_code,
             use_auth_token=use_auth_token,
-            #max_seq_len=2048
         )
 
         tokenizer = AutoTokenizer.from_pretrained(
@@ -60,10 +132,6 @@ class InstructionTextGenerationPipeline:
         tokenizer.padding_side = "left"
         self.tokenizer = tokenizer
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.eval()
-        self.model.to(device=device, dtype=torch_dtype)
-
         # Default arguments
         self.generate_kwargs = {
             "temperature": config['api_temperature'],
@@ -77,10 +145,41 @@ class InstructionTextGenerationPipeline:
             "repetition_penalty": config['api_repetition_penalty'],  # 1.0 means no penalty, > 1.0 means penalty, 1.2 from CTRL paper
         }
 
+        # Cache of the state of the static prompt prefixes (see PrefixCache)
+        self.prefix_cache = PrefixCache(self.model, config['api_max_cached_prefixes']) if config['api_prefix_cache'] else None
+
     def format_instruction(self, instruction):
         ''' When prompt received, use template to adapt the prompt to the desired format. '''
         return PROMPT_FOR_GENERATION_FORMAT.format(instruction=instruction)
 
+    def register_prefix(self, instruction_prefix):
+        ''' Registers the beginning of the instructions that are going to be received. Returns its number of tokens. '''
+        if self.prefix_cache is None:
+            return 0
+        prefix_text = PROMPT_FOR_GENERATION_FORMAT.split("{instruction}")[0] + instruction_prefix
+        prefix_ids = self.tokenizer(prefix_text, return_tensors="pt").input_ids.to(self.model.device)
+        self.prefix_cache.register(prefix_text, prefix_ids)
+        return prefix_ids.shape[1]
+
+    def prepare_inputs(self, instruction, use_prefix_cache=True):
+        '''
+        Tokenizes a single instruction. If it starts with a registered prefix, the cached state of the prefix is
+        extended with the rest of the prompt (except the last token, which is encoded by generate) and returned as past_key_values.
+        '''
+        input_ids = self.tokenizer(self.format_instruction(instruction), return_tensors="pt").input_ids
+        input_ids = input_ids.to(self.model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        if use_prefix_cache and self.prefix_cache is not None:
+            past_key_values, length = self.prefix_cache.lookup(input_ids)
+            if past_key_values is not None:
+                if length < input_ids.shape[1] - 1:
+                    with torch.no_grad():
+                        past_key_values = self.model(
+                            input_ids[:, length:-1], past_key_values=past_key_values, use_cache=True
+                        ).past_key_values
+                inputs["past_key_values"] = past_key_values
+        return inputs
+
     def __call__(
         self, instruction: str, **generate_kwargs: Dict[str, Any]
     ) -> Tuple[str, str, float]:
@@ -96,48 +195,253 @@ class InstructionTextGenerationPipeline:
         output_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
         return output_text
 
+    def generate_batch(
+        self, instructions: List[str], max_new_tokens: List[int], use_prefix_cache: bool = True, **generate_kwargs: Dict[str, Any]
+    ) -> List[Tuple[str, int]]:
+        '''
+        Generates the responses of several instructions with a single padded (left side) call to the model.
+        The batch is generated up to the biggest max_new_tokens and then each output is cut to its own max_new_tokens.
+        The prefix cache is only used for single instruction batches, since the padding changes the position of the prefixes.
+        Returns for each instruction the decoded output (prompt + response) and the number of generated tokens.
+        '''
+        if len(instructions) == 1:
+            inputs = self.prepare_inputs(instructions[0], use_prefix_cache)
+        else:
+            prompts = [self.format_instruction(instruction) for instruction in instructions]
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        gkw = {**self.generate_kwargs, **generate_kwargs, "max_new_tokens": max(max_new_tokens)}
+        with torch.no_grad():
+            output_ids = self.model.generate(**inputs, **gkw)
+        input_length = inputs["input_ids"].shape[1]
+        stop_ids = {self.tokenizer.eos_token_id, self.tokenizer.pad_token_id}
+        results = []
+        for row, row_max_new_tokens in zip(output_ids, max_new_tokens):
+            row = row[: input_length + row_max_new_tokens]
+            # Tokens generated until the end of the sequence (the rest of the row is padding)
+            generated_tokens = 0
+            for token in row[input_length:].tolist():
+                generated_tokens += 1
+                if token in stop_ids:
+                    break
+            results.append((self.tokenizer.decode(row, skip_special_tokens=True), generated_tokens))
+        return results
+
+class GenerationRequest:
+    ''' Generation request waiting in the queue of the GenerationBatcher. '''
+    def __init__(self, instruction, max_new_tokens, sampling_kwargs, use_prefix_cache=True):
+        self.instruction = instruction
+        self.max_new_tokens = max_new_tokens
+        self.sampling_kwargs = sampling_kwargs
+        self.use_prefix_cache = use_prefix_cache
+        # Only requests with the same sampling hyperparameters can be generated in the same batch
+        self.batch_key = tuple(sorted(sampling_kwargs.items()))
+        self.future = Future()
+
+class GenerationBatcher:
+    '''
+    Dynamic micro-batching of the generation requests.
+    The requests received by the API are queued. A background thread collects them for up to max_wait_ms
+    (or until max_batch_size requests are collected), generates all of them with a single batched call to the model
+    and returns each result to its caller. Requests with different sampling hyperparameters go to different batches.
+    '''
+    def __init__(self, pipeline, max_batch_size, max_wait_ms, stopping_criteria=None):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stopping_criteria = stopping_criteria
+        self.queue = queue.Queue()
+        # Requests that could not be added to the previous batch
+        self.pending = deque()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, instruction, max_new_tokens, sampling_kwargs, use_prefix_cache=True):
+        ''' Queues a request and waits for its result: the decoded output and the number of generated tokens. '''
+        generation_request = GenerationRequest(instruction, max_new_tokens, sampling_kwargs, use_prefix_cache)
+        self.queue.put(generation_request)
+        return generation_request.future.result()
+
+    def _collect_batch(self):
+        ''' Waits for a request and collects the compatible requests that arrive during max_wait seconds. '''
+        first = self.pending.popleft() if self.pending else self.queue.get()
+        batch = [first]
+        not_batched = deque()
+        while self.pending:
+            generation_request = self.pending.popleft()
+            if generation_request.batch_key == first.batch_key and len(batch) < self.max_batch_size:
+                batch.append(generation_request)
+            else:
+                not_batched.append(generation_request)
+        self.pending = not_batched
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                generation_request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if generation_request.batch_key == first.batch_key:
+                batch.append(generation_request)
+            else:
+                self.pending.append(generation_request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            generate_kwargs = dict(batch[0].sampling_kwargs)
+            if self.stopping_criteria is not None:
+                generate_kwargs['stopping_criteria'] = self.stopping_criteria
+            try:
+                results = self.pipeline.generate_batch(
+                    [r.instruction for r in batch],
+                    [r.max_new_tokens for r in batch],
+                    use_prefix_cache=all(r.use_prefix_cache for r in batch),
+                    **generate_kwargs,
+                )
+            except Exception as e:
+                for generation_request in batch:
+                    generation_request.future.set_exception(e)
+                continue
+            for generation_request, result in zip(batch, results):
+                generation_request.future.set_result(result)
+
 # 2. Define the API name
 app = Flask(__name__)
 
-# Initialize/LOAD the model and tokenizer (MPT)
-gen_pipeline = InstructionTextGenerationPipeline(
-    config['api_model_path'],
-    torch_dtype=torch.bfloat16,
-    trust_remote_code=True,
-    use_auth_token=None,
-)
-stop_token_ids = gen_pipeline.tokenizer.convert_tokens_to_ids(["<|endoftext|>"])
-print('MODEL LOADED')
+# Seconds that the clients are asked to wait (Retry-After header) when they call the API before the model is ready
+RETRY_AFTER_SECONDS = 5
+WARMUP_INSTRUCTION = 'The temperature of the solution is 25 degrees Celsius.'
+
+class ServerState:
+    '''
+    State of the model of the API. The model is loaded in a background thread (see start_loading()), so the server
+    accepts connections while it loads: /health answers from the start and /ready once the model is loaded and a
+    warm-up generation has run. Until then the endpoints that need the model answer 503 (see requires_model()).
+    '''
+    def __init__(self) -> None:
+        # starting -> loading -> warming_up -> ready, or failed if the load raises an exception
+        self.status = 'starting'
+        self.error = None
+        self.ready = Event()
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.pipeline = None
+        self.batcher = None
+        self.stop_token_ids = []
+
+    def load(self):
+        ''' Loads the model and the tokenizer (MPT), creates the batcher of the requests and warms up the model. '''
+        try:
+            self.status = 'loading'
+            start = time.perf_counter()
+            if config['api_torch_threads']:
+                torch.set_num_threads(config['api_torch_threads'])
+            self.pipeline = InstructionTextGenerationPipeline(
+                config['api_model_path'],
+                inference_mode=config['api_inference_mode'],
+                quantized_cache_dir=config['api_quantized_cache_dir'],
+                safetensors_dir=config['api_safetensors_dir'],
+                trust_remote_code=True,
+                use_auth_token=None,
+            )
+            self.stop_token_ids = self.pipeline.tokenizer.convert_tokens_to_ids(["<|endoftext|>"])
+            # Queue of requests that are generated in batches (see GenerationBatcher)
+            self.batcher = GenerationBatcher(
+                self.pipeline,
+                max_batch_size=config['api_max_batch_size'],
+                max_wait_ms=config['api_batch_wait_ms'],
+                stopping_criteria=StoppingCriteriaList([StopOnTokens()]),
+            )
+            self.timings['load_seconds'] = time.perf_counter() - start
+            print(f'MODEL LOADED in {self.timings["load_seconds"]:.1f} s')
+
+            # The first generation is much slower (memory allocation, kernel initialisation), so it is not left to the first request
+            self.status = 'warming_up'
+            start = time.perf_counter()
+            if config['api_warmup_tokens']:
+                sampling_kwargs = {"temperature": 0.0, "do_sample": False, "top_p": 1, "top_k": 0}
+                self.batcher.submit(WARMUP_INSTRUCTION, config['api_warmup_tokens'], sampling_kwargs)
+            self.timings['warmup_seconds'] = time.perf_counter() - start
+        except Exception as e:
+            self.status = 'failed'
+            self.error = repr(e)
+            raise
+        self.timings['startup_seconds'] = time.perf_counter() - self.start
+        self.status = 'ready'
+        self.ready.set()
+        print(f'MODEL READY in {self.timings["startup_seconds"]:.1f} s (warm-up {self.timings["warmup_seconds"]:.1f} s)')
+
+    def health(self):
+        ''' Status of the server, with the time spent in each step of the startup. '''
+        return {
+            'status': self.status,
+            'error': self.error,
+            'model': config['api_model_path'],
+            'inference_mode': config['api_inference_mode'],
+            'uptime_seconds': time.perf_counter() - self.start,
+            'timings': self.timings,
+        }
+
+server = ServerState()
+
+def start_loading():
+    ''' Loads the model in a background thread. Call it before serving the app (also when it is served by a WSGI server). '''
+    thread = Thread(target=server.load, daemon=True)
+    thread.start()
+    return thread
 
 # Define a custom stopping criteria
 class StopOnTokens(StoppingCriteria):
+    ''' Stops the generation when every sequence of the batch has finished (stop token or padding after it). '''
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for stop_id in stop_token_ids:
-            if input_ids[0][-1] == stop_id:
-                return True
-        return False
+        finished_ids = server.stop_token_ids + [server.pipeline.tokenizer.pad_token_id]
+        for sequence in input_ids:
+            if int(sequence[-1]) not in finished_ids:
+                return False
+        return True
 
-@app.route('/generate', methods=['post'])
-def generate():
-    ''' Function that handles inputs from API. '''
-    content = request.json
+class StopOnEvent(StoppingCriteria):
+    ''' Stops the generation when the event is set. Used to stop streamed generations when the client disconnects. '''
+    def __init__(self, event: Event) -> None:
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.event.is_set()
+
+def requires_model(endpoint):
+    ''' Answers 503 (with a Retry-After header) to the requests received before the model is ready. '''
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not server.ready.is_set():
+            response = jsonify(server.health())
+            response.status_code = 503
+            response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+            return response
+        return endpoint(*args, **kwargs)
+    return wrapper
+
+@app.route('/health', methods=['get'])
+def health():
+    ''' Liveness probe. Answers as soon as the server is up, with the status of the model load. '''
+    return jsonify(server.health())
+
+@app.route('/ready', methods=['get'])
+def ready():
+    ''' Readiness probe. Answers 200 once the model is loaded and warmed up, 503 until then. '''
+    return jsonify(server.health()), 200 if server.ready.is_set() else 503
+
+def parse_generation_request(content):
+    ''' Reads the instruction and the hyperparameters of a request to the API. '''
     instruction = content.get('text','')
     temperature = int(content.get('temperature',''))
     top_p = int(content.get('top_p',''))
     top_k = int(content.get('top_k',''))
     max_new_tokens = int(content.get('max_new_tokens',''))
-
-    # Tokenize the input
-    input_ids = gen_pipeline.tokenizer(
-        gen_pipeline.format_instruction(instruction), return_tensors="pt"
-    ).input_ids
-    input_ids = input_ids.to(gen_pipeline.model.device)
-
-    # Initialize the streamer and stopping criteria
-    #streamer = TextIteratorStreamer(
-    #    gen_pipeline.tokenizer, timeout=10.0, skip_prompt=True, skip_special_tokens=True
-    #)
-    stop = StopOnTokens()
+    use_prefix_cache = bool(content.get('use_prefix_cache', True))
 
     if temperature < 0.1:
         temperature = 0.0
@@ -145,38 +449,89 @@ def generate():
     else:
         do_sample = True
 
+    sampling_kwargs = {
+        "temperature": temperature,
+        "do_sample": do_sample,
+        "top_p": top_p,
+        "top_k": top_k,
+    }
+    return instruction, max_new_tokens, sampling_kwargs, use_prefix_cache
+
+@app.route('/generate', methods=['post'])
+@requires_model
+def generate():
+    ''' Function that handles inputs from API. '''
+    instruction, max_new_tokens, sampling_kwargs, use_prefix_cache = parse_generation_request(request.json)
+
+    # The request is generated together with the other requests received at the same time (see GenerationBatcher)
+    decoded_output, generated_tokens = server.batcher.submit(instruction, max_new_tokens, sampling_kwargs, use_prefix_cache)
+    print(decoded_output)
+    return jsonify({'generated_text': decoded_output, 'generated_tokens': generated_tokens})
+
+@app.route('/generate_stream', methods=['post'])
+@requires_model
+def generate_stream():
+    '''
+    Function that handles inputs from API streaming the response (chunked HTTP) as the tokens are generated.
+    Unlike generate(), only the response is returned (not the prompt). The streamed requests are not batched.
+    If the client closes the connection (e.g. because it already has all the information it needs) the generation is stopped.
+    '''
+    instruction, max_new_tokens, sampling_kwargs, use_prefix_cache = parse_generation_request(request.json)
+
+    # Tokenize the input. If it starts with a registered prefix, its cached state is used (see PrefixCache)
+    inputs = server.pipeline.prepare_inputs(instruction, use_prefix_cache)
+
+    # Initialize the streamer and stopping criteria
+    streamer = TextIteratorStreamer(
+        server.pipeline.tokenizer, timeout=None, skip_prompt=True, skip_special_tokens=True
+    )
+    stream_cancelled = Event()
+
     gkw = {
-        **gen_pipeline.generate_kwargs,
+        **server.pipeline.generate_kwargs,
+        **sampling_kwargs,
+        **inputs,
         **{
-            "input_ids": input_ids,
             "max_new_tokens": max_new_tokens,
-            "temperature": temperature,
-            "do_sample": do_sample,
-            "top_p": top_p,
-            "top_k": top_k,
-            #"streamer": streamer,
-            "stopping_criteria": StoppingCriteriaList([stop]),
+            "streamer": streamer,
+            "stopping_criteria": StoppingCriteriaList([StopOnTokens(), StopOnEvent(stream_cancelled)]),
         },
     }
 
-    response = ""
-    output = gen_pipeline.model.generate(**gkw)
-    decoded_output = gen_pipeline.tokenizer.decode(output[0], skip_prompt=True, skip_special_tokens=True) 
-    print(decoded_output)
-    return jsonify({'generated_text': decoded_output})
-    #stream_complete = Event()
+    def generate_and_signal_complete():
+        try:
+            with torch.no_grad():
+                server.pipeline.model.generate(**gkw)
+        except Exception:
+            # Unblock the response, otherwise it would wait forever for new tokens
+            streamer.end()
+            raise
+
+    t1 = Thread(target=generate_and_signal_complete, daemon=True)
+    t1.start()
 
-    #def generate_and_signal_complete():
-    #    generate.model.generate(**gkw)
-    #    stream_complete.set()
+    def stream():
+        try:
+            for new_text in streamer:
+                if new_text:
+                    yield new_text
+        finally:
+            # Reached when the generation ends or when the client disconnects
+            stream_cancelled.set()
 
-    #t1 = Thread(target=generate_and_signal_complete)
-    #t1.start()
+    return Response(stream(), mimetype='text/plain; charset=utf-8')
 
-    #for new_text in streamer:
-    #    response += new_text
-    #    yield response
+@app.route('/register_prefix', methods=['post'])
+@requires_model
+def register_prefix():
+    '''
+    Registers a static prefix of the instructions (e.g. the kor instructions and few-shot examples).
+    Its state is precomputed so the requests that start with it do not encode it again (see PrefixCache).
+    '''
+    prefix_tokens = server.pipeline.register_prefix(request.json.get('text',''))
+    return jsonify({'prefix_tokens': prefix_tokens})
 
 if __name__ == '__main__':
-    # Run locally
+    # Run locally. The server starts accepting requests while the model loads
+    start_loading()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
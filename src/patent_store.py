@@ -0,0 +1,139 @@
+'''
+Script that handles the storage of the processed patents in JSONL format (one patent per line).
+The patents are appended to the file as soon as they are parsed, so the whole corpus is never held in memory.
+Along with the JSONL file, an index with the byte offset of each patent is stored (one offset per line in the .idx file).
+With the index, a sample of patents can be read by seeking directly to them, without deserialising the whole corpus.
+Samples can also be taken with seeded reservoir sampling in a single streaming pass, optionally filtering the patents by section.
+The files can be compressed with gzip (.gz extension) or zstd (.zst extension).
+'''
+
+import gzip
+import json
+import random
+
+def open_patents_file(path, mode):
+    ''' Opens a JSONL file in the given mode (e.g. 'rb', 'wb', 'rt'). The compression is chosen from the file extension. '''
+    encoding = 'utf-8' if 't' in mode else None
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding=encoding)
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+def index_path(path):
+    ''' Path of the byte offsets index of a JSONL file. '''
+    return path + '.idx'
+
+class PatentWriter:
+    '''
+    Appends patents to a JSONL file, one per line, and stores the byte offset of each one in the index file.
+    The offsets refer to the uncompressed stream. Use it as a context manager so the files are always closed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.count = 0
+        self.file = open_patents_file(path, 'wb')
+        self.index_file = open(index_path(path), 'w', encoding='utf-8')
+
+    def write(self, patent):
+        ''' Writes a single patent at the end of the file. '''
+        line = (json.dumps(patent, ensure_ascii=False) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.index_file.write(f'{self.offset}\n')
+        self.offset += len(line)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_index(path):
+    ''' Returns the list of byte offsets of the patents of a JSONL file. '''
+    with open(index_path(path), 'r', encoding='utf-8') as f:
+        return [int(line) for line in f]
+
+def iter_patents(path):
+    ''' Generator that yields the patents of a JSONL file one by one. '''
+    with open_patents_file(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+def read_patents_at(path, positions):
+    '''
+    Reads the patents at the given positions (0 based) of a JSONL file using its index.
+    The file is always read forward (the positions are sorted first) since compressed files can only seek forward,
+    but the patents are returned in the same order as the requested positions.
+    '''
+    offsets = read_index(path)
+    patents = {}
+    with open_patents_file(path, 'rb') as f:
+        for position in sorted(set(positions)):
+            f.seek(offsets[position])
+            if position + 1 < len(offsets):
+                line = _read_exact(f, offsets[position + 1] - offsets[position])
+            else:
+                line = f.read()
+            patents[position] = json.loads(line.decode('utf-8'))
+    return [patents[position] for position in positions]
+
+def _read_exact(f, size):
+    ''' Reads exactly size bytes. Compressed streams may return less bytes than requested in a single read. '''
+    chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def reservoir_sample(patents, sample_num, seed, required_section=None):
+    '''
+    Seeded reservoir sampling (algorithm R) over an iterable of patents. The patents are read only once and just
+    sample_num of them are kept in memory, so the whole corpus is never loaded.
+    If required_section is given (e.g. 'BRFSUM') only the patents with that section non-empty are considered.
+    With the same seed and the same file the sampled patents are always the same.
+    '''
+    rng = random.Random(seed)
+    reservoir = []
+    candidates_num = 0
+    for patent in patents:
+        if required_section and not patent.get(required_section):
+            continue
+        if candidates_num < sample_num:
+            reservoir.append(patent)
+        else:
+            # Replace a random patent of the reservoir with probability sample_num/(candidates_num+1)
+            position = rng.randrange(candidates_num + 1)
+            if position < sample_num:
+                reservoir[position] = patent
+        candidates_num += 1
+    return reservoir
+
+def sample_patents(path, sample_num, seed, method='index', required_section=None):
+    '''
+    Returns a random sample of sample_num patents of a JSONL file without loading the whole corpus.
+    There are two sampling methods:
+    - 'index': reads only the sampled patents using the byte offsets index. The sampled positions are the same that
+      random.sample() would choose over the whole list of patents with the same seed, so the results are the same
+      as loading the whole corpus and sampling it.
+    - 'reservoir': single streaming pass over the file with reservoir sampling (see reservoir_sample()). It does not
+      need the index and it can filter the patents by section.
+    Filtering by required_section always uses the 'reservoir' method. If sample_num is 0 all the patents are returned.
+    '''
+    if sample_num <= 0:
+        return [patent for patent in iter_patents(path) if not required_section or patent.get(required_section)]
+    if method == 'reservoir' or required_section:
+        return reservoir_sample(iter_patents(path), sample_num, seed, required_section)
+    patents_num = len(read_index(path))
+    rng = random.Random(seed)
+    positions = rng.sample(range(patents_num), sample_num)
+    return read_patents_at(path, positions)
@@ -0,0 +1,91 @@
+'''
+Script that defines a command line entry point for the steps of the pipeline:
+- parse: parses the patents of a weekly XML file (see data_parser.py).
+- sample: samples the processed patents and saves them in a jsonl file or lists their doc_ids (see measurement_pipeline.py).
+- extract: extracts the measurements of a sample of patents (see first_approach.py).
+- example: extracts the measurements of the first input example, for debugging.
+- generate-train-data: generates synthetic train data for finetuning the model (see generate_train_data.py).
+Only argparse and config.py are imported at start. The modules of each command (and their heavy libraries: langchain,
+kor, pandas...) are imported when the command runs, so --help and the commands that do not use the LLM start fast.
+Usage: python pipeline_cli.py <command> [options]
+'''
+
+import argparse
+import time
+from config import config
+
+# Same values as PARSER_BACKENDS in data_parser.py, which is not imported to build the arguments
+PARSER_BACKENDS = ['bs4', 'lxml']
+
+def parse_command(args):
+    from data_parser import parse_and_save
+    parse_and_save(args.input, args.backend, args.workers)
+
+def sample_command(args):
+    from measurement_pipeline import load_patents
+    patents = load_patents(args.num, args.seed, args.required_section)
+    if args.output:
+        from patent_store import PatentWriter
+        with PatentWriter(args.output) as writer:
+            for patent in patents:
+                writer.write(patent)
+        print(f'{len(patents)} patents saved in {args.output}')
+    else:
+        for patent in patents:
+            print(' '.join(patent['doc_id'].split()))
+
+def extract_command(args):
+    from first_approach import run_extraction
+    run_extraction(resume=args.resume)
+
+def example_command(args):
+    from first_approach import run_single_example
+    run_single_example()
+
+def generate_train_data_command(args):
+    import generate_train_data
+    generate_train_data.main()
+
+def build_parser():
+    ''' Parser of the command line with a subcommand per step of the pipeline. '''
+    parser = argparse.ArgumentParser(description='Pipeline to extract measurements from patents.')
+    parser.add_argument('--timing', action='store_true', help='Print the time spent by the command.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help='Parse the patents of a weekly XML file and save them in the processed patents file.')
+    parse_parser.add_argument('--input', default=config['raw_data_patents_path'], help='Weekly XML file with the patents.')
+    parse_parser.add_argument('--workers', type=int, default=config['parser_workers'],
+                              help='Number of processes used to parse the patents. 1 parses them sequentially.')
+    parse_parser.add_argument('--backend', choices=PARSER_BACKENDS, default=config['parser_backend'],
+                              help='Library used to parse the XML of each patent.')
+    parse_parser.set_defaults(handler=parse_command)
+
+    sample_parser = subparsers.add_parser('sample', help='Sample the processed patents.')
+    sample_parser.add_argument('--num', type=int, default=config['sample_patents_num'], help='Number of sampled patents. 0 means all of them.')
+    sample_parser.add_argument('--seed', type=int, default=config['data_selection_seed'], help='Seed of the sampling.')
+    sample_parser.add_argument('--required-section', default=config['data_selection_required_section'],
+                               choices=['abstract', 'BRFSUM', 'DETDESC'], help='Only sample the patents with this section.')
+    sample_parser.add_argument('--output', default=None, help='jsonl file where the sampled patents are saved. By default their doc_ids are printed.')
+    sample_parser.set_defaults(handler=sample_command)
+
+    extract_parser = subparsers.add_parser('extract', help='Extract the measurements of a sample of patents with a LLM.')
+    extract_parser.add_argument('--resume', action='store_true',
+                                help='Resume an interrupted run. The chunks stored in the extraction journal are not sent again to the LLM.')
+    extract_parser.set_defaults(handler=extract_command)
+
+    example_parser = subparsers.add_parser('example', help='Extract the measurements of the first input example (debugging).')
+    example_parser.set_defaults(handler=example_command)
+
+    generate_parser = subparsers.add_parser('generate-train-data', help='Generate synthetic train data for finetuning the model with OpenAI.')
+    generate_parser.set_defaults(handler=generate_train_data_command)
+    return parser
+
+def main(argv=None):
+    start = time.perf_counter()
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+    if args.timing:
+        print(f'{args.command} finished in {time.perf_counter() - start:.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,13 @@ class Patent_measurements(BaseModel):
         description="Unit of measurement associated with the measure value. It provides the standardized reference for interpreting and comparing the measure values. It can not be empy, unitless, not specified, NA or N/A"
     )
 
+# Schema used when several text chunks are extracted in a single LLM call (see chunk_batching.py).
+# Each measurement is tagged with the number of the chunk where it appears.
+class Patent_chunk_measurements(Patent_measurements):
+
+    chunk: int = Field(
+        description="Number of the text chunk where the measurement appears. The input is made of numbered text chunks: [1], [2], [3]..."
+    )
 
 # Defines a set of examples to perform few-shot learning.
 # TODO: Explore the consequences of adding examples with empty results.
@@ -0,0 +1,132 @@
+'''
+Script that defines a rule based extractor of measurements, used as a fast path before the LLM.
+Many measurements in patents follow simple patterns like "<element> having a <property> of <value> <unit>"
+or "the <property> of the <element> is <value> <unit>". The measurement candidates (number + unit) are found with the
+prefilter (see measurement_prefilter.py) and the element and property are taken from the text at their left with these patterns.
+The measurements have the same format as the LLM ones (Patent_measurements). Each chunk gets a confidence:
+if every candidate of the chunk is explained by a pattern the chunk does not need the LLM, otherwise it is escalated.
+'''
+
+import re
+from measurement_prefilter import MEASUREMENT_CANDIDATE, NUMBER_RANGE, mask_references
+
+# Words that qualify a value. They are kept as part of the value, like the LLM does ("approximately 50", "less than 100")
+QUALIFIERS = [
+    'about', 'approximately', 'approx.', 'around', 'roughly', 'substantially', 'nearly', 'at least', 'at most', 'less than',
+    'more than', 'greater than', 'lower than', 'higher than', 'smaller than', 'larger than', 'up to', 'no more than',
+    'not more than', 'no less than', 'not less than', 'within', 'over', 'under', 'below', 'above', 'from', 'between',
+    'in the range of', 'in a range of', 'in the range from', 'ranging from', 'range from', 'of from', 'equal to',
+]
+QUALIFIERS_PATTERN = '|'.join(re.escape(qualifier) for qualifier in sorted(QUALIFIERS, key=len, reverse=True))
+# Property names that the rules trust (last word of the property)
+PROPERTY_LEXICON = {
+    'size', 'diameter', 'radius', 'length', 'width', 'height', 'thickness', 'depth', 'area', 'volume', 'weight', 'mass',
+    'density', 'viscosity', 'temperature', 'pressure', 'concentration', 'content', 'amount', 'ratio', 'porosity', 'speed',
+    'velocity', 'rate', 'frequency', 'voltage', 'current', 'resistance', 'resistivity', 'capacitance', 'power', 'energy',
+    'modulus', 'strength', 'hardness', 'elongation', 'time', 'duration', 'period', 'distance', 'gap', 'spacing', 'pitch',
+    'angle', 'wavelength', 'point', 'dose', 'dosage', 'osmolality', 'osmolarity', 'ph', 'conductivity', 'capacity', 'load',
+    'force', 'torque', 'flow', 'yield', 'purity', 'fraction', 'percentage', 'level', 'range', 'tolerance', 'loss', 'gain',
+}
+# Words that can not be part of an element or property. The element/property starts after the last one
+STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'wherein', 'whereby', 'which', 'that', 'where', 'when', 'in', 'on', 'at', 'to', 'for',
+    'by', 'from', 'with', 'having', 'has', 'have', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'may', 'can', 'such',
+    'as', 'its', 'their', 'this', 'these', 'those', 'each', 'also', 'preferably', 'comprises', 'comprising', 'includes',
+    'including', 'embodiment', 'embodiments', 'example', 'e.g.', 'i.e.',
+}
+HAVING_WORDS = r'(?:having|has|have|with|exhibits?|exhibiting|showing|shows)'
+# Up to 7 words. The words that introduce a property can not be part of it, so the closest one to the value is used
+PHRASE = r'(?:(?!' + HAVING_WORDS + r'\b)[\w()°/.-]+\s){0,6}?(?!' + HAVING_WORDS + r'\b)[\w()°/.-]+'
+VALUE_PREFIX = r'(?P<qualifier>(?:(?:' + QUALIFIERS_PATTERN + r')\s+)*)$'
+# <element> having a <property> of <value>
+HAVING_PATTERN = re.compile(
+    r'(?P<element>' + PHRASE + r')\s+' + HAVING_WORDS + r'\s+(?:an?|the)\s+'
+    r'(?P<property>' + PHRASE + r')\s+(?P<connector>(?:of|is|are|at|that is|which is)\s+)?' + VALUE_PREFIX
+)
+# the <property> of the <element> is <value>
+PROPERTY_OF_PATTERN = re.compile(
+    r'\b(?:[Tt]he|[Aa]n?)\s+(?P<property>' + PHRASE + r')\s+of\s+(?:the|an?|said)\s+(?P<element>' + PHRASE + r')\s+'
+    r'(?P<connector>(?:is|are|was|were|ranges|may be|can be|will be|being)\s+)' + VALUE_PREFIX
+)
+# Separators between two candidates that form a range (0.855 g/cc to 0.900 g/cc)
+RANGE_SEPARATOR = re.compile(r'\s*(?:to|-|–|and)\s*(?:(?:' + QUALIFIERS_PATTERN + r')\s+)?$')
+CLAUSE_BOUNDARY = re.compile(r'[.;:]\s|\n')
+LEFT_CONTEXT_CHARS = 300
+
+def _last_phrase(phrase):
+    ''' Cleans an element or property: the words after the last stopword. Returns None if nothing is left. '''
+    words = phrase.strip(' ,').split()
+    while words and words[-1].lower() in STOPWORDS | {'of'}:
+        words.pop()
+    for position in range(len(words) - 1, -1, -1):
+        if words[position].lower().strip(',') in STOPWORDS or words[position].endswith(','):
+            words = words[position + 1:]
+            break
+    phrase = ' '.join(words).strip(' ,')
+    return phrase or None
+
+def _split_candidate(candidate):
+    ''' Splits a measurement candidate into its value and its unit. '''
+    if candidate[0] in '$€£¥':
+        return candidate[1:].strip(), candidate[0]
+    number = re.match(NUMBER_RANGE, candidate).group()
+    return number, candidate[len(number):].strip()
+
+def _candidates(masked_text):
+    ''' Measurement candidates of a text as (start, end, value, unit). Two candidates that form a range are merged. '''
+    candidates = []
+    for match in MEASUREMENT_CANDIDATE.finditer(masked_text):
+        value, unit = _split_candidate(match.group())
+        if candidates:
+            previous_start, previous_end, previous_value, previous_unit = candidates[-1]
+            separator = masked_text[previous_end:match.start()]
+            if unit == previous_unit and RANGE_SEPARATOR.match(separator):
+                candidates[-1] = (previous_start, match.end(), f'{previous_value}{separator}{value}', unit)
+                continue
+        candidates.append((match.start(), match.end(), value, unit))
+    return candidates
+
+def _explain_candidate(left_context):
+    ''' Applies the patterns to the text at the left of a candidate. Returns the element, property and qualifier or None. '''
+    for pattern in (PROPERTY_OF_PATTERN, HAVING_PATTERN):
+        match = pattern.search(left_context)
+        # A value right after the property without a connector or a qualifier ("a plasma level 12 hours after")
+        # is usually not the value of the property
+        if match and (match.group('connector') or match.group('qualifier')):
+            element = _last_phrase(match.group('element'))
+            measured_property = _last_phrase(match.group('property'))
+            if element and measured_property:
+                return element, measured_property, match.group('qualifier').strip()
+    return None
+
+def extract_measurements_rules(text):
+    '''
+    Extracts the measurements of a text with the rules. Returns the measurements (same format as the LLM ones)
+    and the confidence of the chunk: the minimum confidence of its candidates, where a candidate explained by a pattern
+    with a known property has confidence 1, with an unknown property 0.5, and a candidate not explained has 0.
+    A text without candidates has confidence 0, since the rules can not tell that it has no measurements.
+    '''
+    masked_text = mask_references(text)
+    candidates = _candidates(masked_text)
+    if not candidates:
+        return [], 0
+    measurements = []
+    confidence = 1
+    for start, end, value, unit in candidates:
+        # The patterns are applied to the clause of the candidate (at most LEFT_CONTEXT_CHARS characters)
+        window_start = max(0, start - LEFT_CONTEXT_CHARS)
+        clause_start = max([match.end() for match in CLAUSE_BOUNDARY.finditer(masked_text, window_start, start)], default=window_start)
+        explanation = _explain_candidate(masked_text[clause_start:start])
+        if explanation is None:
+            confidence = 0
+            continue
+        element, measured_property, qualifier = explanation
+        if measured_property.split()[-1].lower() not in PROPERTY_LEXICON:
+            confidence = min(confidence, 0.5)
+        measurements.append({
+            'element': element,
+            'property': measured_property,
+            'value': f'{qualifier} {value}'.strip(),
+            'unit': unit,
+        })
+    return measurements, confidence
@@ -0,0 +1,191 @@
+'''
+Script that collects the telemetry of an extraction run of first_approach.py.
+Each processed chunk and each patent section is written as a JSON line with its timings (split, filter, LLM, parse
+of the completion, validation), its prompt and completion tokens, retries, cache hits and estimated cost, followed by
+the wall time and the peak RSS (resident memory, including native buffers) of each stage of the run and a summary
+with the percentiles of the LLM latency.
+The stages can optionally be profiled with cProfile (a .prof file per stage, see python -m pstats) or tracemalloc
+(peak memory and top allocations of each stage), to find where the time and the memory go on large runs.
+'''
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak RSS is not recorded
+    resource = None
+
+PROFILERS = [None, 'cprofile', 'tracemalloc']
+PERCENTILES = [50, 95, 99]
+# Fields of the chunk records that are added up in the patent records and in the summary
+SUMMED_FIELDS = [
+    'split_seconds', 'filter_seconds', 'rules_seconds', 'llm_seconds', 'parse_seconds', 'validate_seconds', 'rate_limit_wait_seconds',
+    'prompt_tokens', 'completion_tokens', 'retries', 'cost', 'measurements', 'valid_measurements',
+]
+
+def percentile(values, q):
+    ''' q-th percentile of a list of values (nearest rank). None if the list is empty. '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def max_rss_mb(children=False):
+    '''
+    Peak RSS in MB of this process since it started, or of its finished child processes (e.g. the parser workers) if
+    children is True. The peak never goes down, so the peak of a stage is the value at its end when it is bigger than the
+    value at the end of the previous stage. None if it cannot be measured.
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+def call_cost(prices, prompt_tokens, completion_tokens):
+    ''' Estimated cost of a call with the prices per 1k tokens of a model ({'prompt': ..., 'completion': ...}). '''
+    if not prices:
+        return 0.0
+    return (prompt_tokens * prices['prompt'] + completion_tokens * prices['completion']) / 1000
+
+class RunTelemetry:
+    '''
+    Collects the metrics of the chunks, the LLM calls and the stages of a run and writes them as JSON lines to path.
+    The chunk records are written as soon as the chunks are processed (thread safe), the patent, stage and summary
+    records at the end (see close()). prices are the prices per 1k tokens of the model, None for local models.
+    '''
+    def __init__(self, path, model_name, prices=None, profiler=None, profile_dir=None):
+        if profiler not in PROFILERS:
+            raise ValueError(f'Unknown profiler {profiler}. Possible values are: {PROFILERS}')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.model_name = model_name
+        self.prices = prices
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.call_latencies = []
+        self.stages = []
+        self.current_stage = None
+        if profiler == 'tracemalloc':
+            tracemalloc.start()
+        if profiler == 'cprofile':
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def begin_stage(self, name):
+        ''' Starts timing (and profiling) a stage of the run. The previous stage is ended. '''
+        if self.current_stage is not None:
+            self.end_stage()
+        stage = {'name': name, 'start': time.perf_counter()}
+        if self.profiler == 'cprofile':
+            # cProfile only sees the thread that enables it, so the LLM calls of the thread pool are not profiled
+            stage['profile'] = cProfile.Profile()
+            stage['profile'].enable()
+        elif self.profiler == 'tracemalloc':
+            tracemalloc.reset_peak()
+            stage['snapshot'] = tracemalloc.take_snapshot()
+        self.current_stage = stage
+
+    def end_stage(self):
+        ''' Ends the current stage and keeps its wall time, the peak RSS of the process (and its profile or its Python allocations). '''
+        stage = self.current_stage
+        self.current_stage = None
+        record = {'type': 'stage', 'stage': stage['name'], 'seconds': time.perf_counter() - stage['start'], 'max_rss_mb': max_rss_mb()}
+        if self.profiler == 'cprofile':
+            stage['profile'].disable()
+            record['profile'] = os.path.join(self.profile_dir, f'{stage["name"].replace(" ", "_")}.prof')
+            stage['profile'].dump_stats(record['profile'])
+        elif self.profiler == 'tracemalloc':
+            _, peak = tracemalloc.get_traced_memory()
+            record['peak_memory_mb'] = peak / 2**20
+            statistics = tracemalloc.take_snapshot().compare_to(stage['snapshot'], 'lineno')
+            record['top_allocations'] = [
+                {'line': str(statistic.traceback), 'size_mb': statistic.size_diff / 2**20} for statistic in statistics[:10]
+            ]
+        self.stages.append(record)
+
+    def record_call(self, metrics, prompt_tokens, completion_tokens):
+        '''
+        Completes the metrics of an LLM call (see MeasurementExtractor.query() in measurement_pipeline.py) with its tokens and cost.
+        The cached completions do not count in the latency percentiles nor in the cost.
+        '''
+        metrics['prompt_tokens'] = prompt_tokens
+        metrics['completion_tokens'] = completion_tokens
+        metrics['cost'] = 0.0 if metrics['cache_hit'] else call_cost(self.prices, prompt_tokens, completion_tokens)
+        if not metrics['cache_hit']:
+            with self.lock:
+                self.call_latencies.append(metrics['llm_seconds'])
+
+    def record_chunk(self, doc_id, data_section, chunk_idx, metrics):
+        '''
+        Writes the metrics of a chunk. The metrics of a call shared by a batch of chunks are split evenly among them,
+        except its retries, which are counted in the first chunk only (see process_chunk_batch() in first_approach.py).
+        '''
+        record = {'type': 'chunk', 'doc_id': doc_id, 'data_section': data_section, 'chunk_idx': chunk_idx}
+        record.update(metrics)
+        with self.lock:
+            self.chunks.append(record)
+            self._write(record)
+
+    def patent_records(self):
+        ''' Metrics of each patent section: its chunks by path (llm, rules, journal, duplicate, skipped) and the sums of the chunk metrics. '''
+        patents = {}
+        for chunk in self.chunks:
+            key = (chunk['doc_id'], chunk['data_section'])
+            if key not in patents:
+                patents[key] = {'type': 'patent', 'doc_id': chunk['doc_id'], 'data_section': chunk['data_section'], 'chunks': 0, 'paths': {}}
+                patents[key].update({field: 0 for field in SUMMED_FIELDS})
+            patent = patents[key]
+            patent['chunks'] += 1
+            patent['paths'][chunk['path']] = patent['paths'].get(chunk['path'], 0) + 1
+            for field in SUMMED_FIELDS:
+                patent[field] += chunk.get(field, 0)
+        return list(patents.values())
+
+    def summary(self):
+        ''' Totals of the run and percentiles of the LLM latency (in seconds). '''
+        summary = {'type': 'summary', 'model_name': self.model_name, 'chunks': len(self.chunks)}
+        summary.update({field: sum(chunk.get(field, 0) for chunk in self.chunks) for field in SUMMED_FIELDS})
+        summary['cache_hits'] = sum(chunk.get('cache_hit', False) for chunk in self.chunks)
+        summary['llm_calls'] = len(self.call_latencies)
+        summary['llm_latency'] = {f'p{q}': percentile(self.call_latencies, q) for q in PERCENTILES}
+        summary['stages'] = {stage['stage']: stage['seconds'] for stage in self.stages}
+        return summary
+
+    def close(self):
+        ''' Ends the current stage, writes the patent, stage and summary records and returns the summary. '''
+        if self.current_stage is not None:
+            self.end_stage()
+        if self.profiler == 'tracemalloc':
+            tracemalloc.stop()
+        summary = self.summary()
+        for record in self.patent_records() + self.stages + [summary]:
+            self._write(record)
+        self.file.close()
+        return summary
+
+def print_summary(summary):
+    ''' Prints the summary of a run: time of each stage, LLM latency percentiles, tokens, retries, cache hits and cost. '''
+    print('Time of each stage: ' + ', '.join(f'{stage} {seconds:.2f} s' for stage, seconds in summary['stages'].items()))
+    latency = summary['llm_latency']
+    if summary['llm_calls']:
+        print(f'LLM latency of {summary["llm_calls"]} calls: ' + ', '.join(f'{name} {seconds:.2f} s' for name, seconds in latency.items()))
+    print(f'Chunk time: split {summary["split_seconds"]:.2f} s, filter {summary["filter_seconds"]:.2f} s, rules {summary["rules_seconds"]:.2f} s, '
+          f'LLM {summary["llm_seconds"]:.2f} s (rate limit wait {summary["rate_limit_wait_seconds"]:.2f} s), '
+          f'parse {summary["parse_seconds"]:.2f} s, validate {summary["validate_seconds"]:.2f} s')
+    print(f'Tokens: {summary["prompt_tokens"]:.0f} prompt, {summary["completion_tokens"]:.0f} completion. '
+          f'Retries: {summary["retries"]}. Cache hits: {summary["cache_hits"]}. '
+          f'Estimated cost ({summary["model_name"]}): ${summary["cost"]:.4f}')
@@ -0,0 +1,53 @@
+'''
+Script that creates a tiny causal language model (GPT-2 architecture with random weights) in a local folder.
+The model generates nonsense, but it has the same interface as the MPT model, so it can be served by mpt_api.py
+(setting api_model_path to its folder) to test and benchmark the API on CPU in a few seconds.
+The tokenizer is a byte level BPE trained on the few-shot examples of prompts.py.
+'''
+
+import argparse
+import torch
+from tokenizers import ByteLevelBPETokenizer
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+from config import config
+from prompts import patent_examples
+from input_examples import inp_examples
+
+END_OF_TEXT = '<|endoftext|>'
+
+def create_tiny_model(path, vocab_size=1000, hidden_size=64, layers=2, heads=2):
+    ''' Creates and saves a tiny random model along with its tokenizer in path. '''
+    texts = [text for text, _ in patent_examples] + inp_examples
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts, vocab_size=vocab_size, special_tokens=[END_OF_TEXT])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token=END_OF_TEXT)
+
+    model_config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=4096,
+        n_embd=hidden_size,
+        n_layer=layers,
+        n_head=heads,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    model = GPT2LMHeadModel(model_config)
+    # With the end of text embedding set to zero its logit is 0, so the model (almost) never stops by itself and every
+    # request generates max_new_tokens tokens. This keeps the benchmarks comparable between runs
+    with torch.no_grad():
+        model.transformer.wte.weight[tokenizer.eos_token_id].zero_()
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a tiny random model to test the model API.')
+    parser.add_argument('--path', default=config['tiny_model_path'], help='Destination folder of the model.')
+    parser.add_argument('--hidden-size', type=int, default=64, help='Size of the hidden states. Bigger models are closer to the real one in the CPU benchmarks.')
+    parser.add_argument('--layers', type=int, default=2, help='Number of transformer layers.')
+    parser.add_argument('--heads', type=int, default=2, help='Number of attention heads.')
+    args = parser.parse_args()
+    create_tiny_model(args.path, hidden_size=args.hidden_size, layers=args.layers, heads=args.heads)
+    print(f'Tiny model saved in {args.path}')
+
+if __name__ == '__main__':
+    main()
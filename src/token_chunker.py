@@ -0,0 +1,104 @@
+'''
+Script that splits the patent texts into chunks measured in tokens of the model instead of characters.
+The budget of each chunk is what is left of the context window of the model after the rendered kor prompt
+(instructions + few-shot examples), the maximum tokens of the completion and a safety margin.
+The text is split into sentences, which are packed into chunks as full as the budget allows, so there are fewer
+and fuller queries to the LLM and no query exceeds the context window of the model.
+'''
+
+import re
+import statistics
+
+# A sentence ends with . ! or ? followed by whitespace and an uppercase letter or an opening bracket/quote
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+(?=[A-Z("\[])')
+# Abbreviations frequent in patents that end with a dot but do not end the sentence
+ABBREVIATIONS = ('No.', 'Nos.', 'Pat.', 'FIG.', 'FIGS.', 'Fig.', 'Figs.', 'U.S.', 'e.g.', 'i.e.', 'et al.', 'approx.', 'Ser.', 'Appl.')
+
+def load_token_counter(use_open_ai, model_name):
+    '''
+    Returns a function that counts the tokens of a text with the tokenizer of the model:
+    tiktoken for the openai models and the huggingface tokenizer for the local models (e.g. MPT).
+    '''
+    if use_open_ai:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model_name)
+        return lambda text: len(encoding.encode(text))
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return lambda text: len(tokenizer.encode(text))
+
+def split_sentences(text):
+    ''' Splits a text into sentences. The pieces that end with an abbreviation are joined with the next one. '''
+    sentences = []
+    for piece in SENTENCE_BOUNDARY.split(text.strip()):
+        if sentences and sentences[-1].endswith(ABBREVIATIONS):
+            sentences[-1] += ' ' + piece
+        else:
+            sentences.append(piece)
+    return [sentence for sentence in sentences if sentence]
+
+class TokenChunker:
+    '''
+    Packs the sentences of a text into chunks of at most token_budget tokens.
+    Sentences longer than the budget are split by words. It keeps the number of tokens of every chunk produced,
+    to report how full the chunks are (see fill_ratio()).
+    '''
+    def __init__(self, count_tokens, token_budget):
+        if token_budget <= 0:
+            raise ValueError(
+                f'There is no room for the text in the context window of the model (token budget = {token_budget}). '
+                'Reduce the maximum tokens of the completion or the number of few-shot examples.'
+            )
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.chunk_tokens = []
+
+    def _pack(self, pieces):
+        ''' Greedily groups consecutive pieces (sentences or words) while their tokens fit in the budget. '''
+        groups = []
+        current, current_tokens = [], 0
+        for piece in pieces:
+            piece_tokens = self.count_tokens(piece)
+            if piece_tokens > self.token_budget and ' ' in piece:
+                # Sentence longer than the budget: it goes in its own chunks, split by words
+                if current:
+                    groups.append(current)
+                    current, current_tokens = [], 0
+                groups.extend(self._pack(piece.split(' ')))
+                continue
+            # +1 for the space that joins the pieces
+            if current and current_tokens + 1 + piece_tokens > self.token_budget:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens + (1 if len(current) > 1 else 0)
+        if current:
+            groups.append(current)
+        return groups
+
+    def _fit(self, pieces):
+        '''
+        Joins a group of pieces into a chunk. The sum of the tokens of the pieces is an estimation of the tokens of the
+        chunk (the tokenizer may merge the text differently), so the chunk is counted again and halved if it does not fit.
+        '''
+        text = ' '.join(pieces)
+        tokens = self.count_tokens(text)
+        if tokens <= self.token_budget or len(pieces) == 1:
+            return [(text, tokens)]
+        middle = len(pieces) // 2
+        return self._fit(pieces[:middle]) + self._fit(pieces[middle:])
+
+    def split_text(self, text):
+        ''' Splits a text into chunks that fit in the token budget. '''
+        chunks = []
+        for group in self._pack(split_sentences(text)):
+            for chunk, tokens in self._fit(group):
+                chunks.append(chunk)
+                self.chunk_tokens.append(tokens)
+        return chunks
+
+    def fill_ratio(self):
+        ''' Average fraction of the token budget used by the chunks produced so far. '''
+        if not self.chunk_tokens:
+            return 0
+        return statistics.mean(self.chunk_tokens) / self.token_budget
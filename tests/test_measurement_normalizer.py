@@ -0,0 +1,25 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from measurement_normalizer import value_ranges
+
+@pytest.mark.parametrize('value, expected', [
+    ('1 x 10-5', 1e-5),
+    ('5×10^3', 5e3),
+    ('about 1.5e-3', 1.5e-3),
+])
+def test_scientific_notation_is_a_single_number(value, expected):
+    ranges = value_ranges(pd.Series([value], dtype='string'))
+    assert ranges.loc[0, 'value_min'] == pytest.approx(expected)
+    assert ranges.loc[0, 'value_max'] == pytest.approx(expected)
+
+def test_unparsed_exponent_leaves_min_and_max_empty():
+    ranges = value_ranges(pd.Series(['10^x cells'], dtype='string'))
+    assert ranges.isna().all(axis=None)
+
+def test_dimensions_and_ranges_are_not_scientific_notation():
+    ranges = value_ranges(pd.Series(['5 x 100 mm', 'between 20 and 40'], dtype='string'))
+    assert ranges.values.tolist() == [[5.0, 100.0], [20.0, 40.0]]